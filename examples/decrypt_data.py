@@ -23,8 +23,7 @@ def read_encrypted_dataframe(ciphertext: Path) -> None:
                 plaintext = ciphertext.with_suffix("")
                 print(plaintext)
                 start = time()
-                with open(plaintext, "rb") as p, open(ciphertext, "wb") as c:
-                    c.write(crypto_key.encrypt(p.read()))
+                crypto_key.encrypt_stream(plaintext, ciphertext)
                 print("encryption took %.2fs" % (time() - start))
 
             # now decrypt in-memory
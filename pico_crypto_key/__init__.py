@@ -4,7 +4,17 @@ from struct import pack
 
 __version__ = importlib.metadata.version("pico-crypto-key")
 
-from .device import CryptoKey, CryptoKeyConnectionError, CryptoKeyPinError
+from .aio import AsyncCryptoKey
+from .batch import Batch
+from .daemon import CryptoKeyClient, CryptoKeyServer
+from .device import (
+    CryptoKey,
+    CryptoKeyAuthenticationError,
+    CryptoKeyCommunicationError,
+    CryptoKeyConnectionError,
+    CryptoKeyPinError,
+)
+from .pool import CryptoKeyPool
 
 TIMESTAMP_RESOLUTION_MS = 60_000  # 1 min
 
@@ -0,0 +1,281 @@
+"""
+asyncio interface to the crypto key.
+
+USB transfers block, and an encryption can take many seconds, so every command runs on a dedicated I/O thread per
+device. The thread runs one command at a time, in the order they were awaited, so many coroutines can share one key
+without blocking the event loop or interleaving their commands.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+from collections.abc import AsyncIterator, Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from types import TracebackType
+from typing import Any, BinaryIO, Literal, TypeVar, cast
+
+from pico_crypto_key.device import Buffer, CipherMode, CryptoKey
+
+T = TypeVar("T")
+
+# max number of results a streaming command can get ahead of its consumer
+STREAM_BUFFER = 8
+
+
+class _Emitter:
+    """Writable (file-like) object that hands chunks from the I/O thread to an async consumer"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue[Any]) -> None:
+        self.loop = loop
+        self.queue = queue
+        # set when the consumer stops iterating
+        self.abandoned = threading.Event()
+
+    def emit(self, item: Any) -> bool:
+        """Blocks until the consumer has room for item. Returns False (discarding item) if it has gone away"""
+        if self.abandoned.is_set():
+            return False
+        put = asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop)
+        while True:
+            try:
+                put.result(timeout=0.1)
+                return True
+            except TimeoutError:
+                # the consumer (or its event loop) may have gone while the queue was full
+                if self.abandoned.is_set():
+                    put.cancel()
+                    return False
+
+    def write(self, b: Buffer) -> int:
+        # the buffer may be reused by the sender
+        self.emit(bytes(b))
+        return len(b)
+
+
+class AsyncCryptoKey:
+    """
+    Awaitable wrapper around CryptoKey, for use as an async context manager.
+    Don't issue other commands on the same key while iterating one of the streaming methods (hash_many, sign_many,
+    encrypt_stream, decrypt_stream): they are queued behind it, so awaiting one in the loop body would never complete.
+    """
+
+    def __init__(self, device: Any = None, **kwargs: Any) -> None:
+        """
+        Create device object for use in async context manager.
+        Arguments are as CryptoKey.
+        """
+        self.key = CryptoKey(device, **kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pico-crypto-key-io")
+
+    async def __aenter__(self) -> AsyncCryptoKey:
+        """Initialises the device's repl."""
+        await self._run(self.key.init)
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        exc_stack: TracebackType | None,
+    ) -> None:
+        """Disconnect from the device's repl, once all queued commands have completed."""
+        await self._run(self.key.__exit__, exc_type, exc_value, exc_stack)
+        self._executor.shutdown()
+
+    async def hash(self, data: str | Path | BinaryIO | Buffer, length: int | None = None) -> bytes:
+        """Computes the SHA256 hash of a file or data, see CryptoKey.hash"""
+        return await self._run(self.key.hash, data, length)
+
+    async def sign(
+        self,
+        data: str | Path | BinaryIO | Buffer,
+        length: int | None = None,
+        prehash: Literal["device", "host"] = "device",
+    ) -> tuple[bytes, bytes]:
+        """Computes the hash of a file or data and its ECDSA signature, see CryptoKey.sign"""
+        return await self._run(self.key.sign, data, length, prehash)
+
+    async def sign_digest(self, digest: Buffer) -> bytes:
+        """Computes the ECDSA signature of a SHA256 hash computed elsewhere, see CryptoKey.sign_digest"""
+        return await self._run(self.key.sign_digest, digest)
+
+    async def verify(self, digest: bytes, sig: bytes, pubkey: bytes) -> int:
+        """Checks an ECDSA signature, see CryptoKey.verify"""
+        return await self._run(self.key.verify, digest, sig, pubkey)
+
+    async def encrypt(self, data: bytes, mode: CipherMode = "cfb8") -> bytes:
+        """Encrypts data using AES256, see CryptoKey.encrypt"""
+        return await self._run(self.key.encrypt, data, mode)
+
+    async def decrypt(self, data: bytes, mode: CipherMode = "cfb8") -> bytes:
+        """Decrypts data using AES256, see CryptoKey.decrypt"""
+        return await self._run(self.key.decrypt, data, mode)
+
+    async def pubkey(self) -> bytes:
+        """Returns the ECDSA public key, see CryptoKey.pubkey"""
+        return await self._run(self.key.pubkey)
+
+    async def register(self, relying_party: str, user: str) -> bytes:
+        """Returns the webauthn public key for the relying party and user, see CryptoKey.register"""
+        return await self._run(self.key.register, relying_party, user)
+
+    async def auth(self, relying_party: str, user: str, challenge: bytes) -> bytes:
+        """Signs a webauthn challenge, see CryptoKey.auth"""
+        return await self._run(self.key.auth, relying_party, user, challenge)
+
+    async def info(self) -> tuple[str, datetime]:
+        """Returns the firmware version and device time, see CryptoKey.info"""
+        return await self._run(self.key.info)
+
+    async def device_id(self) -> bytes | None:
+        """Returns the device identifier, see CryptoKey.device_id"""
+        return await self._run(self.key.device_id)
+
+    async def hash_many(self, items: Iterable[str | Path | BinaryIO | Buffer]) -> AsyncIterator[bytes]:
+        """
+        Hashes many files or data, yielding digests as the device produces them. See CryptoKey.hash_many
+
+        Parameters
+        ----------
+        items: Iterable[str | Path | BinaryIO | Buffer]
+            The items to hash
+
+        Yields
+        ------
+        bytes
+            The hash digest of each item, in order
+        """
+
+        def produce(emitter: _Emitter) -> None:
+            results = self.key.hash_many(items)
+            try:
+                for result in results:
+                    if not emitter.emit(result):
+                        break
+            finally:
+                # completes the command on the device if the consumer stopped early
+                results.close()
+
+        async for result in self._stream(produce):
+            yield result
+
+    async def sign_many(
+        self, items: Iterable[str | Path | BinaryIO | Buffer], prehashed: bool = False
+    ) -> AsyncIterator[tuple[bytes, bytes]]:
+        """
+        Signs a batch of files or data (or digests), yielding results as the device produces them. See
+        CryptoKey.sign_many
+
+        Parameters
+        ----------
+        items: Iterable[str | Path | BinaryIO | Buffer]
+            The items to sign, or SHA256 digests if prehashed
+        prehashed: bool
+            The items are 32-byte SHA256 digests, which are signed directly
+
+        Yields
+        ------
+        tuple[bytes, bytes]
+            The hash digest and the signature of each item, in order
+        """
+
+        def produce(emitter: _Emitter) -> None:
+            results = self.key.sign_many(items, prehashed)
+            try:
+                for result in results:
+                    if not emitter.emit(result):
+                        break
+            finally:
+                # completes the batch on the device if the consumer stopped early
+                results.close()
+
+        async for result in self._stream(produce):
+            yield result
+
+    async def encrypt_stream(
+        self, src: str | Path | BinaryIO, length: int | None = None, mode: CipherMode = "cfb8"
+    ) -> AsyncIterator[bytes]:
+        """
+        Encrypts a file or stream using AES256, yielding the ciphertext in chunks as it is received. The concatenated
+        chunks are identical to the output of encrypt. See CryptoKey.encrypt_stream
+
+        Parameters
+        ----------
+        src: str | Path | BinaryIO
+            The name of the input file, or a binary file object opened for reading
+        length: int | None
+            The number of bytes to encrypt. Defaults to the remainder of src, which must then be seekable
+        mode: CipherMode
+            The cipher mode, see CryptoKey.encrypt
+
+        Yields
+        ------
+        bytes
+            Chunks of ciphertext
+        """
+        async for chunk in self._stream(
+            lambda emitter: self.key.encrypt_stream(src, cast(BinaryIO, emitter), length, mode)
+        ):
+            yield chunk
+
+    async def decrypt_stream(
+        self, src: str | Path | BinaryIO, length: int | None = None, mode: CipherMode = "cfb8"
+    ) -> AsyncIterator[bytes]:
+        """
+        Decrypts a file or stream using AES256, yielding the plaintext in chunks as it is received. See
+        CryptoKey.decrypt_stream
+
+        Parameters
+        ----------
+        src: str | Path | BinaryIO
+            The name of the encrypted file, or a binary file object opened for reading
+        length: int | None
+            The number of bytes of src to decrypt (including any header). Defaults to the remainder of src, which must
+            then be seekable
+        mode: CipherMode
+            The cipher mode the data was encrypted with. In gcm mode, CryptoKeyAuthenticationError is raised after the
+            last chunk if authentication fails, in which case all the chunks must be discarded
+
+        Yields
+        ------
+        bytes
+            Chunks of plaintext
+        """
+        async for chunk in self._stream(
+            lambda emitter: self.key.decrypt_stream(src, cast(BinaryIO, emitter), length, mode)
+        ):
+            yield chunk
+
+    async def _run(self, fn: Callable[..., T], *args: Any) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, partial(fn, *args))
+
+    async def _stream(self, produce: Callable[[_Emitter], Any]) -> AsyncIterator[Any]:
+        """Runs produce on the I/O thread, yielding what it emits"""
+        queue: asyncio.Queue[Any] = asyncio.Queue(STREAM_BUFFER)
+        emitter = _Emitter(asyncio.get_running_loop(), queue)
+        done = object()
+
+        def run() -> None:
+            try:
+                produce(emitter)
+            finally:
+                emitter.emit(done)
+
+        task = asyncio.ensure_future(self._run(run))
+        try:
+            while (item := await queue.get()) is not done:
+                yield item
+            # raises any error from produce
+            await task
+        finally:
+            # if the consumer stopped early, let the command run to completion (discarding its output) so that the
+            # device is ready for the next one
+            emitter.abandoned.set()
+            while not queue.empty():
+                queue.get_nowait()
+            # any error is of no interest once the consumer has gone
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
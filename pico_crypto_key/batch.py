@@ -0,0 +1,202 @@
+"""
+Small commands with several in flight at once.
+
+Untagged commands are strictly one at a time: the host can't send the next command until it has read the whole reply to
+the previous one, since nothing in the byte stream says which reply is which, or where one ends. With firmware that
+supports tagged frames (see CryptoKey.protocol_version), each command in a batch is sent as a frame carrying a request
+id, its length and a checksum, as soon as it's queued. Replies carry the id of their request and are matched up as they
+arrive, so round trips overlap, and a corrupted reply is reported as an error rather than misread.
+
+Only as many requests are kept in flight as the device's USB buffers can hold, so that neither side blocks on a full
+buffer while the other waits for it. With older firmware, each command runs (untagged) as it is queued.
+"""
+
+from __future__ import annotations
+
+from base64 import b64encode
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from datetime import datetime
+from struct import calcsize, pack, unpack
+from types import TracebackType
+from typing import Any, Generic, TypeVar, cast
+
+from pico_crypto_key.device import Buffer, CryptoKey, CryptoKeyCommunicationError, _digest
+from pico_crypto_key.metrics import Sample
+
+T = TypeVar("T")
+
+# upper bound on the size of a reply frame to any of the commands, used to limit the replies in flight
+MAX_REPLY_BYTES = 128
+
+
+class Reply(Generic[T]):
+    """The result of a command in a batch, available once the device has replied"""
+
+    def __init__(self, batch: Batch, request_id: int, opcode: bytes, parse: Callable[[bytes], T]) -> None:
+        self.batch = batch
+        self.id = request_id
+        self.opcode = opcode
+        self._parse = parse
+        self._done = False
+        self._value: T | None = None
+        self._error: BaseException | None = None
+
+    def done(self) -> bool:
+        """Whether the reply has been received"""
+        return self._done
+
+    def result(self) -> T:
+        """Returns the result, receiving replies from the device until this one has arrived"""
+        while not self._done:
+            self.batch._receive()
+        if self._error is not None:
+            raise self._error
+        return cast(T, self._value)
+
+    def _set(self, payload: bytes) -> None:
+        try:
+            self._resolve(self._parse(payload))
+        except Exception as e:
+            self._fail(e)
+
+    def _resolve(self, value: T) -> None:
+        self._value = value
+        self._done = True
+
+    def _fail(self, error: BaseException) -> None:
+        self._error = error
+        self._done = True
+
+
+class Batch:
+    """
+    Commands sent back-to-back in tagged frames. Not thread safe, and the key must not be used for anything else until
+    every reply has been received (see wait), which leaving the context manager does
+    """
+
+    def __init__(self, crypto_key: CryptoKey) -> None:
+        self.key = crypto_key
+        # whether commands are sent in frames (otherwise they run as they're queued)
+        self.framed = crypto_key.protocol_version() == CryptoKey.FRAME_VERSION
+        capabilities = crypto_key.capabilities()
+        self._rx_bytes = capabilities.get("rx_bufsize", 0)
+        self._max_in_flight = max(1, capabilities.get("tx_bufsize", 0) // MAX_REPLY_BYTES)
+        self._pending: dict[int, tuple[Reply[Any], int]] = {}
+        self._in_flight_bytes = 0
+        self._next_id = 0
+        self._sample = Sample("batch")
+
+    def __enter__(self) -> Batch:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        exc_stack: TracebackType | None,
+    ) -> None:
+        """Receives any outstanding replies."""
+        self.wait()
+
+    def __len__(self) -> int:
+        """The number of requests awaiting a reply"""
+        return len(self._pending)
+
+    def pubkey(self) -> Reply[bytes]:
+        """Queues a request for the ECDSA public key (see CryptoKey.pubkey)"""
+        return self._submit(b"k", b"", bytes, self.key.pubkey)
+
+    def info(self) -> Reply[tuple[str, datetime]]:
+        """Queues a request for board information (see CryptoKey.info)"""
+        return self._submit(b"i", b"", lambda payload: CryptoKey._parse_info(payload[4:]), self.key.info)
+
+    def device_id(self) -> Reply[bytes | None]:
+        """Queues a request for the device id (see CryptoKey.device_id)"""
+        return self._submit(b"u", b"", lambda payload: payload[4:], self.key.device_id)
+
+    def verify(self, digest: bytes, sig: bytes, pubkey: bytes) -> Reply[int]:
+        """Queues a signature verification (see CryptoKey.verify)"""
+        payload = digest + pack("I", len(sig)) + sig + pack("I", len(pubkey)) + pubkey
+        return self._submit(
+            b"v", payload, lambda payload: unpack("I", payload)[0], self.key.verify, digest, sig, pubkey
+        )
+
+    def sign_digest(self, digest: Buffer) -> Reply[bytes]:
+        """Queues signing of a precomputed SHA256 digest (see CryptoKey.sign_digest)"""
+        return self._submit(b"g", _digest(digest), lambda payload: payload[4:], self.key.sign_digest, digest)
+
+    def register(self, relying_party: str, user: str) -> Reply[bytes]:
+        """Queues a request for a relying party's public key (see CryptoKey.register)"""
+        userdata = f"{user}@{relying_party}".encode()
+        return self._submit(b"r", pack("I", len(userdata)) + userdata, bytes, self.key.register, relying_party, user)
+
+    def auth(self, relying_party: str, user: str, challenge: bytes) -> Reply[bytes]:
+        """Queues an authentication (see CryptoKey.auth)"""
+        userdata = f"{user}@{relying_party}".encode()
+        payload = pack("I", len(userdata)) + userdata + pack("I", len(challenge)) + challenge
+        return self._submit(
+            b"a", payload, lambda payload: b64encode(payload[4:]), self.key.auth, relying_party, user, challenge
+        )
+
+    def wait(self) -> None:
+        """Receives every outstanding reply"""
+        while self._pending:
+            self._receive()
+        if self._sample.bytes_sent and self.key.metrics is not None:
+            self.key.metrics.record(self._sample)
+        self._sample = Sample("batch")
+
+    def _submit(
+        self, opcode: bytes, payload: bytes, parse: Callable[[bytes], T], fallback: Callable[..., Any], *args: Any
+    ) -> Reply[T]:
+        """Sends a command in a frame, or runs it untagged with older firmware"""
+        reply: Reply[T] = Reply(self, self._next_id, opcode, parse)
+        self._next_id = (self._next_id + 1) % 2**16
+        if not self.framed:
+            try:
+                reply._resolve(fallback(*args))
+            except Exception as e:
+                reply._fail(e)
+            return reply
+        if len(payload) > CryptoKey.FRAME_MAX_PAYLOAD:
+            raise ValueError(f"request must be no larger than {CryptoKey.FRAME_MAX_PAYLOAD} bytes")
+        frame_bytes = calcsize(CryptoKey.FRAME_HEADER) + len(payload) + 4
+        # make room in the device's buffers: a request larger than the receive buffer is only sent on its own
+        while self._pending and (
+            self._in_flight_bytes + frame_bytes > self._rx_bytes or len(self._pending) >= self._max_in_flight
+        ):
+            self._receive()
+        with self._recording():
+            self.key._write_frame(opcode, reply.id, payload)
+        self._pending[reply.id] = (reply, frame_bytes)
+        self._in_flight_bytes += frame_bytes
+        return reply
+
+    def _receive(self) -> None:
+        """Receives the next reply and passes it to its request"""
+        if not self._pending:
+            raise CryptoKeyCommunicationError("no requests awaiting a reply")
+        with self._recording():
+            opcode, status, request_id, payload = self.key._read_frame()
+        if request_id not in self._pending:
+            raise CryptoKeyCommunicationError(f"reply to unknown request {request_id}")
+        reply, frame_bytes = self._pending.pop(request_id)
+        self._in_flight_bytes -= frame_bytes
+        if opcode != reply.opcode:
+            reply._fail(CryptoKeyCommunicationError(f"reply to request {request_id} is for a different command"))
+        elif status:
+            error = CryptoKey.FRAME_ERRORS.get(status, f"error {status}")
+            name = CryptoKey.COMMANDS[opcode.decode()]
+            reply._fail(CryptoKeyCommunicationError(f"device rejected {name} request {request_id}: {error}"))
+        else:
+            reply._set(payload)
+
+    @contextmanager
+    def _recording(self) -> Iterator[None]:
+        """Attributes transfers to the batch, unless called from a recorded operation"""
+        if self.key.metrics is None or self.key._sample is not None:
+            yield
+            return
+        with self.key._recording(self._sample):
+            yield
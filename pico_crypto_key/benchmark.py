@@ -0,0 +1,392 @@
+"""
+Benchmark suite.
+
+Times a matrix of operations, payload sizes and chunk sizes on a device (or the emulator), with warm-up and repeat
+runs, and records percentile statistics as JSON alongside the board and firmware from info(). Result files can be
+compared to flag regressions, and used to regenerate the performance tables in the README. Where the firmware profiles
+commands (see CryptoKey.device_profile), each result also records how long per run the device spent computing and
+blocked on USB transfers.
+
+Sizes are in binary units (1K = 1024 bytes) and bitrates in kbps (1024 bits per second), as the README tables.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import platform
+import re
+from collections.abc import Callable, Iterable, Sequence
+from datetime import UTC, datetime
+from pathlib import Path
+from statistics import fmean
+from time import perf_counter
+from typing import Any
+
+import usb.core
+
+from pico_crypto_key import __version__
+from pico_crypto_key.device import CipherMode, CryptoKey
+
+RESULTS_VERSION = 1
+
+# operations that process a payload, and those whose cost doesn't depend on it (timed once per chunk size)
+SIZED_OPERATIONS = (
+    "hash",
+    "sign",
+    "encrypt",
+    "decrypt",
+    "encrypt-ctr",
+    "decrypt-ctr",
+    "encrypt-gcm",
+    "decrypt-gcm",
+)
+UNSIZED_OPERATIONS = ("sign-digest", "verify")
+OPERATIONS = SIZED_OPERATIONS + UNSIZED_OPERATIONS
+
+DEFAULT_OPERATIONS = ("hash", "sign", "verify", "encrypt", "decrypt")
+DEFAULT_SIZES = (1, 1024, 100 * 1024, 1000 * 1024)
+
+_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parse_size(size: str) -> int:
+    """Parses a size such as 100, 1K, 1000K or 100M (binary units)"""
+    match = re.fullmatch(r"(\d+)\s*([KMG]?)B?", size.strip().upper())
+    if not match:
+        raise ValueError(f"invalid size {size!r}")
+    return int(match[1]) * _UNITS[match[2]]
+
+
+def format_size(size: int) -> str:
+    """Formats a size in the largest binary unit that divides it"""
+    for unit in ("G", "M", "K"):
+        if size and size % _UNITS[unit] == 0:
+            return f"{size // _UNITS[unit]}{unit}"
+    return str(size)
+
+
+def percentile(times: Sequence[float], q: float) -> float:
+    """The qth percentile (0-100) of the times, interpolating linearly between the closest ranks"""
+    ordered = sorted(times)
+    pos = (len(ordered) - 1) * q / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (pos - lower)
+
+
+# (encrypt, mode) for the cipher operations
+_CIPHER_OPERATIONS: dict[str, tuple[bool, CipherMode]] = {
+    "encrypt": (True, "cfb8"),
+    "decrypt": (False, "cfb8"),
+    "encrypt-ctr": (True, "ctr"),
+    "decrypt-ctr": (False, "ctr"),
+    "encrypt-gcm": (True, "gcm"),
+    "decrypt-gcm": (False, "gcm"),
+}
+
+
+def _operation(crypto_key: CryptoKey, op: str, data: bytes) -> Callable[[], Any]:
+    """
+    Returns a function that performs the operation on the data. Any setup (e.g. encrypting the data to be decrypted)
+    is done here so that it isn't timed
+    """
+    if op == "hash":
+        return lambda: crypto_key.hash(data)
+    if op == "sign":
+        return lambda: crypto_key.sign(data)
+    if op in _CIPHER_OPERATIONS:
+        encrypt, mode = _CIPHER_OPERATIONS[op]
+        if encrypt:
+            return lambda: crypto_key.encrypt(data, mode)
+        ciphertext = crypto_key.encrypt(data, mode)
+        return lambda: crypto_key.decrypt(ciphertext, mode)
+    digest, sig = crypto_key.sign(data)
+    if op == "sign-digest":
+        return lambda: crypto_key.sign_digest(digest)
+    if op == "verify":
+        pubkey = crypto_key.pubkey()
+        return lambda: crypto_key.verify(digest, sig, pubkey)
+    raise ValueError(f"unknown operation {op!r}, must be one of {', '.join(OPERATIONS)}")
+
+
+def _time(
+    fn: Callable[[], Any], warmup: int, repeat: int, max_seconds: float, start: Callable[[], Any] | None = None
+) -> list[float]:
+    """
+    Times repeated calls after warming up (and calling start, if given). Stops early (after at least one timed call) if
+    max_seconds is exceeded
+    """
+    for _ in range(warmup):
+        fn()
+    if start:
+        start()
+    times: list[float] = []
+    began = perf_counter()
+    while len(times) < repeat and (not times or perf_counter() - began < max_seconds):
+        t = perf_counter()
+        fn()
+        times.append(perf_counter() - t)
+    return times
+
+
+def _device_split(profile: dict[str, dict[str, int]], runs: int) -> dict[str, float]:
+    """The mean time per run the device spent computing and transferring, from its profile of the timed runs"""
+    commands = [counters for name, counters in profile.items() if name != "device_profile"]
+    return {
+        field.replace("_us", "_s"): sum(counters[field] for counters in commands) / runs / 1e6
+        for field in ("total_us", "compute_us", "usb_read_us", "usb_write_us")
+    }
+
+
+def _statistics(times: Sequence[float], size: int | None) -> dict[str, Any]:
+    stats: dict[str, Any] = {
+        "runs": len(times),
+        "times_s": list(times),
+        "min_s": min(times),
+        "mean_s": fmean(times),
+        "p50_s": percentile(times, 50),
+        "p90_s": percentile(times, 90),
+        "p99_s": percentile(times, 99),
+        "max_s": max(times),
+    }
+    if size:
+        stats["bitrate_kbps"] = size * 8 / 1024 / stats["p50_s"]
+    return stats
+
+
+def run(
+    crypto_key: CryptoKey,
+    operations: Iterable[str] = DEFAULT_OPERATIONS,
+    sizes: Iterable[int] = DEFAULT_SIZES,
+    chunk_sizes: Iterable[int] | None = None,
+    warmup: int = 1,
+    repeat: int = 5,
+    max_seconds: float = 60.0,
+    progress: Callable[[str], None] | None = None,
+) -> dict[str, Any]:
+    """
+    Benchmarks a device
+
+    Parameters
+    ----------
+    crypto_key: CryptoKey
+        The (initialised) device
+    operations: Iterable[str]
+        The operations to time, from OPERATIONS
+    sizes: Iterable[int]
+        The payload sizes in bytes. Operations in UNSIZED_OPERATIONS are timed once per chunk size
+    chunk_sizes: Iterable[int] | None
+        The transfer chunk sizes to use, defaults to the current one. Firmware that can't negotiate chunk sizes only
+        uses its default
+    warmup: int
+        The number of untimed runs of each operation before it is timed
+    repeat: int
+        The number of timed runs of each operation
+    max_seconds: float
+        Stop repeating an operation once its timed runs have taken this long
+    progress: Callable[[str], None] | None
+        Called with a description of each result as it is measured
+
+    Returns
+    -------
+    dict[str, Any]
+        The results, with details of the device and host
+    """
+    operations = list(operations)
+    for op in operations:
+        if op not in OPERATIONS:
+            raise ValueError(f"unknown operation {op!r}, must be one of {', '.join(OPERATIONS)}")
+    sizes = sorted(sizes)
+    original_chunk_size = crypto_key.chunk_size
+    original_upload_chunk_size = crypto_key.upload_chunk_size
+    if not crypto_key.capabilities():
+        chunk_sizes = [crypto_key.chunk_size]
+    chunk_sizes = list(chunk_sizes or [crypto_key.chunk_size])
+    version, _ = crypto_key.info()
+    # the first call clears any counters from before the benchmark; the second returns at least its own entry if the
+    # firmware profiles commands
+    crypto_key.device_profile(reset=True)
+    profiling = bool(crypto_key.device_profile(reset=True))
+
+    results = []
+    try:
+        for chunk_size in chunk_sizes:
+            if chunk_size != crypto_key.chunk_size:
+                chunk_size = crypto_key.set_chunk_size(chunk_size)
+            crypto_key.upload_chunk_size = chunk_size
+            for op in operations:
+                for size in sizes if op in SIZED_OPERATIONS else [None]:
+                    data = os.urandom(size or 32)
+                    fn = _operation(crypto_key, op, data)
+                    reset_profile = (lambda: crypto_key.device_profile(reset=True)) if profiling else None
+                    times = _time(fn, warmup, repeat, max_seconds, reset_profile)
+                    result = {"operation": op, "size": size, "chunk_size": chunk_size} | _statistics(times, size)
+                    if profiling:
+                        result["device"] = _device_split(crypto_key.device_profile(reset=True), len(times))
+                    results.append(result)
+                    if progress:
+                        progress(_describe(result))
+    finally:
+        if crypto_key.chunk_size != original_chunk_size:
+            crypto_key.set_chunk_size(original_chunk_size)
+        crypto_key.upload_chunk_size = original_upload_chunk_size
+
+    return {
+        "version": RESULTS_VERSION,
+        "timestamp": datetime.now(tz=UTC).isoformat(),
+        "board": version,
+        "emulated": not isinstance(crypto_key.device, usb.core.Device),
+        "capabilities": crypto_key.capabilities(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "pico_crypto_key": __version__},
+        "settings": {
+            "warmup": warmup,
+            "repeat": repeat,
+            "max_seconds": max_seconds,
+            "pipeline_depth": crypto_key.pipeline_depth,
+        },
+        "results": results,
+    }
+
+
+def _describe(result: dict[str, Any]) -> str:
+    size = f" {format_size(result['size'])}B" if result["size"] else ""
+    bitrate = f" {result['bitrate_kbps']:.1f}kbps" if "bitrate_kbps" in result else ""
+    device = ""
+    if split := result.get("device"):
+        device = (
+            f" device {split['total_s']:.4f}s: compute {split['compute_s']:.4f}s"
+            f" usb {split['usb_read_s'] + split['usb_write_s']:.4f}s"
+        )
+    return (
+        f"{result['operation']}{size} (chunk {result['chunk_size']}): p50 {result['p50_s']:.4f}s"
+        f" p90 {result['p90_s']:.4f}s{bitrate}{device} ({result['runs']} runs)"
+    )
+
+
+def save(results: dict[str, Any], path: str | Path) -> None:
+    """Writes results as JSON"""
+    with open(path, "w") as fd:
+        json.dump(results, fd, indent=2)
+
+
+def load(path: str | Path) -> dict[str, Any]:
+    """Reads results written by save"""
+    with open(path) as fd:
+        results = json.load(fd)
+    if results.get("version") != RESULTS_VERSION:
+        raise ValueError(f"{path} is not a version {RESULTS_VERSION} benchmark result file")
+    return results
+
+
+def _key(result: dict[str, Any]) -> tuple[str, int | None, int]:
+    return result["operation"], result["size"], result["chunk_size"]
+
+
+def compare(baseline: dict[str, Any], current: dict[str, Any], threshold: float = 0.1) -> list[dict[str, Any]]:
+    """
+    Compares the median times of the results measured in both runs
+
+    Parameters
+    ----------
+    baseline: dict[str, Any]
+        The reference results
+    current: dict[str, Any]
+        The results to check
+    threshold: float
+        The fractional increase in median time considered a regression
+
+    Returns
+    -------
+    list[dict[str, Any]]
+        For each result in both: the operation, size, chunk_size, both median times, the change (as a fraction of the
+        baseline time) and whether it's a regression
+    """
+    reference = {_key(result): result for result in baseline["results"]}
+    comparison = []
+    for result in current["results"]:
+        if (base := reference.get(_key(result))) is None:
+            continue
+        change = result["p50_s"] / base["p50_s"] - 1
+        comparison.append(
+            {
+                "operation": result["operation"],
+                "size": result["size"],
+                "chunk_size": result["chunk_size"],
+                "baseline_s": base["p50_s"],
+                "current_s": result["p50_s"],
+                "change": change,
+                "regression": change > threshold,
+            }
+        )
+    return comparison
+
+
+def markdown_table(
+    runs: Sequence[dict[str, Any]],
+    size: int,
+    operations: Iterable[str] = DEFAULT_OPERATIONS,
+    labels: Sequence[str] | None = None,
+) -> str:
+    """
+    Formats results as a markdown table in the style of the README: median time and bitrate for each operation on the
+    given payload size, for each run, with the speedup relative to the first
+
+    Parameters
+    ----------
+    runs: Sequence[dict[str, Any]]
+        The results, e.g. one per board. All must include results for the size (at their first chunk size)
+    size: int
+        The payload size in bytes
+    operations: Iterable[str]
+        The operations (rows)
+    labels: Sequence[str] | None
+        The name of each run, defaults to the board it was measured on
+    """
+    labels = labels or [run["board"] for run in runs]
+    header = [""]
+    for i, label in enumerate(labels):
+        header += [f"{label}<br/>time(s)", "<br/>bitrate(kbps)"] + (["<br/>speedup(%)"] if i else [])
+    rows = []
+    for op in operations:
+        row = [op]
+        base_time = None
+        for run in runs:
+            result = _find(run, op, size if op in SIZED_OPERATIONS else None)
+            time_s = result["p50_s"]
+            bitrate = f"{result['bitrate_kbps']:.1f}" if "bitrate_kbps" in result else ""
+            row += [f"{time_s:.1f}" if time_s >= 0.1 else f"{time_s:.3f}", bitrate]
+            if base_time is None:
+                base_time = time_s
+            else:
+                row.append(f"{(base_time / time_s - 1) * 100:.1f}")
+        rows.append(row)
+    widths = [max(len(line[i]) for line in [header, *rows]) for i in range(len(header))]
+    widths[0] = max(widths[0], 7)
+    lines = [
+        "| "
+        + " | ".join(cell.ljust(widths[0]) if i == 0 else cell.rjust(widths[i]) for i, cell in enumerate(line))
+        + " |"
+        for line in [header, *rows]
+    ]
+    lines.insert(1, "|:" + "|".join("-" * (w + 1) + ("" if i == 0 else ":") for i, w in enumerate(widths)) + "|")
+    return "\n".join(lines)
+
+
+def _find(run: dict[str, Any], op: str, size: int | None) -> dict[str, Any]:
+    matches = [result for result in run["results"] if result["operation"] == op and result["size"] == size]
+    if not matches:
+        raise ValueError(f"no {op} result for size {size} on {run['board']}")
+    return matches[0]
+
+
+def update_readme(path: str | Path, name: str, table: str) -> None:
+    """
+    Replaces the content between <!-- benchmark:name --> and <!-- /benchmark:name --> markers in a markdown file
+    """
+    path = Path(path)
+    text = path.read_text()
+    pattern = re.compile(rf"(<!-- benchmark:{re.escape(name)} -->\n).*?(<!-- /benchmark:{re.escape(name)} -->)", re.S)
+    if not pattern.search(text):
+        raise ValueError(f"no benchmark:{name} markers in {path}")
+    path.write_text(pattern.sub(lambda m: m[1] + table + "\n" + m[2], text))
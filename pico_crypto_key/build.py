@@ -3,11 +3,13 @@ import shutil
 import subprocess
 import tomllib
 from pathlib import Path
+from typing import Any
 
 import pytest
 import typer
+import usb.core
 
-from pico_crypto_key import __version__
+from pico_crypto_key import CryptoKey, __version__, benchmark, settings
 
 app = typer.Typer()
 
@@ -174,11 +176,128 @@ def reset_pin(
 def test(
     ctx: typer.Context,
     pin: str | None = typer.Option(default=None, help="pin (optional, can use env var PICO_CRYPTO_KEY_PIN)"),  # noqa: UP007
+    emulate: bool = typer.Option(False, "--emulate", help="Run against an emulated device (no hardware required)"),
 ) -> None:  # noqa: UP007
     """Run unit tests. PIN must either be passed as an option or set in PICO_CRYPTO_KEY_PIN env var"""
-    assert pin or os.getenv("PICO_CRYPTO_KEY_PIN"), (
+    if emulate:
+        os.environ["PICO_CRYPTO_KEY_EMULATE"] = "1"
+    assert pin or emulate or os.getenv("PICO_CRYPTO_KEY_PIN"), (
         "Tests require pin to be specified as option (--pin ...) or PICO_CRYPTO_KEY_PIN in env"
     )
     if pin:
         os.environ["PICO_CRYPTO_KEY_PIN"] = pin
     assert pytest.main(ctx.args) == 0, "tests failed, see logs"
+
+
+@app.command()
+def tune(
+    save: bool = typer.Option(True, help="Save the settings for future sessions with this board/firmware"),
+    emulate: bool = typer.Option(False, "--emulate", help="Tune an emulated device (no hardware required)"),
+) -> None:
+    """Find and apply the fastest transfer chunk sizes for the connected device."""
+    device = _emulated_device() if emulate else None
+
+    with CryptoKey(device) as crypto_key:
+        print(f"Device: {crypto_key.info()[0]}")
+        print(f"Capabilities: {crypto_key.capabilities() or 'chunk size negotiation not supported by firmware'}")
+        tuning = crypto_key.tune(save=save)
+    for name, value in tuning.items():
+        print(f"{name}: {value}")
+    if save:
+        print(f"Saved to {settings.config_dir() / 'tuning.json'}")
+
+
+benchmark_app = typer.Typer(help="Benchmark a device, and compare results.")
+app.add_typer(benchmark_app, name="benchmark")
+
+
+def _emulated_device(**kwargs: Any) -> Any:
+    try:
+        from pico_crypto_key.emulator import EmulatedDevice
+    except ImportError as e:
+        print(f"The emulator requires the emulator extra ({e}), install it with: pip install pico-crypto-key[emulator]")
+        raise typer.Exit(1) from e
+
+    os.environ.setdefault("PICO_CRYPTO_KEY_PIN", "pico")
+    return EmulatedDevice(**kwargs)
+
+
+def _device_attached() -> bool:
+    try:
+        return usb.core.find(idVendor=CryptoKey.VENDOR_ID, idProduct=CryptoKey.PRODUCT_ID) is not None
+    except usb.core.NoBackendError:
+        return False
+
+
+@benchmark_app.command("run")
+def benchmark_run(
+    ops: str = typer.Option(",".join(benchmark.DEFAULT_OPERATIONS), help="operations (comma-separated)"),
+    sizes: str = typer.Option("1,1K,100K,1000K", help="payload sizes (comma-separated), e.g. 1K,100M"),
+    chunk_sizes: str | None = typer.Option(None, help="transfer chunk sizes (comma-separated), default current"),  # noqa: UP007
+    warmup: int = typer.Option(1, help="untimed runs of each operation"),
+    repeat: int = typer.Option(5, help="timed runs of each operation"),
+    max_seconds: float = typer.Option(60.0, help="stop repeating an operation after this long"),
+    pipeline_depth: int = typer.Option(1, help="chunks in flight when encrypting/decrypting"),
+    output: str | None = typer.Option(None, help="results file, default benchmark-<board>.json"),  # noqa: UP007
+    emulate: bool = typer.Option(False, "--emulate", help="Benchmark an emulated device (no hardware required)"),
+    latency_ms: float = typer.Option(0.0, help="emulated per-transfer latency"),
+    bitrate_kbps: float | None = typer.Option(None, help="emulated link bitrate"),  # noqa: UP007
+) -> None:
+    """Time operations over a range of payload and chunk sizes, saving the results as JSON."""
+    device = None
+    if not emulate and not _device_attached():
+        print("No device found, using the emulator")
+        emulate = True
+    if emulate:
+        device = _emulated_device(latency_ms=latency_ms, bitrate_kbps=bitrate_kbps)
+
+    with CryptoKey(device, pipeline_depth=pipeline_depth) as crypto_key:
+        print(f"Device: {crypto_key.info()[0]}")
+        results = benchmark.run(
+            crypto_key,
+            ops.split(","),
+            [benchmark.parse_size(size) for size in sizes.split(",")],
+            [benchmark.parse_size(size) for size in chunk_sizes.split(",")] if chunk_sizes else None,
+            warmup=warmup,
+            repeat=repeat,
+            max_seconds=max_seconds,
+            progress=print,
+        )
+    output = output or f"benchmark-{results['board']}.json"
+    benchmark.save(results, output)
+    print(f"Saved to {output}")
+
+
+@benchmark_app.command("compare")
+def benchmark_compare(
+    baseline: str = typer.Argument(..., help="the reference results file"),
+    current: list[str] = typer.Argument(..., help="the results file(s) to check"),  # noqa: B008
+    threshold: float = typer.Option(0.1, help="fractional increase in median time that counts as a regression"),
+    readme: str | None = typer.Option(None, help="regenerate the table between benchmark markers in this file"),  # noqa: UP007
+    table: str = typer.Option("boards", help="the name of the README table"),
+    size: str = typer.Option("1000K", help="the payload size for the README table"),
+    labels: str | None = typer.Option(None, help="column labels (comma-separated), default the boards"),  # noqa: UP007
+) -> None:
+    """Compare results against a baseline, failing if any operation has slowed down."""
+    reference = benchmark.load(baseline)
+    runs = [benchmark.load(path) for path in current]
+    regressions = 0
+    for path, run in zip(current, runs, strict=True):
+        print(f"{path} ({run['board']}) vs {baseline} ({reference['board']}):")
+        for row in benchmark.compare(reference, run, threshold):
+            size_label = f" {benchmark.format_size(row['size'])}B" if row["size"] else ""
+            flag = "  REGRESSION" if row["regression"] else ""
+            print(
+                f"  {row['operation']}{size_label} (chunk {row['chunk_size']}): "
+                f"{row['baseline_s']:.4f}s -> {row['current_s']:.4f}s ({row['change']:+.1%}){flag}"
+            )
+            regressions += row["regression"]
+    if readme:
+        markdown = benchmark.markdown_table(
+            [reference, *runs], benchmark.parse_size(size), labels=labels.split(",") if labels else None
+        )
+        benchmark.update_readme(readme, table, markdown)
+        print(f"Updated {table} table in {readme}")
+    if regressions:
+        print(f"{regressions} regression(s) found")
+        raise typer.Exit(1)
@@ -0,0 +1,111 @@
+import contextlib
+import json
+import os
+import signal
+from pathlib import Path
+from time import perf_counter
+from typing import Any
+
+import typer
+
+from pico_crypto_key import CryptoKey, CryptoKeyAuthenticationError, directory, metrics
+from pico_crypto_key.daemon import CryptoKeyServer, socket_path
+
+app = typer.Typer()
+
+
+def _device(emulate: bool) -> Any:
+    if not emulate:
+        return None
+    from pico_crypto_key.emulator import EmulatedDevice
+
+    os.environ.setdefault("PICO_CRYPTO_KEY_PIN", "pico")
+    return EmulatedDevice()
+
+
+def _interrupt(*_: Any) -> None:
+    raise KeyboardInterrupt
+
+
+@app.callback()
+def main() -> None:
+    """Use a crypto key from the command line."""
+
+
+@app.command()
+def serve(
+    socket: str | None = typer.Option(None, help="the socket path (default $PICO_CRYPTO_KEY_SOCKET or per-user)"),  # noqa: UP007
+    emulate: bool = typer.Option(False, "--emulate", help="Serve an emulated device (no hardware required)"),
+    metrics_port: int | None = typer.Option(None, help="serve OpenMetrics (Prometheus) on this local port"),  # noqa: UP007
+) -> None:
+    """Unlock the key once and share it with local processes (see CryptoKeyClient) until interrupted."""
+    path = Path(socket) if socket else socket_path()
+    with CryptoKey(_device(emulate)) as crypto_key:
+        print(f"Device: {crypto_key.info()[0]}")
+        # identifies the device in the metrics
+        crypto_key.device_id()
+        exporter = metrics.serve(crypto_key.openmetrics, metrics_port) if metrics_port is not None else None
+        if exporter:
+            print(f"Metrics on http://127.0.0.1:{exporter.server_address[1]}/metrics")
+        with CryptoKeyServer(crypto_key, path) as server:
+            signal.signal(signal.SIGTERM, _interrupt)
+            print(f"Listening on {path}")
+            with contextlib.suppress(KeyboardInterrupt):
+                server.serve_forever()
+            print(f"Served {server.requests} requests")
+        if exporter:
+            exporter.shutdown()
+
+
+def _manifest_path(tree: str, manifest: str | None) -> Path:
+    # by default, alongside (not in) the tree
+    root = Path(tree).resolve()
+    return Path(manifest) if manifest else root.with_name(root.name + ".manifest.json")
+
+
+@app.command("sign-dir")
+def sign_dir(
+    tree: str = typer.Argument(..., help="the directory to sign"),
+    manifest: str | None = typer.Option(None, help="the manifest to write (default <tree>.manifest.json)"),  # noqa: UP007
+    workers: int | None = typer.Option(None, help="hashing threads (default one per CPU)"),  # noqa: UP007
+    index: bool = typer.Option(True, help="skip hashing files unchanged since the last run"),
+    emulate: bool = typer.Option(False, "--emulate", help="Use an emulated device (no hardware required)"),
+) -> None:
+    """Sign every file in a directory tree, as one manifest of their hashes."""
+    path = _manifest_path(tree, manifest)
+    start = perf_counter()
+    hash_index = directory.HashIndex(tree, persist=index)
+    with CryptoKey(_device(emulate)) as crypto_key:
+        signed = directory.sign_tree(crypto_key, tree, hash_index, workers, exclude=[path])
+    path.write_text(json.dumps(signed, indent=2))
+    print(
+        f"Signed {len(signed['files'])} files ({hash_index.misses} hashed, {hash_index.hits} unchanged) "
+        f"in {perf_counter() - start:.2f}s"
+    )
+    print(f"Manifest written to {path}")
+
+
+@app.command("verify-dir")
+def verify_dir(
+    tree: str = typer.Argument(..., help="the directory to verify"),
+    manifest: str | None = typer.Option(None, help="the signed manifest (default <tree>.manifest.json)"),  # noqa: UP007
+    workers: int | None = typer.Option(None, help="hashing threads (default one per CPU)"),  # noqa: UP007
+    emulate: bool = typer.Option(False, "--emulate", help="Use an emulated device (no hardware required)"),
+) -> None:
+    """Check a directory tree against a signed manifest. Exits with status 1 if it doesn't match."""
+    path = _manifest_path(tree, manifest)
+    signed = json.loads(path.read_text())
+    with CryptoKey(_device(emulate)) as crypto_key:
+        try:
+            differences = directory.verify_tree(signed, tree, crypto_key.verify, workers, exclude=[path])
+        except CryptoKeyAuthenticationError as e:
+            print(e)
+            raise typer.Exit(1) from e
+        signer = "this device" if crypto_key.pubkey().hex() == signed["pubkey"] else f"key {signed['pubkey']}"
+    print(f"Manifest signed by {signer}")
+    for kind, paths in differences.items():
+        for file in paths:
+            print(f"{kind}: {file}")
+    if any(differences.values()):
+        raise typer.Exit(1)
+    print(f"All {len(signed['files'])} files match")
@@ -0,0 +1,351 @@
+"""
+Key-sharing daemon.
+
+Unlocking a key (USB discovery, the PIN check and key derivation on the device) costs far more than most commands, and
+every process using the key needs the PIN. The daemon (picokey serve) unlocks the key once and serves its operations
+to any number of local client processes over a Unix domain socket, running one request at a time on the device.
+
+Messages in both directions are a 4-byte big-endian length followed by a JSON object. Bytes are sent as
+{"bytes": <base64>} and datetimes as {"datetime": <ISO 8601>}. The socket is only accessible to the user running the
+daemon.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import socket
+import socketserver
+import threading
+from base64 import b64decode, b64encode
+from collections.abc import Iterable, Iterator
+from datetime import datetime
+from pathlib import Path
+from struct import pack, unpack
+from types import TracebackType
+from typing import Any, BinaryIO, Literal
+
+from pico_crypto_key.device import (
+    Buffer,
+    CipherMode,
+    CryptoKey,
+    CryptoKeyAuthenticationError,
+    CryptoKeyCommunicationError,
+    CryptoKeyConnectionError,
+    _digest,
+    _sha256,
+)
+
+# the CryptoKey methods a client can call
+METHODS = (
+    "hash",
+    "sign",
+    "sign_digest",
+    "sign_many",
+    "verify",
+    "encrypt",
+    "decrypt",
+    "pubkey",
+    "register",
+    "auth",
+    "info",
+    "device_id",
+    "capabilities",
+    "keypair_cache_stats",
+    "device_profile",
+    "stats",
+)
+
+# errors re-raised as the same type by the client
+_ERRORS: dict[str, type[Exception]] = {
+    e.__name__: e
+    for e in (
+        CryptoKeyAuthenticationError,
+        CryptoKeyCommunicationError,
+        CryptoKeyConnectionError,
+        ValueError,
+        TypeError,
+        IndexError,
+    )
+}
+
+
+def socket_path() -> Path:
+    """The default socket: $PICO_CRYPTO_KEY_SOCKET if set, otherwise in the user's runtime (or temp) directory"""
+    if override := os.getenv("PICO_CRYPTO_KEY_SOCKET"):
+        return Path(override)
+    if runtime_dir := os.getenv("XDG_RUNTIME_DIR"):
+        return Path(runtime_dir) / "pico-crypto-key.sock"
+    return Path(f"/tmp/pico-crypto-key-{os.getuid()}.sock")  # noqa: S108
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, bytes | bytearray | memoryview):
+        return {"bytes": b64encode(value).decode()}
+    if isinstance(value, datetime):
+        return {"datetime": value.isoformat()}
+    if isinstance(value, list | tuple):
+        return [_encode(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _encode(v) for k, v in value.items()}
+    return value
+
+
+def _decode(value: Any) -> Any:
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if isinstance(value, dict):
+        if "bytes" in value:
+            return b64decode(value["bytes"])
+        if "datetime" in value:
+            return datetime.fromisoformat(value["datetime"])
+        return {k: _decode(v) for k, v in value.items()}
+    return value
+
+
+def _send(sock: socket.socket, message: dict[str, Any]) -> None:
+    body = json.dumps(_encode(message)).encode()
+    sock.sendall(pack(">I", len(body)) + body)
+
+
+def _recv_exactly(sock: socket.socket, length: int) -> bytes | None:
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(min(length - len(data), 1 << 20))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def _recv(sock: socket.socket) -> dict[str, Any] | None:
+    """Receives a message, or None if the connection has been closed"""
+    header = _recv_exactly(sock, 4)
+    if header is None:
+        return None
+    body = _recv_exactly(sock, unpack(">I", header)[0])
+    if body is None:
+        return None
+    return _decode(json.loads(body))
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    server: CryptoKeyServer
+
+    def handle(self) -> None:
+        while (request := _recv(self.request)) is not None:
+            _send(self.request, self.server.call(request.get("method"), request.get("args", [])))
+
+
+class CryptoKeyServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves a key's operations over a Unix domain socket. Each client connection is handled by its own thread, and
+    requests run on the device one at a time
+    """
+
+    daemon_threads = True
+
+    def __init__(self, crypto_key: CryptoKey, path: str | Path | None = None) -> None:
+        """
+        Parameters
+        ----------
+        crypto_key: CryptoKey
+            The (initialised) key to serve
+        path: str | Path | None
+            The socket path, defaults to socket_path()
+        """
+        self.crypto_key = crypto_key
+        self.path = Path(path or socket_path())
+        self._lock = threading.Lock()
+        self.requests = 0
+        if self.path.is_socket():
+            # remove a stale socket, but not one in use by another server
+            try:
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(str(self.path))
+                raise OSError(f"{self.path} is in use by another server")
+            except ConnectionRefusedError:
+                self.path.unlink()
+        # create the socket with owner-only access
+        umask = os.umask(0o177)
+        try:
+            super().__init__(str(self.path), _Handler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.path.unlink(missing_ok=True)
+
+    def call(self, method: Any, args: list[Any]) -> dict[str, Any]:
+        """Runs a CryptoKey method, returning the result or error as a message"""
+        if method not in METHODS:
+            return {"error": ["ValueError", f"unknown method {method!r}"]}
+        # data must be sent, not the name of a file for the daemon to read
+        if method in ("hash", "sign", "sign_many") and args:
+            data = args[0] if method == "sign_many" else [args[0]]
+            if not isinstance(data, list) or not all(isinstance(item, bytes) for item in data):
+                return {"error": ["TypeError", f"{method} data must be bytes"]}
+        try:
+            with self._lock:
+                self.requests += 1
+                result = getattr(self.crypto_key, method)(*args)
+                # consume generators while the device is locked
+                if method == "sign_many":
+                    result = list(result)
+            return {"result": result}
+        except Exception as e:
+            return {"error": [type(e).__name__, str(e)]}
+
+
+class CryptoKeyClient:
+    """
+    Uses a key shared by a daemon (picokey serve), with the same interface as CryptoKey. Files are read by the client,
+    so the daemon doesn't need access to them
+    """
+
+    def __init__(self, path: str | Path | None = None) -> None:
+        """
+        Create client object for use in context manager.
+        Connects to the daemon at path, or socket_path() by default.
+        """
+        self.path = Path(path or socket_path())
+        self._socket: socket.socket | None = None
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> CryptoKeyClient:
+        """Connects to the daemon."""
+        self.connect()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        exc_stack: TracebackType | None,
+    ) -> None:
+        """Disconnects from the daemon (the key stays unlocked)."""
+        self.close()
+
+    def connect(self) -> None:
+        """
+        Connects to the daemon
+        Normally this is handled by the context manager
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(str(self.path))
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            sock.close()
+            raise CryptoKeyConnectionError(f"no daemon listening on {self.path}") from e
+        self._socket = sock
+
+    def close(self) -> None:
+        """
+        Disconnects from the daemon
+        Normally this is handled by the context manager
+        """
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+
+    def hash(self, data: str | Path | BinaryIO | Buffer, length: int | None = None) -> bytes:
+        """Computes the SHA256 hash of a file or data on the device, see CryptoKey.hash"""
+        return self._call("hash", _read_data(data, length))
+
+    def sign(
+        self,
+        data: str | Path | BinaryIO | Buffer,
+        length: int | None = None,
+        prehash: Literal["device", "host"] = "device",
+    ) -> tuple[bytes, bytes]:
+        """Computes the hash of a file or data and its ECDSA signature, see CryptoKey.sign"""
+        if prehash == "host":
+            digest = _sha256(data, length)
+            return digest, self.sign_digest(digest)
+        digest, sig = self._call("sign", _read_data(data, length), None, prehash)
+        return digest, sig
+
+    def sign_digest(self, digest: Buffer) -> bytes:
+        """Computes the ECDSA signature of a SHA256 hash computed elsewhere, see CryptoKey.sign_digest"""
+        return self._call("sign_digest", bytes(digest))
+
+    def sign_many(
+        self, items: Iterable[str | Path | BinaryIO | Buffer], prehashed: bool = False
+    ) -> Iterator[tuple[bytes, bytes]]:
+        """Signs a batch of files or data (or digests), see CryptoKey.sign_many. Items are sent in one request"""
+        items = [_digest(item) for item in items] if prehashed else [_read_data(item, None) for item in items]
+        return ((digest, sig) for digest, sig in self._call("sign_many", items, prehashed))
+
+    def verify(self, digest: bytes, sig: bytes, pubkey: bytes) -> int:
+        """Checks an ECDSA signature, see CryptoKey.verify"""
+        return self._call("verify", digest, sig, pubkey)
+
+    def encrypt(self, data: bytes, mode: CipherMode = "cfb8") -> bytes:
+        """Encrypts data using AES256, see CryptoKey.encrypt"""
+        return self._call("encrypt", data, mode)
+
+    def decrypt(self, data: bytes, mode: CipherMode = "cfb8") -> bytes:
+        """Decrypts data using AES256, see CryptoKey.decrypt"""
+        return self._call("decrypt", data, mode)
+
+    def pubkey(self) -> bytes:
+        """Returns the ECDSA public key, see CryptoKey.pubkey"""
+        return self._call("pubkey")
+
+    def register(self, relying_party: str, user: str) -> bytes:
+        """Returns the webauthn public key for the relying party and user, see CryptoKey.register"""
+        return self._call("register", relying_party, user)
+
+    def auth(self, relying_party: str, user: str, challenge: bytes) -> bytes:
+        """Signs a webauthn challenge, see CryptoKey.auth"""
+        return self._call("auth", relying_party, user, challenge)
+
+    def info(self) -> tuple[str, datetime]:
+        """Returns the firmware version and device time, see CryptoKey.info"""
+        version, timestamp = self._call("info")
+        return version, timestamp
+
+    def device_id(self) -> bytes | None:
+        """Returns the device identifier, see CryptoKey.device_id"""
+        return self._call("device_id")
+
+    def capabilities(self) -> dict[str, int]:
+        """Returns the device's transfer capabilities, see CryptoKey.capabilities"""
+        return self._call("capabilities")
+
+    def keypair_cache_stats(self) -> dict[str, int]:
+        """Returns the device's keypair cache statistics, see CryptoKey.keypair_cache_stats"""
+        return self._call("keypair_cache_stats")
+
+    def device_profile(self, reset: bool = False) -> dict[str, dict[str, int]]:
+        """Returns the device's profiling counters, see CryptoKey.device_profile"""
+        return self._call("device_profile", reset)
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """Returns the daemon's per-operation statistics for the key (all clients), see CryptoKey.stats"""
+        return self._call("stats")
+
+    def _call(self, method: str, *args: Any) -> Any:
+        if self._socket is None:
+            raise CryptoKeyConnectionError("not connected to the daemon")
+        # one request in flight per connection
+        with self._lock:
+            _send(self._socket, {"method": method, "args": list(args)})
+            response = _recv(self._socket)
+        if response is None:
+            raise CryptoKeyConnectionError("daemon closed the connection")
+        if "error" in response:
+            name, message = response["error"]
+            raise _ERRORS.get(name, RuntimeError)(message)
+        return response["result"]
+
+
+def _read_data(data: str | Path | BinaryIO | Buffer, length: int | None) -> bytes:
+    """Reads data to send to the daemon: the contents of a file, or the data itself"""
+    if isinstance(data, str | Path):
+        with open(data, "rb") as fd:
+            return fd.read(-1 if length is None else length)
+    if isinstance(data, Buffer):
+        return bytes(data)[:length]
+    return data.read(-1 if length is None else length)
@@ -1,17 +1,43 @@
 from __future__ import annotations
 
+import array
+import atexit
+import hashlib
+import inspect
+import mmap
 import os
+import threading
+import traceback
+import zlib
 from base64 import b64encode
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
 from datetime import UTC, datetime
+from functools import wraps
 from pathlib import Path
-from struct import pack, unpack
+from struct import calcsize, iter_unpack, pack, unpack
+from time import perf_counter
 from types import TracebackType
-from typing import Any
+from typing import TYPE_CHECKING, Any, BinaryIO, Literal, TypeVar, cast
 
 import usb.core
 import usb.util
 from pwinput import pwinput
 
+from pico_crypto_key import settings
+from pico_crypto_key.metrics import Metrics, Sample, openmetrics
+
+if TYPE_CHECKING:
+    from pico_crypto_key.batch import Batch
+    from pico_crypto_key.merkle import Manifest
+
+# objects supporting the buffer protocol (collections.abc.Buffer requires python 3.12)
+Buffer = bytes | bytearray | memoryview | array.array | mmap.mmap
+
+CipherMode = Literal["cfb8", "ctr", "gcm"]
+
+F = TypeVar("F", bound=Callable[..., Any])
+
 
 class CryptoKeyConnectionError(ConnectionError):
     pass
@@ -25,22 +51,263 @@ class CryptoKeyPinError(ConnectionRefusedError):
     pass
 
 
+class CryptoKeyAuthenticationError(ValueError):
+    pass
+
+
 def _read_pin_from_stdin() -> str:
     return pwinput("PIN:")
 
 
+@contextmanager
+def _open(file: str | Path | BinaryIO, mode: str) -> Iterator[BinaryIO]:
+    """Opens a path, or passes through an already open (binary) file object"""
+    if isinstance(file, str | Path):
+        with open(file, mode) as fd:
+            yield fd
+    else:
+        yield file
+
+
+def _remaining_length(fd: BinaryIO) -> int:
+    """Number of bytes from the current position to the end of a seekable stream"""
+    try:
+        pos = fd.tell()
+        end = fd.seek(0, os.SEEK_END)
+        fd.seek(pos)
+    except (AttributeError, OSError) as e:
+        raise ValueError("length must be specified for streams that are not seekable") from e
+    return end - pos
+
+
+def _buffer_reader(data: Buffer) -> Callable[[int], memoryview]:
+    """Returns successive (zero-copy) slices of a buffer"""
+    view = memoryview(data).cast("B")
+    pos = 0
+
+    def read(length: int) -> memoryview:
+        nonlocal pos
+        chunk = view[pos : pos + length]
+        pos += length
+        return chunk
+
+    return read
+
+
+def _output_view(output: Buffer, length: int) -> memoryview:
+    """Checks the output is writable and large enough"""
+    view = memoryview(output).cast("B")
+    if view.readonly or len(view) < length:
+        raise ValueError(f"output must be a writable buffer of at least {length} bytes")
+    return view
+
+
+def _digest(item: object) -> bytes:
+    """Checks the item is a SHA256 digest"""
+    if not isinstance(item, Buffer) or memoryview(item).nbytes != CryptoKey.HASH_BYTES:
+        raise ValueError(f"digests must be {CryptoKey.HASH_BYTES} bytes, got {item!r}")
+    return bytes(item)
+
+
+def _sha256(data: str | Path | BinaryIO | Buffer, length: int | None) -> bytes:
+    """Computes the SHA256 hash of a file or data on the host"""
+    if isinstance(data, str | Path):
+        with open(data, "rb") as fd:
+            return hashlib.file_digest(fd, "sha256").digest()
+    if isinstance(data, Buffer):
+        return hashlib.sha256(data).digest()
+    if length is None:
+        return hashlib.file_digest(data, "sha256").digest()
+    h = hashlib.sha256()
+    read = _file_reader(data, 2**20)
+    for pos in range(0, length, 2**20):
+        h.update(CryptoKey._read_input(read, pos, min(length - pos, 2**20), length))
+    return h.digest()
+
+
+def _file_reader(fd: BinaryIO, chunk_size: int) -> Callable[[int], Buffer]:
+    """Reads successive chunks of a file into a single preallocated buffer (if the file object supports it)"""
+    if not hasattr(fd, "readinto"):
+        return fd.read
+    buffer = memoryview(bytearray(chunk_size))
+
+    def read(length: int) -> memoryview:
+        return buffer[: fd.readinto(buffer[:length]) or 0]
+
+    return read
+
+
+def _instrumented(fn: F) -> F:
+    """
+    Records the transfers and latency of each call of a CryptoKey operation, unless called from another one. Writes left
+    buffered by an operation that raises are discarded
+    """
+    name = fn.__name__
+
+    if inspect.isgeneratorfunction(fn):
+
+        @wraps(fn)
+        def generator(self: CryptoKey, *args: Any, **kwargs: Any) -> Iterator[Any]:
+            with self._discarding_on_error():
+                if self.metrics is None or self._sample is not None:
+                    return (yield from fn(self, *args, **kwargs))
+                sample = Sample(name)
+                steps = fn(self, *args, **kwargs)
+                # only the time spent producing each item counts, not the time the consumer spends with it
+                try:
+                    while True:
+                        with self._recording(sample):
+                            try:
+                                item = next(steps)
+                            except StopIteration as stop:
+                                return stop.value
+                        yield item
+                except GeneratorExit:
+                    raise
+                except BaseException as e:
+                    sample.error = type(e).__name__
+                    raise
+                finally:
+                    try:
+                        # completes an abandoned batch
+                        with self._recording(sample):
+                            steps.close()
+                    finally:
+                        self.metrics.record(sample)
+
+        return cast(F, generator)
+
+    @wraps(fn)
+    def wrapper(self: CryptoKey, *args: Any, **kwargs: Any) -> Any:
+        with self._discarding_on_error():
+            if self.metrics is None or self._sample is not None:
+                return fn(self, *args, **kwargs)
+            sample = Sample(name)
+            try:
+                with self._recording(sample):
+                    return fn(self, *args, **kwargs)
+            except BaseException as e:
+                sample.error = type(e).__name__
+                raise
+            finally:
+                self.metrics.record(sample)
+
+    return cast(F, wrapper)
+
+
+# public keys are deterministic for a given device, so are cached for the lifetime of the process, keyed by device id
+_key_cache: dict[bytes, dict[str, bytes]] = {}
+
+# unlocked devices kept open between context managers (see idle_timeout), keyed by the device passed to CryptoKey (None
+# for the first key on the bus), with the timer that closes each one when it expires
+_sessions: dict[Any, tuple[CryptoKey, threading.Timer]] = {}
+_sessions_lock = threading.Lock()
+
+
 class CryptoKey:
-    CHUNK_SIZE = 2048
+    VENDOR_ID = 0xAAFE
+    PRODUCT_ID = 0xC0FF
+    CHUNK_SIZE = 2048  # default, firmware may support others
+    DEVICE_BUFFER_BYTES = 4096  # CFG_TUD_CDC_RX_BUFSIZE + CFG_TUD_CDC_TX_BUFSIZE (default)
+    # writes smaller than this are buffered, and sent along with whatever follows them (up to a chunk of data)
+    COALESCE_BYTES = 64
+    INVALID_CMD = 2
     HASH_BYTES = 32
+    END_OF_ITEMS = 2**32 - 1  # terminates the items in hash_many
+    MERKLE_CHUNK_SIZE = 4 * 2**20  # default for sign_large
+    SIGNED_RESULT_BYTES = 108  # max of hash[32], len(sig)[4], DER-encoded sig[72]
     ECDSA_PUBKEY_BYTES = 33  # short form with 02/03 prefix
     VERIFY_FAILED = 2**32 - 19968  # -0x480 MBEDTLS_ERR_ECP_VERIFY_FAILED
+    # ciphertexts in ctr and gcm modes start with a header: magic, format version, mode and nonce (gcm also appends a
+    # tag). cfb8 ciphertexts have no header
+    CIPHER_MAGIC = b"PCK"
+    CIPHER_VERSION = 1
+    CIPHER_MODES = {"ctr": 1, "gcm": 2}
+    NONCE_BYTES = 12
+    HEADER_BYTES = 5 + NONCE_BYTES
+    TAG_BYTES = 16
+    # firmware commands, by the names used in device profiles
+    COMMANDS = {
+        "k": "pubkey",
+        "h": "hash",
+        "H": "hash_many",
+        "e": "encrypt",
+        "d": "decrypt",
+        "t": "crypt_ctr",
+        "E": "encrypt_gcm",
+        "D": "decrypt_gcm",
+        "s": "sign",
+        "g": "sign_digest",
+        "m": "sign_many",
+        "v": "verify",
+        "r": "register",
+        "a": "auth",
+        "p": "set_pin",
+        "c": "capabilities",
+        "z": "set_chunk_size",
+        "l": "keypair_cache_stats",
+        "u": "device_id",
+        "i": "info",
+        "f": "device_profile",
+        "F": "device_profile",
+        "q": "protocol_version",
+        "T": "frame",
+    }
+    # device profile record: cmd, calls, total_us, usb_read_us, usb_write_us, compute_us, bytes_in, bytes_out
+    PROFILE_RECORD = "<2I6Q"
+    # tagged frames (see batch): b"T", version, opcode, status, request id, payload length, then the payload and a crc32
+    FRAME_VERSION = 1
+    FRAME_HEADER = "<cBBBHI"
+    FRAME_MAX_PAYLOAD = 8192
+    FRAME_ERRORS = {2: "invalid command", 3: "bad checksum", 4: "bad frame"}
 
     reattach: bool
 
-    def __init__(self) -> None:
-        """Create device object for use in context manager."""
+    def __init__(
+        self,
+        device: Any = None,
+        pipeline_depth: int = 1,
+        key_cache: Literal["memory", "disk"] | None = "memory",
+        idle_timeout: float | None = None,
+        metrics: bool = True,
+    ) -> None:
+        """
+        Create device object for use in context manager.
+        Optionally pass a specific device, e.g. an emulated one. By default the first key found on the bus is used.
+        If pipeline_depth is greater than 1, encryption/decryption keeps up to that many chunks in flight (limited by
+        the device's buffer sizes) so that upload and download overlap.
+        Public keys (from pubkey and register) are cached per device in memory, and optionally also on disk so they
+        persist across processes. Pass key_cache=None to always query the device.
+        If idle_timeout is given, leaving the context manager keeps the device unlocked for that many seconds, and
+        the next CryptoKey for the same device (with an idle_timeout) reuses the session rather than unlocking it
+        again, once it has checked the device still responds. Use close() to disconnect regardless.
+        Each operation's transfers and latency are recorded (see stats) unless metrics is False.
+        """
+        if pipeline_depth < 1:
+            raise ValueError("pipeline_depth must be at least 1")
+        if idle_timeout is not None and idle_timeout <= 0:
+            raise ValueError("idle_timeout must be positive")
+        self.idle_timeout = idle_timeout
+        if key_cache not in ("memory", "disk", None):
+            raise ValueError(f"key_cache must be 'memory', 'disk' or None, not {key_cache!r}")
+        self.key_cache = key_cache
+        self._device_id: bytes | None = None
         self.have_repl = False  # tracks whether repl entered (i.e. pin was correct)
+        self._device = device
+        self.pipeline_depth = pipeline_depth
+        # chunk size for encryption/decryption, which must match the device's
+        self.chunk_size = self.CHUNK_SIZE
+        # chunk size for uploads (hash/sign), which the device does not need to know
+        self.upload_chunk_size = self.CHUNK_SIZE
+        self._capabilities: dict[str, int] | None = None
+        self._protocol_version: int | None = None
+        # written but not yet sent (see _write)
+        self._write_buffer = bytearray()
+        self._allocate_buffers()
         self.device: Any = None
+        self.metrics = Metrics() if metrics else None
+        # the operation in progress, if it's being recorded
+        self._sample: Sample | None = None
 
     def __enter__(self) -> CryptoKey:
         """Initialised the device's repl."""
@@ -53,12 +320,18 @@ class CryptoKey:
         exc_value: BaseException | None,
         _exc_stack: TracebackType | None,
     ) -> None:
-        """Disconnect from the device's repl."""
-        self.reset()
+        """Disconnect from the device's repl, or keep it open for reuse if idle_timeout was given."""
         if exc_type:
             print(f"{exc_type.__name__}: {exc_value}")
+        # a communication error or interrupted command may have left the device mid-command
+        reusable = exc_type is None or (
+            issubclass(exc_type, Exception) and not issubclass(exc_type, usb.core.USBError | OSError)
+        )
+        if self.idle_timeout is not None and reusable and self._park():
+            return
+        self.reset()
 
-        usb.util.dispose_resources(self.device)
+        self._dispose_resources()
         # It may raise USBError if there's e.g. no kernel driver loaded at all
         try:
             if self.reattach:
@@ -66,34 +339,109 @@ class CryptoKey:
         except usb.core.USBError:
             pass
 
-    def hash(self, filename: str | Path) -> bytes:
+    @_instrumented
+    def hash(self, data: str | Path | BinaryIO | Buffer, length: int | None = None) -> bytes:
         """
-        Computes the SHA256 hash of a file
+        Computes the SHA256 hash of a file or data
 
         Parameters
         ----------
-        filename: str
-            The name of the file
+        data: str | Path | BinaryIO | Buffer
+            The name of a file, a binary file object opened for reading, or the data itself (e.g. bytes, memoryview)
+        length: int | None
+            For file objects, the number of bytes to hash. Defaults to the remainder of the file, which must then be
+            seekable
 
         Returns
         -------
         bytes
             The hash digest
         """
-        assert self.have_repl
-        self._write(b"h")
-        file_length = os.stat(filename).st_size
-        self._write_uint32(file_length)
-        with open(filename, "rb") as fd:
-            write_remaining = file_length
-            while write_remaining > 0:
-                write_chunk_length = min(write_remaining, self.CHUNK_SIZE)
-                data = fd.read(write_chunk_length)
-                ret = self._write(data)
-                write_remaining -= ret
+        self._upload(b"h", data, length)
         return self._read(CryptoKey.HASH_BYTES)
 
-    def encrypt(self, data: bytes) -> bytes:
+    @_instrumented
+    def hash_many(self, items: Iterable[str | Path | BinaryIO | Buffer]) -> Iterator[bytes]:
+        """
+        Computes the SHA256 hashes of many files or data in a single command, yielding the digests in order. Small items
+        are packed together into transfers of up to upload_chunk_size, so the per-item overhead is much lower than
+        calling hash() in a loop. Items are taken from the iterable as they are sent, and digests are read once as many
+        are waiting as fit in the device's transmit buffer, so memory use is bounded however many items there are.
+        Falls back to hash() on firmware without batch support
+
+        Parameters
+        ----------
+        items: Iterable[str | Path | BinaryIO | Buffer]
+            The items to hash, as for hash() (file objects are hashed to the end)
+
+        Yields
+        ------
+        bytes
+            The hash digest of each item, in order
+        """
+        if not self.capabilities():
+            for item in items:
+                yield self.hash(item)
+            return
+
+        window = max(1, self.capabilities()["tx_bufsize"] // CryptoKey.HASH_BYTES)
+        # items packed into the next transfer, starting with the command
+        pending = bytearray(b"H")
+        packed = written = received = 0
+        # whether an item is partly sent
+        streaming = False
+
+        def flush() -> list[bytes]:
+            """Writes the packed items, first reading the waiting digests if the device may not have room for theirs"""
+            nonlocal packed, written, received
+            digests = []
+            if written - received + packed > window:
+                digests = self._read_digests(written - received)
+                received = written
+            if pending:
+                self._write(pending)
+                pending.clear()
+            written += packed
+            packed = 0
+            return digests
+
+        try:
+            for item in items:
+                with self._source(item, None) as (length, read):
+                    if length >= CryptoKey.END_OF_ITEMS:
+                        raise ValueError("data must be smaller than 4GiB")
+                    if len(pending) + 4 + length > self.upload_chunk_size:
+                        yield from flush()
+                    if 4 + length <= self.upload_chunk_size:
+                        pending += pack("I", length) + self._read_input(read, 0, length, length)
+                        packed += 1
+                    else:
+                        # too large to pack: sent in chunks after its length
+                        pending += pack("I", length)
+                        packed += 1
+                        digests = flush()
+                        streaming = True
+                        for pos in range(0, length, self.upload_chunk_size):
+                            self._write(self._read_input(read, pos, min(length - pos, self.upload_chunk_size), length))
+                        streaming = False
+                        yield from digests
+                if packed == window:
+                    yield from flush()
+            pending += pack("I", CryptoKey.END_OF_ITEMS)
+            yield from flush()
+            yield from self._read_digests(written - received)
+        except (GeneratorExit, OSError, ValueError) as e:
+            if streaming or isinstance(e, usb.core.USBError | ConnectionError):
+                raise
+            # abandoned, or an item couldn't be read before it was sent: end the command (discarding the remaining
+            # digests) so that the device is ready for the next one
+            pending += pack("I", CryptoKey.END_OF_ITEMS)
+            flush()
+            self._read_digests(written - received)
+            raise
+
+    @_instrumented
+    def encrypt(self, data: bytes, mode: CipherMode = "cfb8") -> bytes:
         """
         Encrypts data using AES256
 
@@ -101,28 +449,22 @@ class CryptoKey:
         ----------
         data: bytes
             Some binary data
+        mode: CipherMode
+            The cipher mode. "cfb8" (the default, for compatibility) has no header and a fixed IV, so equal plaintexts
+            give equal ciphertexts. "ctr" is much faster and uses a random nonce (stored in a header). "gcm" is as
+            fast as "ctr" and also appends an authentication tag, so that modified ciphertexts fail to decrypt
 
         Returns
         -------
         bytes
             The encrpted data
         """
-        assert self.have_repl
-        self._write(b"e")
-
-        length = len(data)
-        self._write_uint32(length)
-
-        output = bytearray()
-        for pos in range(0, length, self.CHUNK_SIZE):
-            chunk_length = min(length - pos, self.CHUNK_SIZE)
-            # write a chunk
-            bytes_written = self._write(data[pos : pos + chunk_length])
-            chunk = self._read(bytes_written)
-            output += chunk
+        output = bytearray(len(data) + self.ciphertext_overhead(mode))
+        self.encrypt_into(data, output, mode)
         return bytes(output)
 
-    def decrypt(self, data: bytes) -> bytes:
+    @_instrumented
+    def decrypt(self, data: bytes, mode: CipherMode = "cfb8") -> bytes:
         """
         Decrypts data using AES256
 
@@ -130,58 +472,317 @@ class CryptoKey:
         ----------
         data: bytes
             Some encrypted binary data
+        mode: CipherMode
+            The cipher mode the data was encrypted with
 
         Returns
         -------
         bytes
-            The decrypted data (if the device is the same as the encrypting device, random bytes otherwise)
+            The decrypted data (if the device is the same as the encrypting device, random bytes otherwise, or an error
+            in gcm mode)
         """
-        assert self.have_repl
-        self._write(b"d")
+        output = bytearray(max(0, len(data) - self.ciphertext_overhead(mode)))
+        self.decrypt_into(data, output, mode)
+        return bytes(output)
 
-        length = len(data)
-        self._write_uint32(length)
+    @_instrumented
+    def encrypt_into(self, data: Buffer, output: Buffer, mode: CipherMode = "cfb8") -> int:
+        """
+        Encrypts data using AES256 into a preallocated buffer, without intermediate copies
 
-        output = bytearray()
-        for pos in range(0, length, self.CHUNK_SIZE):
-            chunk_length = min(length - pos, self.CHUNK_SIZE)
-            # write a chunk
-            bytes_written = self._write(data[pos : pos + chunk_length])
-            chunk = self._read(bytes_written)
-            output += chunk
-        return bytes(output)
+        Parameters
+        ----------
+        data: Buffer
+            Some binary data, e.g. bytes, memoryview or mmap
+        output: Buffer
+            A writable buffer at least as large as data plus ciphertext_overhead(mode), e.g. a bytearray or mmap
+        mode: CipherMode
+            The cipher mode, see encrypt
 
-    def sign(self, filename: str | Path) -> tuple[bytes, bytes]:
+        Returns
+        -------
+        int
+            The number of bytes written to output
         """
-        Computes the hash of a file and its and ECDSA signature
+        cmd, header = self._encrypt_header(mode)
+        length = memoryview(data).nbytes
+        view = _output_view(output, length + self.ciphertext_overhead(mode))
+        view[: len(header)] = header
+        self._crypt(cmd, length, _buffer_reader(data), view[len(header) :])
+        if mode == "gcm":
+            view[len(header) + length : len(header) + length + CryptoKey.TAG_BYTES] = self._read(CryptoKey.TAG_BYTES)
+        return length + self.ciphertext_overhead(mode)
+
+    @_instrumented
+    def decrypt_into(self, data: Buffer, output: Buffer, mode: CipherMode = "cfb8") -> int:
+        """
+        Decrypts data using AES256 into a preallocated buffer, without intermediate copies
+
+        Parameters
+        ----------
+        data: Buffer
+            Some encrypted binary data, e.g. bytes, memoryview or mmap
+        output: Buffer
+            A writable buffer at least as large as data less ciphertext_overhead(mode), e.g. a bytearray or mmap
+        mode: CipherMode
+            The cipher mode the data was encrypted with. In gcm mode output is zeroed if authentication fails
+
+        Returns
+        -------
+        int
+            The number of bytes written to output
+        """
+        ciphertext = memoryview(data).cast("B")
+        length = len(ciphertext) - self.ciphertext_overhead(mode)
+        if length < 0:
+            raise ValueError(f"input is too short to be a {mode} ciphertext")
+        header_bytes = CryptoKey.HEADER_BYTES if mode != "cfb8" else 0
+        cmd = self._decrypt_command(mode, ciphertext[:header_bytes])
+        view = _output_view(output, length)
+        self._crypt(cmd, length, _buffer_reader(ciphertext[header_bytes:]), view)
+        if mode == "gcm" and not self._check_tag(ciphertext[header_bytes + length :]):
+            view[:length] = bytes(length)
+            raise CryptoKeyAuthenticationError("ciphertext failed authentication")
+        return length
+
+    @_instrumented
+    def encrypt_stream(
+        self,
+        src: str | Path | BinaryIO,
+        dst: str | Path | BinaryIO,
+        length: int | None = None,
+        mode: CipherMode = "cfb8",
+    ) -> int:
+        """
+        Encrypts a file or stream using AES256, writing each chunk to the destination as it is received so that
+        memory use is independent of the data size. The output is identical in format to encrypt.
 
         Parameters
         ----------
-        filename: str
-            The name of the file
+        src: str | Path | BinaryIO
+            The name of the input file, or a binary file object opened for reading
+        dst: str | Path | BinaryIO
+            The name of the output file, or a binary file object opened for writing
+        length: int | None
+            The number of bytes to encrypt. Defaults to the remainder of src, which must then be seekable
+        mode: CipherMode
+            The cipher mode, see encrypt
+
+        Returns
+        -------
+        int
+            The number of bytes encrypted
+        """
+        cmd, header = self._encrypt_header(mode)
+        with _open(src, "rb") as fd_in, _open(dst, "wb") as fd_out:
+            if length is None:
+                length = _remaining_length(fd_in)
+            fd_out.write(header)
+            self._crypt(cmd, length, _file_reader(fd_in, self.chunk_size), fd_out.write)
+            if mode == "gcm":
+                fd_out.write(self._read(CryptoKey.TAG_BYTES))
+        return length
+
+    @_instrumented
+    def decrypt_stream(
+        self,
+        src: str | Path | BinaryIO,
+        dst: str | Path | BinaryIO,
+        length: int | None = None,
+        mode: CipherMode = "cfb8",
+    ) -> int:
+        """
+        Decrypts a file or stream using AES256, writing each chunk to the destination as it is received so that
+        memory use is independent of the data size. The output is identical to decrypt.
+
+        Parameters
+        ----------
+        src: str | Path | BinaryIO
+            The name of the encrypted file, or a binary file object opened for reading
+        dst: str | Path | BinaryIO
+            The name of the output file, or a binary file object opened for writing
+        length: int | None
+            The number of bytes of src to decrypt (including any header). Defaults to the remainder of src, which must
+            then be seekable
+        mode: CipherMode
+            The cipher mode the data was encrypted with. In gcm mode, the output must be discarded if authentication
+            fails (CryptoKeyAuthenticationError), since it is only checked at the end
+
+        Returns
+        -------
+        int
+            The number of bytes decrypted
+        """
+        with _open(src, "rb") as fd_in, _open(dst, "wb") as fd_out:
+            if length is None:
+                length = _remaining_length(fd_in)
+            length -= self.ciphertext_overhead(mode)
+            if length < 0:
+                raise ValueError(f"input is too short to be a {mode} ciphertext")
+            read = _file_reader(fd_in, self.chunk_size)
+            header_bytes = CryptoKey.HEADER_BYTES if mode != "cfb8" else 0
+            cmd = self._decrypt_command(mode, bytes(self._read_input(read, 0, header_bytes, header_bytes)))
+            self._crypt(cmd, length, read, fd_out.write)
+            if mode == "gcm":
+                tag = self._read_input(read, 0, CryptoKey.TAG_BYTES, CryptoKey.TAG_BYTES)
+                if not self._check_tag(tag):
+                    raise CryptoKeyAuthenticationError("ciphertext failed authentication")
+        return length
+
+    @staticmethod
+    def ciphertext_overhead(mode: CipherMode) -> int:
+        """The number of bytes the ciphertext header (and tag) add in the given mode"""
+        match mode:
+            case "cfb8":
+                return 0
+            case "ctr":
+                return CryptoKey.HEADER_BYTES
+            case "gcm":
+                return CryptoKey.HEADER_BYTES + CryptoKey.TAG_BYTES
+        raise ValueError(f"mode must be one of 'cfb8', 'ctr', 'gcm', not {mode!r}")
+
+    @_instrumented
+    def sign(
+        self,
+        data: str | Path | BinaryIO | Buffer,
+        length: int | None = None,
+        prehash: Literal["device", "host"] = "device",
+    ) -> tuple[bytes, bytes]:
+        """
+        Computes the hash of a file or data and its ECDSA signature
+
+        Parameters
+        ----------
+        data: str | Path | BinaryIO | Buffer
+            The name of a file, a binary file object opened for reading, or the data itself (e.g. bytes, memoryview)
+        length: int | None
+            For file objects, the number of bytes to sign. Defaults to the remainder of the file, which must then be
+            seekable
+        prehash: Literal["device", "host"]
+            Where the hash is computed. "host" avoids uploading the data, which is much faster for large inputs. The
+            signature is the same either way
 
         Returns
         -------
         tuple[bytes, bytes]
             The hash digest and the signature
         """
-        assert self.have_repl
-        self._write(b"s")
-        file_length = os.stat(filename).st_size
-        self._write_uint32(file_length)
-        with open(filename, "rb") as fd:
-            write_remaining = file_length
-            while write_remaining > 0:
-                write_chunk_length = min(write_remaining, self.CHUNK_SIZE)
-                data = fd.read(write_chunk_length)
-                ret = self._write(data)
-                write_remaining -= ret
+        if prehash == "host":
+            digest = _sha256(data, length)
+            return digest, self.sign_digest(digest)
+        if prehash != "device":
+            raise ValueError(f"prehash must be 'device' or 'host', not {prehash!r}")
+        self._upload(b"s", data, length)
         # somehow separates hash and sig even when length not specified
         digest = self._read(CryptoKey.HASH_BYTES)
         siglen = self._read_uint32()
         sig = self._read(siglen)
         return digest, sig
 
+    @_instrumented
+    def sign_digest(self, digest: Buffer) -> bytes:
+        """
+        Computes the ECDSA signature of a SHA256 hash computed elsewhere
+
+        Parameters
+        ----------
+        digest: Buffer
+            The SHA256 hash of the data to sign (32 bytes)
+
+        Returns
+        -------
+        bytes
+            The signature
+        """
+        digest = _digest(digest)
+        if not self.capabilities():
+            raise CryptoKeyCommunicationError("firmware does not support signing digests")
+        self._write(b"g" + digest)
+        siglen = self._read_uint32()
+        return self._read(siglen)
+
+    @_instrumented
+    def sign_many(
+        self, items: Iterable[str | Path | BinaryIO | Buffer], prehashed: bool = False
+    ) -> Iterator[tuple[bytes, bytes]]:
+        """
+        Signs a batch of files or data (or digests) in a single command, yielding results as the device produces them.
+        Items are sent ahead of the results being read (as far as the device's transmit buffer allows), so the per-item
+        overhead is much lower than calling sign() in a loop. Falls back to sign() on firmware without batch support
+
+        Parameters
+        ----------
+        items: Iterable[str | Path | BinaryIO | Buffer]
+            The items to sign, as for sign() (file objects are signed to the end), or SHA256 digests if prehashed
+        prehashed: bool
+            The items are 32-byte SHA256 digests, which are signed directly
+
+        Yields
+        ------
+        tuple[bytes, bytes]
+            The hash digest and the signature of each item, in order
+        """
+        items = [_digest(item) for item in items] if prehashed else list(items)
+        if not self.capabilities():
+            for item in items:
+                yield (item, self.sign_digest(item)) if prehashed else self.sign(item)
+            return
+
+        # limit unread results to what fits in the device's transmit buffer, otherwise device and host block each other
+        window = max(1, self.capabilities()["tx_bufsize"] // CryptoKey.SIGNED_RESULT_BYTES)
+        self._write(b"m")
+        self._write_uint32(len(items))
+        sent = received = 0
+        try:
+            for item in items:
+                if prehashed:
+                    self._write(b"d" + item)
+                else:
+                    self._upload(b"h", item, None)
+                sent += 1
+                if sent - received == window:
+                    received += 1
+                    yield self._read_signed()
+            while received < sent:
+                received += 1
+                yield self._read_signed()
+        except (GeneratorExit, OSError, ValueError) as e:
+            if isinstance(e, usb.core.USBError | ConnectionError):
+                raise
+            # batch abandoned, or an item couldn't be opened before it was sent: complete it with dummy digests so
+            # the device is ready for the next command
+            for _ in range(sent, len(items)):
+                self._write(b"d" + bytes(CryptoKey.HASH_BYTES))
+            for _ in range(received, len(items)):
+                self._read_signed()
+            raise
+
+    @_instrumented
+    def sign_large(self, path: str | Path, chunk_size: int = MERKLE_CHUNK_SIZE, workers: int | None = None) -> Manifest:
+        """
+        Signs a large file without uploading it: the file's chunks are hashed in parallel on the host, and the device
+        signs the root of a Merkle tree of the chunk hashes. See merkle for the tree and the manifest format, and
+        merkle.ChunkVerifier to check a file (one chunk at a time) against the manifest
+
+        Parameters
+        ----------
+        path: str | Path
+            The file to sign
+        chunk_size: int
+            The size of the chunks hashed, and verifiable, individually
+        workers: int | None
+            The number of hashing threads, None for one per CPU
+
+        Returns
+        -------
+        Manifest
+            The chunk hashes, their root and its signature, and the public key
+        """
+        from pico_crypto_key.merkle import sign_large
+
+        return sign_large(self, path, chunk_size, workers)
+
+    @_instrumented
     def verify(self, digest: bytes, sig: bytes, pubkey: bytes) -> int:
         """
         Checks the ECDSA signature given a hash and the ECDSA public key of the signer
@@ -213,6 +814,7 @@ class CryptoKey:
         self._write(pubkey)
         return self._read_uint32()
 
+    @_instrumented
     def pubkey(self) -> bytes:
         """
         Computes the hash of a file and its and ECDSA signature
@@ -226,22 +828,113 @@ class CryptoKey:
             The long-form ECDSA public key
         """
         assert self.have_repl
-        self._write(b"k")
-        pubkey = self._read(CryptoKey.ECDSA_PUBKEY_BYTES)
-        return pubkey
+        return self._cached_key("pubkey", lambda: self._query_key(b"k"))
 
+    @_instrumented
     def register(self, relying_party: str, user: str) -> bytes:
         """
         Returns dynamically generated ECDSA public key
         """
         assert self.have_repl
         userdata = f"{user}@{relying_party}".encode()
-        self._write(b"r")
-        self._write_uint32(len(userdata))
-        self._write(userdata)
-        pubkey = self._read(CryptoKey.ECDSA_PUBKEY_BYTES)
-        return pubkey
+        return self._cached_key(
+            f"register:{userdata.hex()}", lambda: self._query_key(b"r" + pack("I", len(userdata)) + userdata)
+        )
 
+    @_instrumented
+    def device_id(self) -> bytes | None:
+        """
+        Returns an identifier unique to the device (the SHA256 hash of its public key), or None if the firmware does
+        not support the query
+        """
+        assert self.have_repl
+        if self._device_id is None and self.capabilities():
+            self._write(b"u")
+            self._device_id = self._read(self._read_uint32())
+        return self._device_id
+
+    @_instrumented
+    def device_profile(self, reset: bool = False) -> dict[str, dict[str, int]]:
+        """
+        Returns the device's profiling counters for each command run since the session started (or the counters were
+        last reset), so that device compute time can be told apart from USB transport time. Empty if the firmware
+        does not profile commands
+
+        Parameters
+        ----------
+        reset: bool
+            Reset the counters once they have been read
+
+        Returns
+        -------
+        dict[str, dict[str, int]]
+            For each command (named as in COMMANDS): the number of calls, the total time on the device, the time blocked
+            reading from and writing to USB, the time in crypto (mbedtls/SHA256) calls, all in microseconds, and the
+            bytes received and sent by the device. With streamed input, compute (on core 1) overlaps with USB transfers
+            (on core 0)
+        """
+        if not self.capabilities():
+            return {}
+        self._write(b"F" if reset else b"f")
+        length = self._read_uint32()
+        record_bytes = calcsize(CryptoKey.PROFILE_RECORD)
+        # firmware without profiling responds with the error code
+        if length % record_bytes:
+            return {}
+        profile: dict[str, dict[str, int]] = {}
+        for cmd, *counters in iter_unpack(CryptoKey.PROFILE_RECORD, self._read(length)):
+            name = CryptoKey.COMMANDS.get(chr(cmd), chr(cmd))
+            fields = ("calls", "total_us", "usb_read_us", "usb_write_us", "compute_us", "bytes_in", "bytes_out")
+            totals = profile.setdefault(name, dict.fromkeys(fields, 0))
+            for field, value in zip(fields, counters, strict=True):
+                totals[field] += value
+        return profile
+
+    @_instrumented
+    def keypair_cache_stats(self) -> dict[str, int]:
+        """
+        Returns the hit and miss counts, size and capacity of the device's cache of derived (register/auth) keypairs,
+        since it was last cleared (on reset or PIN change). Empty if the firmware does not have the cache
+        """
+        if not self.capabilities():
+            return {}
+        self._write(b"l")
+        hits, misses, size, capacity = unpack("4I", self._read(self._read_uint32()))
+        return {"hits": hits, "misses": misses, "size": size, "capacity": capacity}
+
+    def clear_key_cache(self) -> None:
+        """
+        Removes cached public keys for this device, from memory and disk
+        """
+        if device_id := self.device_id():
+            _key_cache.pop(device_id, None)
+            saved = settings.load("keys")
+            if saved.pop(device_id.hex(), None) is not None:
+                settings.save("keys", saved)
+
+    def _query_key(self, request: bytes) -> bytes:
+        self._write(request)
+        return self._read(CryptoKey.ECDSA_PUBKEY_BYTES)
+
+    def _cached_key(self, name: str, query: Callable[[], bytes]) -> bytes:
+        """Looks up a public key for this device in the cache, querying the device if not present"""
+        device_id = self.device_id() if self.key_cache else None
+        # can't tell devices apart on older firmware
+        if device_id is None:
+            return query()
+        keys = _key_cache.setdefault(device_id, {})
+        if name not in keys:
+            saved = settings.load("keys") if self.key_cache == "disk" else {}
+            if name in saved.get(device_id.hex(), {}):
+                keys[name] = bytes.fromhex(saved[device_id.hex()][name])
+            else:
+                keys[name] = query()
+                if self.key_cache == "disk":
+                    saved.setdefault(device_id.hex(), {})[name] = keys[name].hex()
+                    settings.save("keys", saved)
+        return keys[name]
+
+    @_instrumented
     def auth(self, relying_party: str, user: str, challenge: bytes) -> bytes:
         """
         Time-limited authentication
@@ -259,6 +952,7 @@ class CryptoKey:
         sig = self._read(length)
         return b64encode(sig)
 
+    @_instrumented
     def info(self) -> tuple[str, datetime]:
         """
         Returns board information: board type, firmware version, timestamp
@@ -266,7 +960,10 @@ class CryptoKey:
         assert self.have_repl
         self._write(b"i")
         length = self._read_uint32()
-        raw = self._read(length)
+        return self._parse_info(self._read(length))
+
+    @staticmethod
+    def _parse_info(raw: bytes) -> tuple[str, datetime]:
         version = raw[:-8].decode()
         timestamp = datetime.fromtimestamp(unpack("Q", raw[-8:])[0] / 1000, tz=UTC)
         return version, timestamp
@@ -290,7 +987,8 @@ class CryptoKey:
         self.reset()
         self.init()
         new_pin = pwinput("NEW PIN:")
-        if not 4 <= len(new_pin) <= 64:
+        pin = new_pin.encode("utf-8")
+        if not 4 <= len(pin) <= 64:
             print("pin must be between 4 and 64 bytes")
             return
         check = pwinput("CONFIRM:")
@@ -298,11 +996,11 @@ class CryptoKey:
             print("doesn't match")
             return
         self._write(b"p")
-        self._write_uint32(len(new_pin))
-        self._write(new_pin)
+        self._write_uint32(len(pin))
+        self._write(pin)
         result = self._read_uint32()
         if result:
-            print("pin change failed: {result}")
+            print(f"pin change failed: {result}")
             return
         print("resetting device and reauthenticating")
         self.reset()
@@ -316,21 +1014,47 @@ class CryptoKey:
         """
         # only send reset request if we have repl
         if self.have_repl:
+            # anything unsent is the start of a command that failed
+            self._write_buffer.clear()
             self.__endpoint_in.write(b"x")
             self.have_repl = False
 
-        usb.util.dispose_resources(self.device)
+        self._dispose_resources()
 
         # It may raise USBError if there's e.g. no kernel driver loaded at all
         if self.reattach:
+            self.reattach = False
             self.device.attach_kernel_driver(0)
 
+    def close(self) -> None:
+        """
+        Resets the device, even if idle_timeout was given, and closes any idle session for it
+        """
+        self._close_idle(self._device)
+        if self.device is not None:
+            self.reset()
+
+    @staticmethod
+    def close_sessions() -> None:
+        """
+        Resets all devices kept open by CryptoKeys with an idle_timeout. This happens automatically at exit
+        """
+        for device in list(_sessions):
+            CryptoKey._close_idle(device)
+
     def init(self) -> None:
         """
-        Initialises the device with the supplied pin
+        Initialises the device with the supplied pin, or reuses an idle session if idle_timeout was given
         Normally this is handled by the context manager
         """
-        self.device = usb.core.find(idVendor=0xAAFE, idProduct=0xC0FF)
+        if self.idle_timeout is not None and self._resume():
+            return
+        # an idle session would otherwise interpret the PIN as commands
+        self._close_idle(self._device)
+        if self._device is not None:
+            self.device = self._device
+        else:
+            self.device = usb.core.find(idVendor=self.VENDOR_ID, idProduct=self.PRODUCT_ID)
 
         if not self.device:
             raise CryptoKeyConnectionError()
@@ -364,18 +1088,520 @@ class CryptoKey:
 
         self.have_repl = True
 
+        # the device starts each session with the default chunk size
+        self.chunk_size = self.upload_chunk_size = self.CHUNK_SIZE
+        self._capabilities = None
+        self._protocol_version = None
+        self._device_id = None
+        self._allocate_buffers()
+        # apply any saved tuning for this board/firmware
+        if tuning := settings.load("tuning"):
+            self._apply_tuning(tuning.get(self.info()[0], {}))
+
+    @_instrumented
+    def capabilities(self) -> dict[str, int]:
+        """
+        Returns the device's transfer capabilities: the current and maximum chunk sizes and the USB receive and
+        transmit buffer sizes. Empty if the firmware does not support chunk size negotiation
+        """
+        assert self.have_repl
+        if self._capabilities is None:
+            self._write(b"c")
+            length = self._read_uint32()
+            # older firmware responds with the error code
+            if length == CryptoKey.INVALID_CMD:
+                self._capabilities = {}
+            else:
+                chunk_size, max_chunk_size, rx_bufsize, tx_bufsize = unpack("4I", self._read(length))
+                self._capabilities = {
+                    "chunk_size": chunk_size,
+                    "max_chunk_size": max_chunk_size,
+                    "rx_bufsize": rx_bufsize,
+                    "tx_bufsize": tx_bufsize,
+                }
+        return self._capabilities
+
+    @_instrumented
+    def protocol_version(self) -> int:
+        """
+        Returns the version of the tagged frame protocol (see batch) used with the device, 0 if the firmware only
+        supports untagged commands
+        """
+        assert self.have_repl
+        if self._protocol_version is None:
+            self._protocol_version = 0
+            if self.capabilities():
+                self._write(b"q")
+                length = self._read_uint32()
+                # firmware without frames responds with the error code
+                if length != CryptoKey.INVALID_CMD and CryptoKey.FRAME_VERSION in unpack(
+                    f"{length // 4}I", self._read(length)
+                ):
+                    self._protocol_version = CryptoKey.FRAME_VERSION
+        return self._protocol_version
+
+    def batch(self) -> Batch:
+        """
+        Returns a batch, in which small commands (pubkey, info, verify, auth etc.) are sent back-to-back, each in a
+        tagged frame, without waiting for earlier replies. Replies are matched to requests by id as they arrive.
+        Falls back to running each command as it is queued if the firmware does not support frames. The key must not
+        be used for anything else until the batch is complete (see Batch.wait)
+        """
+        from pico_crypto_key.batch import Batch
+
+        return Batch(self)
+
+    @_instrumented
+    def set_chunk_size(self, size: int) -> int:
+        """
+        Negotiates the chunk size used for encryption/decryption with the device
+
+        Parameters
+        ----------
+        size: int
+            The requested chunk size, which the device may clamp to its supported range
+
+        Returns
+        -------
+        int
+            The chunk size actually set
+        """
+        if not self.capabilities():
+            raise CryptoKeyCommunicationError("firmware does not support chunk size negotiation")
+        self._write(b"z")
+        self._write_uint32(size)
+        self.chunk_size = self._read_uint32()
+        self.capabilities()["chunk_size"] = self.chunk_size
+        self._allocate_buffers()
+        return self.chunk_size
+
+    @_instrumented
+    def tune(
+        self, sizes: Iterable[int] = (512, 1024, 2048, 4096, 8192), length: int = 65536, save: bool = True
+    ) -> dict[str, int]:
+        """
+        Measures hash (upload) and encryption (round trip) times over a range of chunk sizes and applies the fastest.
+        Encryption chunk size is only tuned if the firmware supports negotiation.
+
+        Parameters
+        ----------
+        sizes: Iterable[int]
+            The chunk sizes to try
+        length: int
+            The size of the (random) test data
+        save: bool
+            Save the settings, which are then applied automatically to later sessions with the same board and firmware
+
+        Returns
+        -------
+        dict[str, int]
+            The chosen upload_chunk_size and chunk_size
+        """
+        data = os.urandom(length)
+        upload_times: dict[int, float] = {}
+        crypt_times: dict[int, float] = {}
+        for size in sizes:
+            self.upload_chunk_size = size
+            self._allocate_buffers()
+            start = perf_counter()
+            self.hash(data)
+            upload_times[size] = perf_counter() - start
+
+            if self.capabilities():
+                size = self.set_chunk_size(size)
+                start = perf_counter()
+                self.encrypt(data)
+                crypt_times[size] = perf_counter() - start
+
+        tuning = {
+            "upload_chunk_size": min(upload_times, key=upload_times.__getitem__),
+            "chunk_size": min(crypt_times, key=crypt_times.__getitem__) if crypt_times else self.CHUNK_SIZE,
+        }
+        self._apply_tuning(tuning)
+        if save:
+            saved = settings.load("tuning")
+            saved[self.info()[0]] = tuning
+            settings.save("tuning", saved)
+        return tuning
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """
+        Returns a snapshot of the statistics recorded for each operation called (empty if metrics are disabled)
+
+        Returns
+        -------
+        dict[str, dict[str, Any]]
+            For each operation: the number of calls and errors, bytes sent and received, USB writes and reads, seconds
+            spent writing and reading, total latency in seconds, and a histogram of latencies (the number of calls in
+            each of metrics.LATENCY_BUCKETS, plus one for longer calls)
+        """
+        return self.metrics.snapshot() if self.metrics else {}
+
+    def reset_stats(self) -> None:
+        """
+        Clears the recorded statistics
+        """
+        if self.metrics:
+            self.metrics.reset()
+
+    def add_hook(self, hook: Callable[[Sample], None]) -> None:
+        """
+        Registers a function to be called with the sample recorded at the end of each operation. Hooks run on the
+        calling thread, so should be quick
+
+        Parameters
+        ----------
+        hook: Callable[[Sample], None]
+            Called with the operation name, its transfers, latency and any error
+        """
+        if self.metrics is None:
+            raise ValueError("metrics are disabled")
+        self.metrics.hooks.append(hook)
+
+    def remove_hook(self, hook: Callable[[Sample], None]) -> None:
+        """
+        Unregisters a function added by add_hook
+        """
+        if self.metrics is not None and hook in self.metrics.hooks:
+            self.metrics.hooks.remove(hook)
+
+    def openmetrics(self, labels: dict[str, str] | None = None) -> str:
+        """
+        Returns the statistics in the OpenMetrics text format, for Prometheus. Doesn't communicate with the device, so
+        can be called from another thread, e.g. by metrics.serve
+
+        Parameters
+        ----------
+        labels: dict[str, str] | None
+            Labels for every sample. Defaults to the device identifier, if it has been queried
+
+        Returns
+        -------
+        str
+            The metrics
+        """
+        if labels is None:
+            labels = {"device": self._device_id.hex()} if self._device_id else {}
+        return openmetrics(self.stats(), labels)
+
+    @contextmanager
+    def _discarding_on_error(self) -> Iterator[None]:
+        """Discards any buffered writes (a partial command) if an operation raises, so the next one isn't corrupted"""
+        try:
+            yield
+        except BaseException:
+            self._write_buffer.clear()
+            raise
+
+    @contextmanager
+    def _recording(self, sample: Sample) -> Iterator[None]:
+        """Attributes transfers (and time) to the sample"""
+        self._sample = sample
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            sample.latency_s += perf_counter() - start
+            self._sample = None
+
+    def _apply_tuning(self, tuning: dict[str, int]) -> None:
+        self.upload_chunk_size = tuning.get("upload_chunk_size", self.CHUNK_SIZE)
+        if tuning.get("chunk_size", self.CHUNK_SIZE) != self.chunk_size:
+            self.set_chunk_size(tuning["chunk_size"])
+        self._allocate_buffers()
+
+    def _allocate_buffers(self) -> None:
+        """Preallocates transfer buffers for full chunks"""
+        self._read_buffer = array.array("B", bytes(self.chunk_size))
+        self._read_view = memoryview(self._read_buffer)
+        self._write_views = {
+            size: memoryview(array.array("B", bytes(size))) for size in {self.chunk_size, self.upload_chunk_size}
+        }
+        # room for a command's header fields and its first chunk of data
+        self._write_buffer_limit = max(self.chunk_size, self.upload_chunk_size) + self.COALESCE_BYTES
+
+    def _read_digests(self, count: int) -> list[bytes]:
+        """Reads count digests in a single transfer"""
+        data = self._read(count * CryptoKey.HASH_BYTES) if count else b""
+        return [data[pos : pos + CryptoKey.HASH_BYTES] for pos in range(0, len(data), CryptoKey.HASH_BYTES)]
+
+    def _read_signed(self) -> tuple[bytes, bytes]:
+        """Reads a digest and length-prefixed signature"""
+        digest, siglen = unpack("32sI", self._read(CryptoKey.HASH_BYTES + 4))
+        return digest, self._read(siglen)
+
+    def _upload(self, cmd: bytes, data: str | Path | BinaryIO | Buffer, length: int | None) -> None:
+        """
+        Sends a command followed by the length and content of a file or buffer. The source is opened before anything is
+        sent, so that e.g. a missing file does not leave the device mid-command
+        """
+        with self._source(data, length) as (size, read):
+            self._send(cmd, size, read)
+
+    @contextmanager
+    def _source(
+        self, data: str | Path | BinaryIO | Buffer, length: int | None
+    ) -> Iterator[tuple[int, Callable[[int], Buffer]]]:
+        """
+        Opens a file or buffer to upload, giving its length and a function that reads successive chunks of it. Files
+        are memory-mapped and read as zero-copy slices
+        """
+        if isinstance(data, str | Path):
+            with open(data, "rb") as fd:
+                size = os.fstat(fd.fileno()).st_size
+                # empty files cannot be mapped
+                if not size:
+                    yield 0, _buffer_reader(b"")
+                    return
+                with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    read = _buffer_reader(mapped)
+                    try:
+                        yield size, lambda length: read(length)
+                    except BaseException as e:
+                        # the frames of a failed upload can still refer to slices, which would stop the file being
+                        # unmapped (with a BufferError in place of e)
+                        traceback.clear_frames(e.__traceback__)
+                        raise
+                    finally:
+                        # the file can't be unmapped while the reader (or a slice) refers to it
+                        del read
+            return
+        if isinstance(data, Buffer):
+            with memoryview(data) as view:
+                yield view.nbytes, _buffer_reader(view)
+        else:
+            yield _remaining_length(data) if length is None else length, _file_reader(data, self.upload_chunk_size)
+
+    def _send(self, cmd: bytes, length: int, read: Callable[[int], Buffer]) -> None:
+        """Writes a command followed by length bytes from read, in chunks"""
+        assert self.have_repl
+        if length >= 2**32:
+            raise ValueError("data must be smaller than 4GiB")
+        self._write(cmd)
+        self._write_uint32(length)
+        for pos in range(0, length, self.upload_chunk_size):
+            self._write(self._read_input(read, pos, min(length - pos, self.upload_chunk_size), length))
+
+    def _encrypt_header(self, mode: CipherMode) -> tuple[bytes, bytes]:
+        """Returns the command (including a random nonce) and the header for the ciphertext"""
+        if not self.ciphertext_overhead(mode):
+            return b"e", b""
+        nonce = os.urandom(CryptoKey.NONCE_BYTES)
+        header = pack("3sBB", CryptoKey.CIPHER_MAGIC, CryptoKey.CIPHER_VERSION, CryptoKey.CIPHER_MODES[mode]) + nonce
+        return self._mode_command(mode, encrypt=True) + nonce, header
+
+    def _decrypt_command(self, mode: CipherMode, header: Buffer) -> bytes:
+        """Checks the ciphertext header, returns the command (including the nonce)"""
+        if not self.ciphertext_overhead(mode):
+            return b"d"
+        magic, version, mode_id, nonce = unpack(f"3sBB{CryptoKey.NONCE_BYTES}s", header)
+        if magic != CryptoKey.CIPHER_MAGIC or mode_id != CryptoKey.CIPHER_MODES[mode]:
+            raise ValueError(f"input is not a {mode} ciphertext")
+        if version != CryptoKey.CIPHER_VERSION:
+            raise ValueError(f"unsupported ciphertext format version {version}")
+        return self._mode_command(mode, encrypt=False) + nonce
+
+    def _mode_command(self, mode: CipherMode, encrypt: bool) -> bytes:
+        if not self.capabilities():
+            raise CryptoKeyCommunicationError(f"firmware does not support {mode} mode")
+        if mode == "ctr":
+            return b"t"
+        return b"E" if encrypt else b"D"
+
+    def _check_tag(self, tag: Buffer) -> bool:
+        """Sends the GCM tag once the ciphertext has been sent, returns whether it matches"""
+        self._write(bytes(tag))
+        return self._read_uint32() == 0
+
+    def _crypt(
+        self,
+        cmd: bytes,
+        length: int,
+        read: Callable[[int], Buffer],
+        output: memoryview | Callable[[memoryview], Any],
+    ) -> None:
+        """
+        Sends length bytes from read to the device in chunks. The processed chunks are either received directly into
+        the output buffer, or into a reusable buffer which is then passed to the output function
+        """
+        assert self.have_repl
+        if length >= 2**32:
+            raise ValueError("data must be smaller than 4GiB")
+        self._write(cmd)
+        self._write_uint32(length)
+
+        # the device echoes each chunk once processed, so only as many chunks as fit in its buffers can be in flight
+        buffer_bytes = (
+            self._capabilities["rx_bufsize"] + self._capabilities["tx_bufsize"]
+            if self._capabilities
+            else self.DEVICE_BUFFER_BYTES
+        )
+        depth = max(1, min(self.pipeline_depth, buffer_bytes // self.chunk_size))
+        receive = self._receiver(output)
+        if depth > 1:
+            self._crypt_pipelined(length, read, receive, depth)
+            return
+
+        for pos in range(0, length, self.chunk_size):
+            chunk_length = min(length - pos, self.chunk_size)
+            # write a chunk
+            bytes_written = self._write(self._read_input(read, pos, chunk_length, length))
+            receive(pos, bytes_written)
+
+    def _receiver(self, output: memoryview | Callable[[memoryview], Any]) -> Callable[[int, int], None]:
+        """Returns a function that receives length bytes of output at a given position"""
+        if isinstance(output, memoryview):
+            return lambda pos, length: self._read_into(output[pos : pos + length])
+
+        buffer = memoryview(bytearray(self.chunk_size))
+
+        def receive(_pos: int, length: int) -> None:
+            chunk = buffer[:length]
+            self._read_into(chunk)
+            output(chunk)
+
+        return receive
+
+    def _crypt_pipelined(
+        self, length: int, read: Callable[[int], Buffer], receive: Callable[[int, int], None], depth: int
+    ) -> None:
+        """Writes chunks whilst a background thread reads the processed chunks, with up to depth chunks in flight"""
+        in_flight = threading.Semaphore(depth)
+        errors: list[BaseException] = []
+
+        def reader() -> None:
+            try:
+                for pos in range(0, length, self.chunk_size):
+                    receive(pos, min(length - pos, self.chunk_size))
+                    in_flight.release()
+            except BaseException as e:
+                errors.append(e)
+                # unblock the writer
+                in_flight.release()
+
+        # the reader flushes the write buffer before each read, so the writer bypasses it (transferring every chunk,
+        # however short, directly)
+        self._flush()
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            for pos in range(0, length, self.chunk_size):
+                in_flight.acquire()
+                if errors:
+                    break
+                chunk_length = min(length - pos, self.chunk_size)
+                self._transfer(self._read_input(read, pos, chunk_length, length))
+        finally:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    @staticmethod
+    def _read_input(read: Callable[[int], Buffer], pos: int, chunk_length: int, length: int) -> Buffer:
+        data = read(chunk_length)
+        if len(data) != chunk_length:
+            raise CryptoKeyCommunicationError(f"input ended after {pos + len(data)} of {length} bytes")
+        return data
+
+    def _park(self) -> bool:
+        """Keeps the session open for reuse until idle_timeout expires, False if it can't be"""
+        if not self.have_repl:
+            return False
+        with _sessions_lock:
+            # another instance may have parked a session for the same device
+            if self._device in _sessions:
+                return False
+            timer = threading.Timer(self.idle_timeout or 0, CryptoKey._close_idle, (self._device,))
+            timer.daemon = True
+            _sessions[self._device] = (self, timer)
+            timer.start()
+        return True
+
+    def _resume(self) -> bool:
+        """Takes over an idle session for this device if there's one that still responds"""
+        with _sessions_lock:
+            parked, timer = _sessions.pop(self._device, (None, None))
+        if parked is None or timer is None:
+            return False
+        timer.cancel()
+        try:
+            version = parked.info()[0]
+        except (usb.core.USBError, OSError, ValueError, UnicodeDecodeError):
+            version = None
+        if not version:
+            # e.g. unplugged or reset: start afresh
+            try:
+                parked.reset()
+            except usb.core.USBError:
+                parked._dispose_resources()
+            return False
+        self.device = parked.device
+        self.__endpoint_in = parked.__endpoint_in
+        self.__endpoint_out = parked.__endpoint_out
+        self.reattach = parked.reattach
+        self.have_repl = True
+        self.chunk_size = parked.chunk_size
+        self.upload_chunk_size = parked.upload_chunk_size
+        self._capabilities = parked._capabilities
+        self._protocol_version = parked._protocol_version
+        self._device_id = parked._device_id
+        self._allocate_buffers()
+        # the parked instance no longer owns the session
+        parked.have_repl = parked.reattach = False
+        return True
+
+    @staticmethod
+    def _close_idle(device: Any) -> None:
+        # reset while holding the lock so that no new session can start on the device meanwhile
+        with _sessions_lock:
+            parked, timer = _sessions.pop(device, (None, None))
+            if parked is None or timer is None:
+                return
+            timer.cancel()
+            try:
+                parked.reset()
+            except usb.core.USBError:
+                parked._dispose_resources()
+
+    def _dispose_resources(self) -> None:
+        # only real USB devices hold resources
+        if isinstance(self.device, usb.core.Device):
+            usb.util.dispose_resources(self.device)
+
     def _set_device_time(self) -> None:
         epoch_ms = int(datetime.now().timestamp() * 1000)
         self._write_uint64(epoch_ms)
+        # the device's clock starts when the timestamp arrives
+        self._flush()
 
     def _read(self, length: int) -> bytes:
-        result = bytearray()
-        while length:
-            chunk = self.__endpoint_out.read(length).tobytes()
-            result += chunk
-            length -= len(chunk)
+        result = bytearray(length)
+        self._read_into(memoryview(result))
         return bytes(result)
 
+    def _read_into(self, view: memoryview) -> None:
+        """
+        Fills view with data from the device, once any buffered writes have been sent. Full chunks are read into a
+        preallocated array (pyusb can only read into arrays) and copied, anything smaller is read as a new array
+        """
+        self._flush()
+        pos = 0
+        length = len(view)
+        while pos < length:
+            start = perf_counter()
+            if length - pos >= len(self._read_buffer):
+                n = self.__endpoint_out.read(self._read_buffer)
+                view[pos : pos + n] = self._read_view[:n]
+            else:
+                chunk = self.__endpoint_out.read(length - pos)
+                n = len(chunk)
+                view[pos : pos + n] = chunk
+            pos += n
+            if sample := self._sample:
+                sample.read_s += perf_counter() - start
+                sample.reads += 1
+                sample.bytes_received += n
+
     def _read_uint32(self) -> int:
         """Read raw uint32_t (?-endian)"""
         data = self._read(4)
@@ -386,14 +1612,70 @@ class CryptoKey:
         data = self._read(8)
         return unpack("Q", data)[0]
 
-    def _write(self, b: bytes) -> int:
+    def _write(self, b: Buffer, flush: bool = False) -> int:
+        """
+        Writes b, returning its length. Small writes are buffered and sent in one transfer with what follows them, up to
+        and including the first chunk of a command's data, so that a command and its arguments don't each take a round
+        trip. Buffered data is sent before the next read, or immediately if flush
+        """
+        length = memoryview(b).nbytes
+        buffered = len(self._write_buffer)
+        if buffered + length <= self._write_buffer_limit and (buffered or length < self.COALESCE_BYTES):
+            self._write_buffer += b
+            if flush:
+                self._flush()
+            return length
+        self._flush()
+        if flush or length >= self.COALESCE_BYTES:
+            self._transfer(b)
+        else:
+            self._write_buffer += b
+        return length
+
+    def _flush(self) -> None:
+        """Sends any buffered writes"""
+        if self._write_buffer:
+            self._transfer(self._write_buffer)
+            self._write_buffer.clear()
+
+    def _transfer(self, b: Buffer) -> None:
+        """Writes b in a single transfer"""
+        if not isinstance(b, bytes | bytearray | array.array):
+            # pyusb converts other buffer types to an array element-by-element, so copy into a preallocated one
+            if view := self._write_views.get(len(b)):
+                view[:] = b
+                b = view.obj
+            else:
+                b = bytes(b)
+        start = perf_counter()
         bytes_written = self.__endpoint_in.write(b)
+        if sample := self._sample:
+            sample.write_s += perf_counter() - start
+            sample.writes += 1
+            sample.bytes_sent += bytes_written
         if bytes_written != len(b):
             raise CryptoKeyCommunicationError(
                 f"attempted to write {len(b)} bytes but device reports {bytes_written} received"
             )
 
-        return bytes_written
+    def _write_frame(self, opcode: bytes, request_id: int, payload: bytes) -> int:
+        """Sends a command in a tagged frame, returns the size of the frame"""
+        frame = pack(CryptoKey.FRAME_HEADER, b"T", CryptoKey.FRAME_VERSION, opcode[0], 0, request_id, len(payload))
+        frame += payload
+        frame += pack("I", zlib.crc32(frame))
+        # sent as soon as it's queued, so the device can start on it
+        return self._write(frame, flush=True)
+
+    def _read_frame(self) -> tuple[bytes, int, int, bytes]:
+        """Reads a tagged frame, returns its opcode, status, request id and payload"""
+        header = self._read(calcsize(CryptoKey.FRAME_HEADER))
+        tag, version, opcode, status, request_id, length = unpack(CryptoKey.FRAME_HEADER, header)
+        if tag != b"T" or version != CryptoKey.FRAME_VERSION:
+            raise CryptoKeyCommunicationError(f"expected a frame, got {header.hex()} (out of sync?)")
+        payload = self._read(length)
+        if zlib.crc32(payload, zlib.crc32(header)) != self._read_uint32():
+            raise CryptoKeyCommunicationError(f"checksum mismatch in reply to request {request_id}")
+        return bytes([opcode]), status, request_id, payload
 
     def _write_uint32(self, n: int) -> bool:
         """Writes an int as uint32_t (?-endian)"""
@@ -404,3 +1686,7 @@ class CryptoKey:
         """Writes an int as uint32_t (?-endian)"""
         uint64 = pack("Q", n)
         return self._write(uint64) == 8
+
+
+# don't leave devices unlocked
+atexit.register(CryptoKey.close_sessions)
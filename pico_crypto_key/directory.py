@@ -0,0 +1,238 @@
+"""
+Signing of directory trees.
+
+A tree is signed as a single manifest listing the SHA256 hash of every file, so the device makes one signature however
+many files there are. Files are hashed on the host, in parallel (hashlib releases the GIL). Hashes are kept in a
+persistent index, keyed by each file's path, size, modification time and inode, so that on later runs files that
+haven't changed since are not read again, and re-signing costs time proportional to what has changed.
+
+Files modified within RACY_NS of being hashed are not added to the index: a later change within the filesystem's
+timestamp resolution could leave the size and modification time as they were. Verification always re-hashes every
+file, since the index records what the files were, not what they should be.
+
+The manifest is JSON:
+
+    {
+      "format": "pico-crypto-key-directory",
+      "version": 1,
+      "files": {"<path relative to the tree, with / separators>": "<hex SHA256>", ...},
+      "hash": "<hex SHA256 of the body>",
+      "signature": "<hex, DER-encoded ECDSA signature of the hash>",
+      "pubkey": "<hex, the signer's public key>"
+    }
+
+where the body is the format, version and files, serialised as compact JSON with sorted keys. Only regular files are
+included; symbolic links are not followed.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import time_ns
+from typing import Any
+
+from pico_crypto_key import settings
+from pico_crypto_key.device import CryptoKey, CryptoKeyAuthenticationError
+
+FORMAT = "pico-crypto-key-directory"
+VERSION = 1
+# files modified more recently than this before being hashed aren't indexed
+RACY_NS = 2 * 10**9
+
+
+def list_files(root: str | Path, exclude: Iterable[str | Path] = ()) -> list[str]:
+    """The regular files in a tree (not following symbolic links), as sorted relative paths with / separators"""
+    root = Path(root)
+    excluded = {Path(path).resolve() for path in exclude}
+    files = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = Path(dirpath, filename)
+            if path.is_file() and not path.is_symlink() and path.resolve() not in excluded:
+                files.append(path.relative_to(root).as_posix())
+    return sorted(files)
+
+
+def _file_hash(path: Path) -> bytes:
+    with open(path, "rb") as fd:
+        return hashlib.file_digest(fd, "sha256").digest()
+
+
+class HashIndex:
+    """
+    File hashes, reused while a file's size, modification time and inode are unchanged. Persisted (per tree) in the
+    settings directory
+    """
+
+    def __init__(self, root: str | Path, persist: bool = True) -> None:
+        """
+        Parameters
+        ----------
+        root: str | Path
+            The tree whose files are indexed
+        persist: bool
+            Load the index from, and save it to, the settings directory. Otherwise it lasts as long as the object
+        """
+        self.root = Path(root).resolve()
+        self.persist = persist
+        self._name = "index-" + hashlib.sha256(str(self.root).encode()).hexdigest()[:16]
+        saved = settings.load(self._name) if persist else {}
+        # path: [size, mtime_ns, inode, hash]
+        self._entries: dict[str, list[Any]] = saved.get("files", {}) if saved.get("root") == str(self.root) else {}
+        self.hits = 0
+        self.misses = 0
+
+    def hash_files(self, paths: Iterable[str], workers: int | None = None) -> dict[str, bytes]:
+        """
+        Returns the SHA256 hashes of files in the tree, hashing (in parallel) only those not in the index or changed
+        since. The index is then updated to contain just these files, and saved
+
+        Parameters
+        ----------
+        paths: Iterable[str]
+            Relative paths of files in the tree
+        workers: int | None
+            The number of hashing threads, None for one per CPU
+
+        Returns
+        -------
+        dict[str, bytes]
+            The hash of each file
+        """
+        entries: dict[str, list[Any]] = {}
+        hashes: dict[str, bytes] = {}
+        unindexed: dict[str, os.stat_result] = {}
+        for path in paths:
+            st = (self.root / path).stat()
+            entry = self._entries.get(path)
+            if entry and entry[:3] == [st.st_size, st.st_mtime_ns, st.st_ino]:
+                hashes[path] = bytes.fromhex(entry[3])
+                entries[path] = entry
+            else:
+                unindexed[path] = st
+        self.hits += len(hashes)
+        self.misses += len(unindexed)
+
+        hashed_ns = time_ns()
+        with ThreadPoolExecutor(workers or os.cpu_count() or 1) as executor:
+            digests = executor.map(_file_hash, (self.root / path for path in unindexed))
+            for path, digest in zip(unindexed, digests, strict=True):
+                hashes[path] = digest
+                st = unindexed[path]
+                if st.st_mtime_ns < hashed_ns - RACY_NS:
+                    entries[path] = [st.st_size, st.st_mtime_ns, st.st_ino, digest.hex()]
+
+        self._entries = entries
+        if self.persist:
+            settings.save(self._name, {"root": str(self.root), "files": entries})
+        return hashes
+
+
+def _body(files: dict[str, str]) -> bytes:
+    """The signed part of a manifest"""
+    return json.dumps(
+        {"format": FORMAT, "version": VERSION, "files": files}, sort_keys=True, separators=(",", ":")
+    ).encode()
+
+
+def sign_tree(
+    crypto_key: CryptoKey,
+    root: str | Path,
+    index: HashIndex | None = None,
+    workers: int | None = None,
+    exclude: Iterable[str | Path] = (),
+) -> dict[str, Any]:
+    """
+    Hashes the files in a tree and signs a manifest of them
+
+    Parameters
+    ----------
+    crypto_key: CryptoKey
+        The signing key
+    root: str | Path
+        The tree to sign
+    index: HashIndex | None
+        Hashes of unchanged files are taken from (and new ones added to) the index. By default every file is hashed
+    workers: int | None
+        The number of hashing threads, None for one per CPU
+    exclude: Iterable[str | Path]
+        Files not to include, e.g. the manifest itself if it's written to the tree
+
+    Returns
+    -------
+    dict[str, Any]
+        The signed manifest
+    """
+    index = index or HashIndex(root, persist=False)
+    hashes = index.hash_files(list_files(root, exclude), workers)
+    files = {path: digest.hex() for path, digest in sorted(hashes.items())}
+    digest, sig = crypto_key.sign(_body(files), prehash="host")
+    return {
+        "format": FORMAT,
+        "version": VERSION,
+        "files": files,
+        "hash": digest.hex(),
+        "signature": sig.hex(),
+        "pubkey": crypto_key.pubkey().hex(),
+    }
+
+
+def verify_tree(
+    manifest: dict[str, Any],
+    root: str | Path,
+    verify: Callable[[bytes, bytes, bytes], int],
+    workers: int | None = None,
+    exclude: Iterable[str | Path] = (),
+) -> dict[str, list[str]]:
+    """
+    Checks a manifest's signature, and a tree against it. Whether the manifest's public key is that of a trusted
+    signer is up to the caller
+
+    Parameters
+    ----------
+    manifest: dict[str, Any]
+        The signed manifest
+    root: str | Path
+        The tree to check
+    verify: Callable[[bytes, bytes, bytes], int]
+        Verifies a signature, returning 0 if it's valid: CryptoKey.verify or (on the host) Verifier.verify
+    workers: int | None
+        The number of hashing threads, None for one per CPU
+    exclude: Iterable[str | Path]
+        Files not to check, e.g. the manifest itself
+
+    Returns
+    -------
+    dict[str, list[str]]
+        The files that have been changed, removed or added since the manifest was signed. The tree matches if all are
+        empty
+
+    Raises
+    ------
+    ValueError
+        If the manifest isn't in a supported format
+    CryptoKeyAuthenticationError
+        If the manifest's signature is not valid
+    """
+    if manifest.get("format") != FORMAT:
+        raise ValueError("not a directory manifest")
+    if manifest.get("version") != VERSION:
+        raise ValueError(f"unsupported manifest version {manifest.get('version')}")
+    digest = hashlib.sha256(_body(manifest["files"])).digest()
+    if digest.hex() != manifest["hash"] or verify(
+        digest, bytes.fromhex(manifest["signature"]), bytes.fromhex(manifest["pubkey"])
+    ):
+        raise CryptoKeyAuthenticationError("manifest signature is not valid")
+
+    expected: dict[str, str] = manifest["files"]
+    hashes = HashIndex(root, persist=False).hash_files(list_files(root, exclude), workers)
+    return {
+        "changed": [path for path in expected if path in hashes and hashes[path].hex() != expected[path]],
+        "removed": [path for path in expected if path not in hashes],
+        "added": [path for path in hashes if path not in expected],
+    }
@@ -0,0 +1,719 @@
+"""
+In-process emulation of the crypto key firmware.
+
+EmulatedDevice speaks the same byte protocol as the firmware's repl (src/main.cpp) and can be passed to CryptoKey in
+place of a real device, so the host driver can be tested and profiled without hardware. Results are identical to a
+device with the same board id: keys are derived in the same way, encryption is AES256-CFB8 with a zero IV and
+signatures are deterministic (RFC6979).
+
+An optional latency/bitrate model can be applied to the USB transfers to separate host overhead from transport cost.
+
+Differences from the firmware:
+- delays (e.g. after an invalid PIN) are not emulated
+- an error the firmware can't recover from (e.g. verifying with a public key mbedtls can't parse) halts the emulated
+  device, as the firmware's error loop does, but without the LED codes: it stops responding, so transfers time out
+- verifying a signature that isn't valid DER returns MBEDTLS_ERR_ECP_BAD_INPUT_DATA, without the ASN.1 error code that
+  mbedtls adds to it
+"""
+
+from __future__ import annotations
+
+import array
+import hmac
+import threading
+import zlib
+from collections import OrderedDict
+from collections.abc import Callable
+from hashlib import sha256
+from struct import pack, unpack
+from time import monotonic, perf_counter_ns, sleep
+
+import usb.core
+from ecdsa import SECP256k1, SigningKey
+from ecdsa.util import sigencode_der
+
+from pico_crypto_key import __version__
+from pico_crypto_key.verifier import parse_pubkey, verify_signature
+
+# mirror constants in the firmware
+DEFAULT_CHUNK_SIZE = 2048  # cdc::DEFAULT_CHUNK_SIZE
+MIN_CHUNK_SIZE = 64  # cdc::MIN_CHUNK_SIZE
+MAX_CHUNK_SIZE = 8192  # cdc::MAX_CHUNK_SIZE
+CDC_RX_BUFSIZE = 2048  # CFG_TUD_CDC_RX_BUFSIZE
+CDC_TX_BUFSIZE = 2048  # CFG_TUD_CDC_TX_BUFSIZE
+KEYCACHE_CAPACITY = 8  # keycache::CAPACITY
+NONCE_BYTES = 12  # aes::NONCE_BYTES
+TAG_BYTES = 16  # aes::TAG_BYTES
+END_OF_ITEMS = 0xFFFFFFFF  # sha256::END_OF_ITEMS
+AUTH_TIME_VALIDITY_MS = 60_000
+FRAME_VERSION = 1  # frame::VERSION
+FRAME_MAX_PAYLOAD = MAX_CHUNK_SIZE  # frame::MAX_PAYLOAD
+# commands that can be sent in a frame (frame::framed)
+FRAMED_COMMANDS = {b"k", b"g", b"v", b"r", b"a", b"c", b"z", b"l", b"u", b"f", b"F", b"i"}
+
+KEY_SALT = bytes([0xAA, 0xFE, 0xC0, 0xFF, 0xBA, 0xDA, 0x55, 0x55])
+PIN_SALT = bytes([0x19, 0x93, 0x76, 0x02, 0x45, 0x4A, 0xBC, 0xDE])
+
+# commands supported by all firmware versions
+LEGACY_COMMANDS = {b"x", b"p", b"k", b"h", b"d", b"e", b"s", b"v", b"r", b"a", b"i"}
+
+SUCCESS = 0
+INVALID_PIN = 1
+INVALID_CMD = 2
+BAD_CHECKSUM = 3
+BAD_FRAME = 4
+
+
+def _sbox() -> list[int]:
+    """Generates the AES S-box"""
+
+    def rotl8(x: int, shift: int) -> int:
+        return ((x << shift) | (x >> (8 - shift))) & 0xFF
+
+    sbox = [0] * 256
+    p = q = 1
+    while True:
+        # multiply p by 3
+        p = p ^ ((p << 1) & 0xFF) ^ (0x1B if p & 0x80 else 0)
+        # divide q by 3
+        q ^= q << 1
+        q ^= q << 2
+        q ^= q << 4
+        q &= 0xFF
+        if q & 0x80:
+            q ^= 0x09
+        sbox[p] = q ^ rotl8(q, 1) ^ rotl8(q, 2) ^ rotl8(q, 3) ^ rotl8(q, 4) ^ 0x63
+        if p == 1:
+            break
+    sbox[0] = 0x63
+    return sbox
+
+
+_SBOX = _sbox()
+
+
+def _tables() -> tuple[list[int], list[int], list[int], list[int]]:
+    """Generates the AES encryption T-tables"""
+
+    def xtime(x: int) -> int:
+        return ((x << 1) ^ 0x1B) & 0xFF if x & 0x80 else x << 1
+
+    te0 = [(xtime(s) << 24) | (s << 16) | (s << 8) | (xtime(s) ^ s) for s in _SBOX]
+    te1 = [((t >> 8) | (t << 24)) & 0xFFFFFFFF for t in te0]
+    te2 = [((t >> 8) | (t << 24)) & 0xFFFFFFFF for t in te1]
+    te3 = [((t >> 8) | (t << 24)) & 0xFFFFFFFF for t in te2]
+    return te0, te1, te2, te3
+
+
+_TE0, _TE1, _TE2, _TE3 = _tables()
+
+
+class AES256:
+    """
+    Minimal pure-python AES256 (forward cipher only, which is all CFB mode requires)
+    """
+
+    ROUNDS = 14
+
+    def __init__(self, key: bytes) -> None:
+        assert len(key) == 32, "AES256 requires a 32 byte key"
+        rcon = 1
+        w = list(unpack(">8I", key))
+        for i in range(8, 4 * (self.ROUNDS + 1)):
+            t = w[i - 1]
+            if i % 8 == 0:
+                t = ((t << 8) | (t >> 24)) & 0xFFFFFFFF
+                t = self._sub_word(t) ^ (rcon << 24)
+                rcon = ((rcon << 1) ^ 0x1B) & 0xFF if rcon & 0x80 else rcon << 1
+            elif i % 8 == 4:
+                t = self._sub_word(t)
+            w.append(w[i - 8] ^ t)
+        self._round_keys = w
+
+    @staticmethod
+    def _sub_word(w: int) -> int:
+        return (
+            (_SBOX[w >> 24] << 24) | (_SBOX[(w >> 16) & 0xFF] << 16) | (_SBOX[(w >> 8) & 0xFF] << 8) | _SBOX[w & 0xFF]
+        )
+
+    def _rounds(self, s0: int, s1: int, s2: int, s3: int) -> tuple[int, int, int, int]:
+        """Applies all but the final round to the state (as 4 big-endian words)"""
+        rk = self._round_keys
+        te0, te1, te2, te3 = _TE0, _TE1, _TE2, _TE3
+        s0 ^= rk[0]
+        s1 ^= rk[1]
+        s2 ^= rk[2]
+        s3 ^= rk[3]
+        for r in range(4, 4 * self.ROUNDS, 4):
+            t0 = te0[s0 >> 24] ^ te1[(s1 >> 16) & 0xFF] ^ te2[(s2 >> 8) & 0xFF] ^ te3[s3 & 0xFF] ^ rk[r]
+            t1 = te0[s1 >> 24] ^ te1[(s2 >> 16) & 0xFF] ^ te2[(s3 >> 8) & 0xFF] ^ te3[s0 & 0xFF] ^ rk[r + 1]
+            t2 = te0[s2 >> 24] ^ te1[(s3 >> 16) & 0xFF] ^ te2[(s0 >> 8) & 0xFF] ^ te3[s1 & 0xFF] ^ rk[r + 2]
+            t3 = te0[s3 >> 24] ^ te1[(s0 >> 16) & 0xFF] ^ te2[(s1 >> 8) & 0xFF] ^ te3[s2 & 0xFF] ^ rk[r + 3]
+            s0, s1, s2, s3 = t0, t1, t2, t3
+        return s0, s1, s2, s3
+
+    def encrypt_block(self, block: bytes) -> bytes:
+        s0, s1, s2, s3 = self._rounds(*unpack(">4I", block))
+        rk = self._round_keys[4 * self.ROUNDS :]
+        sb = _SBOX
+        return pack(
+            ">4I",
+            self._final(s0, s1, s2, s3, sb) ^ rk[0],
+            self._final(s1, s2, s3, s0, sb) ^ rk[1],
+            self._final(s2, s3, s0, s1, sb) ^ rk[2],
+            self._final(s3, s0, s1, s2, sb) ^ rk[3],
+        )
+
+    @staticmethod
+    def _final(a: int, b: int, c: int, d: int, sb: list[int]) -> int:
+        return (sb[a >> 24] << 24) | (sb[(b >> 16) & 0xFF] << 16) | (sb[(c >> 8) & 0xFF] << 8) | sb[d & 0xFF]
+
+    def cfb8(self, data: bytes | bytearray | memoryview, iv: int, encrypt: bool) -> tuple[bytes, int]:
+        """
+        AES-CFB8 as mbedtls_aes_crypt_cfb8. The IV is passed and returned as a 128-bit integer so that a stream can
+        be processed in chunks
+        """
+        out = bytearray(len(data))
+        last = self._round_keys[4 * self.ROUNDS] >> 24
+        sb = _SBOX
+        mask = (1 << 128) - 1
+        for i, b in enumerate(data):
+            s0, _, _, _ = self._rounds(iv >> 96, (iv >> 64) & 0xFFFFFFFF, (iv >> 32) & 0xFFFFFFFF, iv & 0xFFFFFFFF)
+            o = b ^ sb[s0 >> 24] ^ last
+            out[i] = o
+            iv = ((iv << 8) & mask) | (o if encrypt else b)
+        return bytes(out), iv
+
+    def ctr(
+        self, data: bytes | bytearray | memoryview, counter: int, keystream: bytes = b""
+    ) -> tuple[bytes, int, bytes]:
+        """
+        AES-CTR as mbedtls_aes_crypt_ctr (128-bit big-endian counter block). The counter and any unused keystream are
+        passed and returned so that a stream can be processed in chunks
+        """
+        length = len(data)
+        blocks = [keystream]
+        available = len(keystream)
+        while available < length:
+            blocks.append(self.encrypt_block(counter.to_bytes(16, "big")))
+            counter = (counter + 1) & ((1 << 128) - 1)
+            available += 16
+        stream = b"".join(blocks)
+        out = int.from_bytes(data, "big") ^ int.from_bytes(stream[:length], "big")
+        return out.to_bytes(length, "big"), counter, stream[length:]
+
+
+def _gf128_mul(x: int, y: int) -> int:
+    """Multiplication in GF(2^128) with the GCM bit ordering"""
+    z = 0
+    for i in range(127, -1, -1):
+        if (x >> i) & 1:
+            z ^= y
+        y = (y >> 1) ^ (0xE1 << 120) if y & 1 else y >> 1
+    return z
+
+
+class GHash:
+    """GCM's GHASH over ciphertext only (no additional data)"""
+
+    def __init__(self, h: int) -> None:
+        self.h = h
+        self.y = 0
+        self.pending = b""
+        self.length = 0
+
+    def update(self, data: bytes) -> None:
+        self.length += len(data)
+        self.pending += data
+        while len(self.pending) >= 16:
+            self.y = _gf128_mul(self.y ^ int.from_bytes(self.pending[:16], "big"), self.h)
+            self.pending = self.pending[16:]
+
+    def digest(self) -> int:
+        y = self.y
+        if self.pending:
+            y = _gf128_mul(y ^ int.from_bytes(self.pending.ljust(16, b"\0"), "big"), self.h)
+        return _gf128_mul(y ^ (self.length * 8), self.h)
+
+
+class _FrameOverrun(Exception):
+    """A framed command read beyond the end of its payload"""
+
+
+class _ErrorLoop(Exception):
+    """The firmware has entered its error loop (error.check), and will not respond again until it's power cycled"""
+
+
+class _Fifo:
+    """Bounded byte FIFO modelling one direction of the CDC link"""
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.buffer = bytearray()
+        self.cond = threading.Condition()
+
+    def put(self, data: bytes | bytearray | memoryview, timeout: float | None = None) -> int:
+        """
+        Blocks until all data is in the FIFO, returns the number of bytes accepted (less if no space became available
+        within the timeout)
+        """
+        pos = 0
+        with self.cond:
+            while pos < len(data):
+                if not self.cond.wait_for(lambda: len(self.buffer) < self.capacity, timeout):
+                    break
+                n = min(self.capacity - len(self.buffer), len(data) - pos)
+                self.buffer += data[pos : pos + n]
+                pos += n
+                self.cond.notify_all()
+        return pos
+
+    def get(self, length: int, timeout: float | None = None) -> bytes:
+        """Blocks until some data is available, returns up to length bytes (empty on timeout)"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.buffer, timeout):
+                return b""
+            data = bytes(self.buffer[:length])
+            del self.buffer[:length]
+            self.cond.notify_all()
+            return data
+
+    def get_exact(self, length: int) -> bytes:
+        data = bytearray()
+        while len(data) < length:
+            data += self.get(length - len(data))
+        return bytes(data)
+
+
+class EmulatedEndpoint:
+    """
+    Host-side view of a bulk endpoint, implementing the subset of the pyusb Endpoint interface used by CryptoKey.
+    Counts transfers and bytes, and applies the device's latency/bitrate model to each transfer.
+    """
+
+    def __init__(self, device: EmulatedDevice, fifo: _Fifo, address: int) -> None:
+        self.device = device
+        self.fifo = fifo
+        self.bEndpointAddress = address
+        self.transfers = 0
+        self.bytes_transferred = 0
+
+    def write(self, data: bytes | bytearray | memoryview | str, timeout: int | None = None) -> int:
+        if isinstance(data, str):
+            data = data.encode()
+        self.device._delay(len(data))
+        n = self.fifo.put(data, self.device._timeout_s(timeout))
+        if n < len(data):
+            raise usb.core.USBTimeoutError("Operation timed out", errno=110)
+        self.transfers += 1
+        self.bytes_transferred += n
+        return n
+
+    def read(self, size_or_buffer: int | array.array, timeout: int | None = None) -> array.array | int:
+        into = isinstance(size_or_buffer, array.array)
+        length = len(size_or_buffer) if into else size_or_buffer
+        data = self.fifo.get(length, self.device._timeout_s(timeout))
+        if not data:
+            raise usb.core.USBTimeoutError("Operation timed out", errno=110)
+        self.device._delay(len(data))
+        self.transfers += 1
+        self.bytes_transferred += len(data)
+        if into:
+            memoryview(size_or_buffer)[: len(data)] = data
+            return len(data)
+        return array.array("B", data)
+
+
+class EmulatedDevice:
+    """
+    Emulates a crypto key on the USB bus, implementing the subset of the pyusb Device interface used by CryptoKey.
+    The firmware's command loop runs in a background (daemon) thread, communicating with the host via bounded FIFOs
+    sized as the device's CDC buffers. Delays in the firmware (e.g. after an invalid PIN) are not emulated.
+
+    Parameters
+    ----------
+    board_id: bytes
+        The 8-byte unique board id, from which all keys are derived
+    pin: str
+        The device PIN
+    board: str
+        The board name reported by info
+    latency_ms: float
+        Fixed cost added to every USB transfer
+    bitrate_kbps: float | None
+        Link bitrate, if specified each transfer incurs an additional size-dependent cost
+    timeout_ms: int
+        Default transfer timeout (as pyusb)
+    legacy: bool
+        Emulate firmware without the protocol extensions (i.e. only the original commands), to test host fallbacks
+    """
+
+    VENDOR_ID = 0xAAFE
+    PRODUCT_ID = 0xC0FF
+
+    def __init__(
+        self,
+        board_id: bytes = b"EMULATED",
+        pin: str = "pico",
+        board: str = "emulator",
+        latency_ms: float = 0.0,
+        bitrate_kbps: float | None = None,
+        timeout_ms: int = 1000,
+        legacy: bool = False,
+    ) -> None:
+        assert len(board_id) == 8, "board id must be 8 bytes"
+        self.idVendor = self.VENDOR_ID
+        self.idProduct = self.PRODUCT_ID
+        self.board_id = board_id
+        self.version = f"{__version__}-{board}-host"
+        self.latency_ms = latency_ms
+        self.bitrate_kbps = bitrate_kbps
+        self.default_timeout = timeout_ms
+        self.legacy = legacy
+        # whether the firmware is in its error loop
+        self.halted = False
+        self._pin_hash = sha256(pin.encode() + PIN_SALT).digest()
+        self._boot_ms = monotonic() * 1000
+        self._time_offset_ms = 0
+        self._chunk_size = DEFAULT_CHUNK_SIZE
+        # LRU cache of webauthn keys, most recently used last
+        self._keys: OrderedDict[bytes, SigningKey] = OrderedDict()
+        self._key_hits = self._key_misses = 0
+        # profiling counters per command: calls, total, usb read, usb write, compute (us), bytes in, bytes out
+        self._profile: dict[bytes, list[int]] = {}
+        self._current = [0] * 7
+        # while running a framed command, its input (and read position) and output
+        self._frame_in: bytes | None = None
+        self._frame_pos = 0
+        self._frame_out = bytearray()
+        self._rx = _Fifo(CDC_RX_BUFSIZE)
+        self._tx = _Fifo(CDC_TX_BUFSIZE)
+        # endpoint order as the CDC data interface descriptor: OUT then IN
+        self.endpoints = (EmulatedEndpoint(self, self._rx, 0x02), EmulatedEndpoint(self, self._tx, 0x82))
+        self._thread = threading.Thread(target=self._main, name="pico-crypto-key-emulator", daemon=True)
+        self._thread.start()
+
+    # pyusb device interface
+
+    def get_active_configuration(self) -> dict[tuple[int, int], tuple[EmulatedEndpoint, EmulatedEndpoint]]:
+        # CDC data interface is (1, 0)
+        return {(1, 0): self.endpoints}
+
+    def is_kernel_driver_active(self, _interface: int) -> bool:
+        return False
+
+    def detach_kernel_driver(self, _interface: int) -> None:
+        pass
+
+    def attach_kernel_driver(self, _interface: int) -> None:
+        pass
+
+    # transfer model
+
+    def _delay(self, length: int) -> None:
+        delay_ms = self.latency_ms
+        if self.bitrate_kbps:
+            delay_ms += length * 8 / self.bitrate_kbps
+        if delay_ms:
+            sleep(delay_ms / 1000)
+
+    def _timeout_s(self, timeout: int | None) -> float | None:
+        timeout = self.default_timeout if timeout is None else timeout
+        return timeout / 1000 if timeout else None
+
+    # firmware
+
+    def _read(self, length: int) -> bytes:
+        if self._frame_in is not None:
+            if self._frame_pos + length > len(self._frame_in):
+                raise _FrameOverrun
+            self._frame_pos += length
+            return self._frame_in[self._frame_pos - length : self._frame_pos]
+        start = perf_counter_ns()
+        data = self._rx.get_exact(length)
+        self._current[2] += (perf_counter_ns() - start) // 1000
+        self._current[5] += length
+        return data
+
+    def _read_uint32(self) -> int:
+        return unpack("<I", self._read(4))[0]
+
+    def _read_with_length(self) -> bytes:
+        return self._read(self._read_uint32())
+
+    def _write(self, data: bytes) -> None:
+        if self._frame_in is not None:
+            self._frame_out += data
+            return
+        start = perf_counter_ns()
+        self._tx.put(data)
+        self._current[3] += (perf_counter_ns() - start) // 1000
+        self._current[6] += len(data)
+
+    def _begin_profile(self) -> None:
+        self._current = [0] * 7
+        self._current[1] = perf_counter_ns()
+
+    def _end_profile(self, cmd: bytes) -> None:
+        # time not spent in transfers is taken to be compute
+        self._current[1] = (perf_counter_ns() - self._current[1]) // 1000
+        self._current[4] = max(0, self._current[1] - self._current[2] - self._current[3])
+        self._current[0] = 1
+        totals = self._profile.setdefault(cmd, [0] * 7)
+        for i, value in enumerate(self._current):
+            totals[i] += value
+
+    def _write_profile(self) -> None:
+        records = b"".join(pack("<2I6Q", cmd[0], *counters) for cmd, counters in self._profile.items())
+        self._write_uint32(len(records))
+        self._write(records)
+
+    def _write_uint32(self, n: int) -> None:
+        self._write(pack("<I", n & 0xFFFFFFFF))
+
+    def _write_with_length(self, data: bytes) -> None:
+        self._write_uint32(len(data))
+        self._write(data)
+
+    def _get_time_ms(self) -> int:
+        return self._time_offset_ms + int(monotonic() * 1000 - self._boot_ms)
+
+    def _genkey(self, extra: bytes = b"") -> bytes:
+        return sha256(KEY_SALT + self.board_id + extra).digest()
+
+    def _eckey(self, raw: bytes) -> SigningKey:
+        return SigningKey.from_string(raw, curve=SECP256k1, hashfunc=sha256)
+
+    def _webauthn_key(self, rp: bytes) -> SigningKey:
+        if rp in self._keys:
+            self._key_hits += 1
+            self._keys.move_to_end(rp)
+        else:
+            self._key_misses += 1
+            self._keys[rp] = self._eckey(self._genkey(rp))
+            if len(self._keys) > KEYCACHE_CAPACITY:
+                self._keys.popitem(last=False)
+        return self._keys[rp]
+
+    def _clear_keys(self) -> None:
+        self._keys.clear()
+        self._key_hits = self._key_misses = 0
+
+    def _pubkey(self, key: SigningKey) -> bytes:
+        return key.get_verifying_key().to_string("compressed")
+
+    def _sign(self, key: SigningKey, digest: bytes) -> bytes:
+        return key.sign_digest_deterministic(digest, hashfunc=sha256, sigencode=sigencode_der)
+
+    def _verify(self, digest: bytes, sig: bytes, pubkey: bytes) -> int:
+        # mbedtls_ecp_point_read_binary accepts the point at infinity, and compressed or uncompressed points of the
+        # right length (whether they're on the curve is checked when verifying), anything else is an error.check failure
+        if pubkey != b"\x00" and (len(pubkey), pubkey[:1]) not in {(33, b"\x02"), (33, b"\x03"), (65, b"\x04")}:
+            raise _ErrorLoop
+        return verify_signature(parse_pubkey(pubkey), digest, sig)
+
+    def _transform_in(self, transform: Callable[[bytes], bytes]) -> None:
+        length = self._read_uint32()
+        while length:
+            chunk_length = min(length, self._chunk_size)
+            self._write(transform(self._read(chunk_length)))
+            length -= chunk_length
+
+    def _crypt_in(self, aes_key: AES256, encrypt: bool) -> None:
+        iv = 0
+
+        def transform(chunk: bytes) -> bytes:
+            nonlocal iv
+            output, iv = aes_key.cfb8(chunk, iv, encrypt)
+            return output
+
+        self._transform_in(transform)
+
+    def _ctr_in(self, aes_key: AES256) -> None:
+        counter = int.from_bytes(self._read(NONCE_BYTES) + bytes(4), "big")
+        keystream = b""
+
+        def transform(chunk: bytes) -> bytes:
+            nonlocal counter, keystream
+            output, counter, keystream = aes_key.ctr(chunk, counter, keystream)
+            return output
+
+        self._transform_in(transform)
+
+    def _gcm_in(self, aes_key: AES256, encrypt: bool) -> bytes:
+        """Transforms input in GCM mode, returns the tag"""
+        j0 = int.from_bytes(self._read(NONCE_BYTES) + b"\0\0\0\1", "big")
+        ghash = GHash(int.from_bytes(aes_key.encrypt_block(bytes(16)), "big"))
+        keystream = b""
+        counter = j0 + 1
+
+        def transform(chunk: bytes) -> bytes:
+            nonlocal counter, keystream
+            output, counter, keystream = aes_key.ctr(chunk, counter, keystream)
+            ghash.update(output if encrypt else chunk)
+            return output
+
+        self._transform_in(transform)
+        mask = int.from_bytes(aes_key.encrypt_block(j0.to_bytes(16, "big")), "big")
+        return (mask ^ ghash.digest()).to_bytes(16, "big")
+
+    def _hash_in(self, length: int | None = None) -> bytes:
+        if length is None:
+            length = self._read_uint32()
+        h = sha256()
+        while length:
+            chunk_length = min(length, self._chunk_size)
+            h.update(self._read(chunk_length))
+            length -= chunk_length
+        return h.digest()
+
+    def _frame(self, ec_key: SigningKey, aes_key: AES256) -> None:
+        """Reads a frame (after its b"T"), runs the command it contains and writes the response frame"""
+        header = b"T" + self._read(9)
+        version, opcode, status, request_id, length = unpack("<BBBHI", header[1:])
+        if version != FRAME_VERSION or length > FRAME_MAX_PAYLOAD:
+            self._respond(opcode, BAD_FRAME, request_id, b"")
+            return
+        payload = self._read(length)
+        (checksum,) = unpack("<I", self._read(4))
+        if zlib.crc32(payload, zlib.crc32(header)) != checksum:
+            self._respond(opcode, BAD_CHECKSUM, request_id, b"")
+            return
+        cmd = bytes([opcode])
+        if cmd not in FRAMED_COMMANDS:
+            self._respond(opcode, INVALID_CMD, request_id, b"")
+            return
+        self._frame_in, self._frame_pos, self._frame_out = payload, 0, bytearray()
+        try:
+            self._execute(cmd, ec_key, aes_key)
+            consumed = self._frame_pos == len(payload)
+        except _FrameOverrun:
+            consumed = False
+        finally:
+            self._frame_in = None
+        self._respond(opcode, SUCCESS if consumed else BAD_FRAME, request_id, self._frame_out if consumed else b"")
+
+    def _respond(self, opcode: int, status: int, request_id: int, payload: bytes | bytearray) -> None:
+        response = pack("<cBBBHI", b"T", FRAME_VERSION, opcode, status, request_id, len(payload)) + payload
+        self._write(response + pack("<I", zlib.crc32(response)))
+
+    def _check_pin(self) -> bool:
+        pin = self._read_with_length()
+        return sha256(pin + PIN_SALT).digest() == self._pin_hash
+
+    def _main(self) -> None:
+        try:
+            self._run()
+        except _ErrorLoop:
+            self.halted = True
+
+    def _run(self) -> None:
+        while True:
+            while not self._check_pin():
+                self._write_uint32(INVALID_PIN)
+            self._write_uint32(SUCCESS)
+            # host will send timestamp on success
+            (timestamp_ms,) = unpack("<Q", self._read(8))
+            self._time_offset_ms = timestamp_ms - int(monotonic() * 1000 - self._boot_ms)
+
+            key = self._genkey()
+            # each session starts with the default chunk size
+            self._chunk_size = DEFAULT_CHUNK_SIZE
+            self._profile.clear()
+            self._repl(self._eckey(key), AES256(key))
+
+    def _repl(self, ec_key: SigningKey, aes_key: AES256) -> None:
+        while True:
+            cmd = self._read(1)
+            if self.legacy and cmd not in LEGACY_COMMANDS:
+                cmd = b""
+            self._begin_profile()
+            if not self._execute(cmd, ec_key, aes_key):
+                return
+            if cmd:
+                self._end_profile(cmd)
+
+    def _execute(self, cmd: bytes, ec_key: SigningKey, aes_key: AES256) -> bool:
+        """Runs a command, returns False if it ends the session"""
+        match cmd:
+            case b"x":
+                self._clear_keys()
+                return False
+            case b"p":
+                self._clear_keys()
+                pin = self._read_with_length()
+                self._pin_hash = sha256(pin + PIN_SALT).digest()
+                self._write_uint32(SUCCESS)
+            case b"k":
+                self._write(self._pubkey(ec_key))
+            case b"h":
+                self._write(self._hash_in())
+            case b"H":
+                while (length := self._read_uint32()) != END_OF_ITEMS:
+                    self._write(self._hash_in(length))
+            case b"d":
+                self._crypt_in(aes_key, encrypt=False)
+            case b"e":
+                self._crypt_in(aes_key, encrypt=True)
+            case b"t":
+                self._ctr_in(aes_key)
+            case b"E":
+                self._write(self._gcm_in(aes_key, encrypt=True))
+            case b"D":
+                tag = self._gcm_in(aes_key, encrypt=False)
+                self._write_uint32(0 if hmac.compare_digest(tag, self._read(TAG_BYTES)) else 1)
+            case b"s":
+                digest = self._hash_in()
+                self._write(digest)
+                self._write_with_length(self._sign(ec_key, digest))
+            case b"g":
+                self._write_with_length(self._sign(ec_key, self._read(32)))
+            case b"m":
+                for _ in range(self._read_uint32()):
+                    digest = self._hash_in() if self._read(1) == b"h" else self._read(32)
+                    self._write(digest)
+                    self._write_with_length(self._sign(ec_key, digest))
+            case b"v":
+                digest = self._read(32)
+                sig = self._read_with_length()
+                pubkey = self._read_with_length()
+                self._write(pack("<i", self._verify(digest, sig, pubkey)))
+            case b"r":
+                rp = self._read_with_length()
+                self._write(self._pubkey(self._webauthn_key(rp)))
+            case b"a":
+                rp = self._read_with_length()
+                webauthn_key = self._webauthn_key(rp)
+                challenge = self._read_with_length()
+                timestamp = self._get_time_ms()
+                challenge += pack("<Q", timestamp - timestamp % AUTH_TIME_VALIDITY_MS)
+                self._write_with_length(self._sign(webauthn_key, sha256(challenge).digest()))
+            case b"c":
+                self._write_uint32(16)
+                self._write(pack("<4I", self._chunk_size, MAX_CHUNK_SIZE, CDC_RX_BUFSIZE, CDC_TX_BUFSIZE))
+            case b"z":
+                self._chunk_size = min(max(self._read_uint32(), MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+                self._write_uint32(self._chunk_size)
+            case b"l":
+                self._write_uint32(16)
+                self._write(pack("<4I", self._key_hits, self._key_misses, len(self._keys), KEYCACHE_CAPACITY))
+            case b"u":
+                self._write_with_length(sha256(self._pubkey(ec_key)).digest())
+            case b"f":
+                self._write_profile()
+            case b"F":
+                self._write_profile()
+                self._profile.clear()
+            case b"i":
+                version = self.version.encode()
+                self._write_uint32(len(version) + 8)
+                self._write(version)
+                self._write(pack("<Q", self._get_time_ms()))
+            case b"q":
+                self._write_uint32(4)
+                self._write_uint32(FRAME_VERSION)
+            case b"T":
+                self._frame(ec_key, aes_key)
+            case _:
+                self._write_uint32(INVALID_CMD)
+        return True
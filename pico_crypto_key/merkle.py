@@ -0,0 +1,237 @@
+"""
+Signing of large files by a Merkle tree of their chunks.
+
+Hashing a file on the device means uploading every byte over USB, and hashing it on the host in one pass uses only one
+core. Instead the file is split into fixed-size chunks, which are hashed in parallel on a thread pool (hashlib releases
+the GIL), the chunk hashes are combined into a Merkle tree, and the device signs only the 32-byte root. So signing time
+scales with host cores and disk bandwidth rather than USB bandwidth.
+
+The tree is the RFC 6962 (Certificate Transparency) tree hash, with SHA256: each chunk's leaf hash is
+SHA256(0x00 || chunk), each interior node is SHA256(0x01 || left || right), and a node without a sibling is promoted to
+the level above. An empty file has no chunks, and its root is SHA256 of nothing. The manifest is JSON:
+
+    {
+      "format": "pico-crypto-key-merkle",
+      "version": 1,
+      "file": "<file name>",
+      "size": <file size in bytes>,
+      "chunk_size": <chunk size in bytes>,
+      "root": "<hex>",
+      "signature": "<hex, DER-encoded ECDSA signature of the root>",
+      "pubkey": "<hex, the signer's public key>",
+      "leaves": ["<hex leaf hash of each chunk>", ...]
+    }
+
+Since every leaf hash is listed, once the leaves have been checked against the signed root a file can be verified (or
+e.g. downloaded and checked) one chunk at a time.
+"""
+
+from __future__ import annotations
+
+import json
+import mmap
+import os
+from collections.abc import Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from pathlib import Path
+from typing import Any
+
+from pico_crypto_key.device import Buffer, CryptoKey, CryptoKeyAuthenticationError
+
+FORMAT = "pico-crypto-key-merkle"
+VERSION = 1
+DEFAULT_CHUNK_SIZE = CryptoKey.MERKLE_CHUNK_SIZE
+
+
+def leaf_hash(chunk: Buffer) -> bytes:
+    """The hash of a chunk of data, as a leaf of the tree"""
+    h = sha256(b"\x00")
+    h.update(chunk)
+    return h.digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    """The hash of an interior node of the tree"""
+    return sha256(b"\x01" + left + right).digest()
+
+
+def merkle_root(leaves: Sequence[bytes]) -> bytes:
+    """Computes the root of the tree with the given leaf hashes"""
+    if not leaves:
+        return sha256().digest()
+    level = list(leaves)
+    while len(level) > 1:
+        level = [node_hash(level[i], level[i + 1]) if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)]
+    return level[0]
+
+
+def hash_chunks(
+    path: str | Path, chunk_size: int = DEFAULT_CHUNK_SIZE, workers: int | None = None
+) -> tuple[int, list[bytes]]:
+    """
+    Hashes a file's chunks in parallel
+
+    Parameters
+    ----------
+    path: str | Path
+        The file
+    chunk_size: int
+        The size of each chunk (the last may be shorter)
+    workers: int | None
+        The number of threads, None for one per CPU
+
+    Returns
+    -------
+    tuple[int, list[bytes]]
+        The size of the file and the leaf hash of each chunk, in order
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    with open(path, "rb") as fd:
+        size = os.fstat(fd.fileno()).st_size
+        # empty files cannot be mapped
+        if not size:
+            return 0, []
+        # chunks are hashed from the mapping without being copied
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+
+            def hash_chunk(pos: int) -> bytes:
+                with view[pos : pos + chunk_size] as chunk:
+                    return leaf_hash(chunk)
+
+            with ThreadPoolExecutor(workers or os.cpu_count() or 1) as executor:
+                return size, list(executor.map(hash_chunk, range(0, size, chunk_size)))
+
+
+class Manifest:
+    """A file's chunk hashes and their Merkle root, signed by the device"""
+
+    def __init__(
+        self,
+        file: str,
+        size: int,
+        chunk_size: int,
+        root: bytes,
+        signature: bytes,
+        pubkey: bytes,
+        leaves: list[bytes],
+    ) -> None:
+        self.file = file
+        self.size = size
+        self.chunk_size = chunk_size
+        self.root = root
+        self.signature = signature
+        self.pubkey = pubkey
+        self.leaves = leaves
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "format": FORMAT,
+            "version": VERSION,
+            "file": self.file,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "root": self.root.hex(),
+            "signature": self.signature.hex(),
+            "pubkey": self.pubkey.hex(),
+            "leaves": [leaf.hex() for leaf in self.leaves],
+        }
+
+    @classmethod
+    def from_dict(cls, manifest: dict[str, Any]) -> Manifest:
+        """
+        Raises ValueError if the manifest isn't in a supported format, or CryptoKeyAuthenticationError if its sizes are
+        invalid
+        """
+        if manifest.get("format") != FORMAT:
+            raise ValueError("not a Merkle tree manifest")
+        if manifest.get("version") != VERSION:
+            raise ValueError(f"unsupported manifest version {manifest.get('version')}")
+        return cls(
+            manifest["file"],
+            manifest["size"],
+            manifest["chunk_size"],
+            bytes.fromhex(manifest["root"]),
+            bytes.fromhex(manifest["signature"]),
+            bytes.fromhex(manifest["pubkey"]),
+            [bytes.fromhex(leaf) for leaf in manifest["leaves"]],
+        )._checked()
+
+    def _checked(self) -> Manifest:
+        """Checks the sizes can describe a file (a verifier divides by the chunk size)"""
+        if not isinstance(self.chunk_size, int) or self.chunk_size < 1:
+            raise CryptoKeyAuthenticationError(f"invalid chunk size {self.chunk_size!r}")
+        if not isinstance(self.size, int) or self.size < 0:
+            raise CryptoKeyAuthenticationError(f"invalid file size {self.size!r}")
+        return self
+
+    def save(self, path: str | Path) -> None:
+        Path(path).write_text(json.dumps(self.to_dict(), indent=2))
+
+    @classmethod
+    def load(cls, path: str | Path) -> Manifest:
+        return cls.from_dict(json.loads(Path(path).read_text()))
+
+
+def sign_large(
+    crypto_key: CryptoKey, path: str | Path, chunk_size: int = DEFAULT_CHUNK_SIZE, workers: int | None = None
+) -> Manifest:
+    """Hashes a file's chunks in parallel and signs their Merkle root with the device (see CryptoKey.sign_large)"""
+    size, leaves = hash_chunks(path, chunk_size, workers)
+    root = merkle_root(leaves)
+    return Manifest(Path(path).name, size, chunk_size, root, crypto_key.sign_digest(root), crypto_key.pubkey(), leaves)
+
+
+class ChunkVerifier:
+    """
+    Checks a file against a manifest, one chunk at a time. The leaf hashes are checked against the root, and the root's
+    signature verified, on construction. Whether the manifest's public key is that of a trusted signer is up to the
+    caller
+    """
+
+    def __init__(self, manifest: Manifest, verify: Callable[[bytes, bytes, bytes], int]) -> None:
+        """
+        Parameters
+        ----------
+        manifest: Manifest
+            The signed manifest
+        verify: Callable[[bytes, bytes, bytes], int]
+            Verifies a signature, returning 0 if it's valid: CryptoKey.verify or (on the host) Verifier.verify
+
+        Raises
+        ------
+        CryptoKeyAuthenticationError
+            If the sizes are invalid, the leaves don't match the root, or the root's signature is not valid
+        """
+        manifest._checked()
+        if len(manifest.leaves) != -(-manifest.size // manifest.chunk_size):
+            raise CryptoKeyAuthenticationError("number of chunk hashes doesn't match the file size")
+        if merkle_root(manifest.leaves) != manifest.root:
+            raise CryptoKeyAuthenticationError("chunk hashes don't match the root")
+        if verify(manifest.root, manifest.signature, manifest.pubkey):
+            raise CryptoKeyAuthenticationError("root signature is not valid")
+        self.manifest = manifest
+
+    def chunk_length(self, index: int) -> int:
+        """The length of a chunk of the file"""
+        return min(self.manifest.chunk_size, self.manifest.size - index * self.manifest.chunk_size)
+
+    def verify_chunk(self, index: int, chunk: Buffer) -> bool:
+        """Whether chunk is the index'th chunk of the signed file"""
+        if not 0 <= index < len(self.manifest.leaves) or memoryview(chunk).nbytes != self.chunk_length(index):
+            return False
+        return leaf_hash(chunk) == self.manifest.leaves[index]
+
+    def verify_file(self, path: str | Path, workers: int | None = None) -> list[int]:
+        """
+        Hashes a file's chunks in parallel, returning the indices of those that don't match the manifest (including any
+        beyond the end of either). The file matches if there are none
+        """
+        _, leaves = hash_chunks(path, self.manifest.chunk_size, workers)
+        expected = self.manifest.leaves
+        return [
+            index
+            for index in range(max(len(leaves), len(expected)))
+            if index >= len(leaves) or index >= len(expected) or leaves[index] != expected[index]
+        ]
@@ -0,0 +1,231 @@
+"""
+Per-operation instrumentation.
+
+CryptoKey records, for each command it runs, the bytes sent and received, the number of USB transfers, the time spent
+in USB writes and reads, and the end-to-end latency. Operations called from within another (e.g. encrypt_into from
+encrypt) are attributed to the outer one. Aggregates are kept per operation as counters and a latency histogram, which
+can be exported in the OpenMetrics (Prometheus) text format.
+
+Time not spent in USB transfers is host-side overhead, e.g. reading files. Reads include time the device spends
+processing, so a slow board shows up as read time and a slow host as the remainder. With pipelining, writes and reads
+overlap so their total can exceed the latency.
+"""
+
+from __future__ import annotations
+
+import threading
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+# upper bounds of the latency histogram buckets, in seconds (there is also an unbounded one)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+class Sample:
+    """The transfers made by a single call of an operation"""
+
+    __slots__ = (
+        "operation",
+        "bytes_sent",
+        "bytes_received",
+        "writes",
+        "reads",
+        "write_s",
+        "read_s",
+        "latency_s",
+        "error",
+    )
+
+    def __init__(self, operation: str) -> None:
+        self.operation = operation
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.writes = 0
+        self.reads = 0
+        self.write_s = 0.0
+        self.read_s = 0.0
+        self.latency_s = 0.0
+        # the name of the exception raised, if any
+        self.error: str | None = None
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"Sample({fields})"
+
+
+class OperationStats:
+    """Aggregated samples of an operation"""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.writes = 0
+        self.reads = 0
+        self.write_s = 0.0
+        self.read_s = 0.0
+        self.latency_s = 0.0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, sample: Sample) -> None:
+        self.calls += 1
+        self.errors += sample.error is not None
+        self.bytes_sent += sample.bytes_sent
+        self.bytes_received += sample.bytes_received
+        self.writes += sample.writes
+        self.reads += sample.reads
+        self.write_s += sample.write_s
+        self.read_s += sample.read_s
+        self.latency_s += sample.latency_s
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and sample.latency_s > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        self.latency_buckets[bucket] += 1
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "writes": self.writes,
+            "reads": self.reads,
+            "write_s": self.write_s,
+            "read_s": self.read_s,
+            "latency_s": self.latency_s,
+            "latency_buckets": list(self.latency_buckets),
+        }
+
+
+class Metrics:
+    """The operation statistics of a device, and hooks called with each sample"""
+
+    def __init__(self) -> None:
+        self.operations: dict[str, OperationStats] = {}
+        self.hooks: list[Callable[[Sample], None]] = []
+        self._lock = threading.Lock()
+
+    def record(self, sample: Sample) -> None:
+        with self._lock:
+            if (stats := self.operations.get(sample.operation)) is None:
+                stats = self.operations[sample.operation] = OperationStats()
+            stats.add(sample)
+        for hook in self.hooks:
+            hook(sample)
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        with self._lock:
+            return {name: stats.snapshot() for name, stats in self.operations.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self.operations.clear()
+
+
+def _labels(labels: dict[str, str]) -> str:
+    def escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def openmetrics(
+    stats: dict[str, dict[str, Any]], labels: dict[str, str] | None = None, prefix: str = "pico_crypto_key"
+) -> str:
+    """
+    Formats operation statistics in the OpenMetrics text format, which Prometheus can scrape
+
+    Parameters
+    ----------
+    stats: dict[str, dict[str, Any]]
+        Operation statistics, as returned by CryptoKey.stats
+    labels: dict[str, str] | None
+        Labels added to every sample, e.g. to identify the device
+    prefix: str
+        The prefix of the metric names
+
+    Returns
+    -------
+    str
+        The metrics, ending with the # EOF marker
+    """
+    labels = labels or {}
+    counters = [
+        ("operations", "Operations completed", lambda s: [({}, s["calls"])]),
+        ("operation_errors", "Operations that raised an exception", lambda s: [({}, s["errors"])]),
+        (
+            "transferred_bytes",
+            "Bytes transferred over USB",
+            lambda s: [({"direction": "out"}, s["bytes_sent"]), ({"direction": "in"}, s["bytes_received"])],
+        ),
+        (
+            "transfers",
+            "USB transfers",
+            lambda s: [({"direction": "out"}, s["writes"]), ({"direction": "in"}, s["reads"])],
+        ),
+        (
+            "transfer_seconds",
+            "Time spent in USB transfers",
+            lambda s: [({"direction": "out"}, s["write_s"]), ({"direction": "in"}, s["read_s"])],
+        ),
+    ]
+    lines = []
+    for name, help_text, values in counters:
+        lines += [f"# TYPE {prefix}_{name} counter", f"# HELP {prefix}_{name} {help_text}."]
+        for operation, op_stats in stats.items():
+            for extra, value in values(op_stats):
+                lines.append(f"{prefix}_{name}_total{_labels(labels | {'operation': operation} | extra)} {value}")
+
+    name = f"{prefix}_operation_seconds"
+    lines += [f"# TYPE {name} histogram", f"# HELP {name} Operation latency."]
+    for operation, op_stats in stats.items():
+        op_labels = labels | {"operation": operation}
+        count = 0
+        for bound, n in zip((*LATENCY_BUCKETS, "+Inf"), op_stats["latency_buckets"], strict=True):
+            count += n
+            lines.append(f"{name}_bucket{_labels(op_labels | {'le': str(bound)})} {count}")
+        lines.append(f"{name}_count{_labels(op_labels)} {count}")
+        lines.append(f"{name}_sum{_labels(op_labels)} {op_stats['latency_s']}")
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def serve(source: Callable[[], str], port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Serves metrics over HTTP (for Prometheus to scrape) from a background thread
+
+    Parameters
+    ----------
+    source: Callable[[], str]
+        Returns the current metrics, e.g. CryptoKey.openmetrics
+    port: int
+        The port to listen on (0 for any free port)
+    host: str
+        The address to listen on, local only by default
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        The server, which should be shut down when no longer required
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            body = source().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="pico-crypto-key-metrics", daemon=True).start()
+    return server
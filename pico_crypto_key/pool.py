@@ -0,0 +1,208 @@
+"""
+Drives several attached crypto keys concurrently.
+
+Each key gets its own worker thread. Work that any key can do (hashing, verification) goes to a shared queue, taken by
+whichever key is idle, so throughput scales with the number of keys. Work that depends on a key's secrets (signing,
+encryption, webauthn) is pinned to a particular key and queued for its worker only.
+"""
+
+from __future__ import annotations
+
+import threading
+from collections import deque
+from collections.abc import Callable, Iterable
+from concurrent.futures import Future
+from pathlib import Path
+from types import TracebackType
+from typing import Any, BinaryIO, TypeVar
+
+import usb.core
+
+from pico_crypto_key.device import Buffer, CipherMode, CryptoKey, CryptoKeyConnectionError
+
+T = TypeVar("T")
+
+
+class _Task:
+    def __init__(self, fn: Callable[..., Any], args: tuple[Any, ...], kwargs: dict[str, Any]) -> None:
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future: Future[Any] = Future()
+
+    def run(self, key: CryptoKey) -> None:
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            self.future.set_result(self.fn(key, *self.args, **self.kwargs))
+        except BaseException as e:
+            self.future.set_exception(e)
+
+
+class CryptoKeyPool:
+    """
+    A set of crypto keys used concurrently, each from its own worker thread.
+    """
+
+    def __init__(self, devices: Iterable[Any] | None = None, **kwargs: Any) -> None:
+        """
+        Create pool object for use in context manager.
+        By default every key found on the bus is used, or pass specific devices, e.g. emulated ones. Other arguments
+        are passed to each CryptoKey. The PIN is read (from PICO_CRYPTO_KEY_PIN or stdin) as each key is unlocked.
+        """
+        self._devices = list(devices) if devices is not None else None
+        self._kwargs = kwargs
+        self.keys: list[CryptoKey] = []
+        self._cond = threading.Condition()
+        self._shared: deque[_Task] = deque()
+        self._pinned: list[deque[_Task]] = []
+        self._workers: list[threading.Thread] = []
+        self._closed = True
+
+    def __enter__(self) -> CryptoKeyPool:
+        """Unlocks all the keys and starts the workers."""
+        self.init()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        exc_stack: TracebackType | None,
+    ) -> None:
+        """Waits for queued work to complete and disconnects all the keys."""
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @staticmethod
+    def find_devices() -> list[Any]:
+        """Returns all the crypto keys on the USB bus"""
+        return list(usb.core.find(find_all=True, idVendor=CryptoKey.VENDOR_ID, idProduct=CryptoKey.PRODUCT_ID))
+
+    def init(self) -> None:
+        """
+        Unlocks each key and starts a worker thread for it
+        Normally this is handled by the context manager
+        """
+        devices = self._devices if self._devices is not None else self.find_devices()
+        if not devices:
+            raise CryptoKeyConnectionError()
+        try:
+            for device in devices:
+                key = CryptoKey(device, **self._kwargs)
+                key.init()
+                self.keys.append(key)
+        except BaseException:
+            self._reset_keys()
+            raise
+        self._closed = False
+        self._pinned = [deque() for _ in self.keys]
+        self._workers = [
+            threading.Thread(target=self._work, args=(i,), name=f"pico-crypto-key-pool-{i}", daemon=True)
+            for i in range(len(self.keys))
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def close(self) -> None:
+        """
+        Waits for queued work to complete, stops the workers and disconnects all the keys
+        Normally this is handled by the context manager
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self._reset_keys()
+
+    def submit(self, fn: Callable[..., T], *args: Any, device: int | None = None, **kwargs: Any) -> Future[T]:
+        """
+        Schedules fn(key, *args, **kwargs) to be run with a key
+
+        Parameters
+        ----------
+        fn: Callable[..., T]
+            The function to run, taking a CryptoKey as its first argument
+        device: int | None
+            The index of the key to use, or None for whichever key is idle first
+
+        Returns
+        -------
+        Future[T]
+            The result of fn
+        """
+        if device is not None and not 0 <= device < len(self.keys):
+            raise IndexError(f"device must be in [0, {len(self.keys)}), not {device}")
+        task = _Task(fn, args, kwargs)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("pool is not open")
+            (self._shared if device is None else self._pinned[device]).append(task)
+            self._cond.notify_all()
+        return task.future
+
+    def device_ids(self) -> list[bytes | None]:
+        """Returns the device identifier of each key (see CryptoKey.device_id), in order"""
+        return [key.device_id() for key in self.keys]
+
+    # operations that any key can perform
+
+    def hash(self, data: str | Path | BinaryIO | Buffer, length: int | None = None) -> Future[bytes]:
+        """Computes the SHA256 hash of a file or data (see CryptoKey.hash) on the first idle key"""
+        return self.submit(CryptoKey.hash, data, length)
+
+    def verify(self, digest: bytes, sig: bytes, pubkey: bytes) -> Future[int]:
+        """Checks an ECDSA signature (see CryptoKey.verify) on the first idle key"""
+        return self.submit(CryptoKey.verify, digest, sig, pubkey)
+
+    # operations that use a specific key's secrets
+
+    def pubkey(self, device: int) -> Future[bytes]:
+        """Returns the ECDSA public key of a key (see CryptoKey.pubkey)"""
+        return self.submit(CryptoKey.pubkey, device=device)
+
+    def sign(
+        self, data: str | Path | BinaryIO | Buffer, device: int, length: int | None = None
+    ) -> Future[tuple[bytes, bytes]]:
+        """Hashes and signs a file or data with a key (see CryptoKey.sign)"""
+        return self.submit(CryptoKey.sign, data, length, device=device)
+
+    def encrypt(self, data: bytes, device: int, mode: CipherMode = "cfb8") -> Future[bytes]:
+        """Encrypts data with a key (see CryptoKey.encrypt)"""
+        return self.submit(CryptoKey.encrypt, data, mode, device=device)
+
+    def decrypt(self, data: bytes, device: int, mode: CipherMode = "cfb8") -> Future[bytes]:
+        """Decrypts data with the key that encrypted it (see CryptoKey.decrypt)"""
+        return self.submit(CryptoKey.decrypt, data, mode, device=device)
+
+    def register(self, relying_party: str, user: str, device: int) -> Future[bytes]:
+        """Returns a key's webauthn public key for the relying party and user (see CryptoKey.register)"""
+        return self.submit(CryptoKey.register, relying_party, user, device=device)
+
+    def auth(self, relying_party: str, user: str, challenge: bytes, device: int) -> Future[bytes]:
+        """Signs a webauthn challenge with the key the user registered with (see CryptoKey.auth)"""
+        return self.submit(CryptoKey.auth, relying_party, user, challenge, device=device)
+
+    def _work(self, index: int) -> None:
+        key = self.keys[index]
+        pinned = self._pinned[index]
+        while True:
+            with self._cond:
+                while not (pinned or self._shared or self._closed):
+                    self._cond.wait()
+                # pinned work first, as no other key can do it
+                if pinned:
+                    task = pinned.popleft()
+                elif self._shared:
+                    task = self._shared.popleft()
+                else:
+                    return
+            task.run(key)
+
+    def _reset_keys(self) -> None:
+        while self.keys:
+            self.keys.pop().__exit__(None, None, None)
@@ -0,0 +1,35 @@
+"""
+Persistent host-side settings, stored as JSON files in the user's config directory.
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Any
+
+
+def config_dir() -> Path:
+    """The settings directory: $PICO_CRYPTO_KEY_CONFIG_DIR if set, otherwise pico-crypto-key in the XDG config dir"""
+    if override := os.getenv("PICO_CRYPTO_KEY_CONFIG_DIR"):
+        return Path(override)
+    return Path(os.getenv("XDG_CONFIG_HOME") or Path.home() / ".config") / "pico-crypto-key"
+
+
+def load(name: str) -> dict[str, Any]:
+    """Load named settings, empty if not present"""
+    try:
+        with open(config_dir() / f"{name}.json") as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return {}
+
+
+def save(name: str, settings: dict[str, Any]) -> None:
+    """Save named settings, replacing any existing"""
+    path = config_dir() / f"{name}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write then rename so concurrent readers never see a partial file
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w") as fd:
+        json.dump(settings, fd, indent=2)
+    tmp.replace(path)
@@ -0,0 +1,155 @@
+"""
+Host-side ECDSA signature verification.
+
+Verification needs no secrets, so signatures made by the device can be checked on the host instead of with a device
+round trip each. For a well-formed public key and signature, results are the same codes that CryptoKey.verify returns.
+Malformed input is reported differently: a public key the device can't parse sends it into its error loop (it stops
+responding), and a signature that isn't valid DER gives MBEDTLS_ERR_ECP_BAD_INPUT_DATA plus an ASN.1 error code on the
+device, but just ERR_ECP_BAD_INPUT_DATA here. Parsed public keys are kept in an LRU cache with precomputed
+multiplication tables (built on first use), which roughly halves the cost of verifying further signatures from the same
+key, and batches can be spread over several processes.
+"""
+
+from __future__ import annotations
+
+import os
+from collections import OrderedDict
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+
+from ecdsa import SECP256k1, VerifyingKey
+from ecdsa.der import UnexpectedDER
+from ecdsa.ellipticcurve import PointJacobi
+from ecdsa.errors import MalformedPointError
+from ecdsa.keys import BadSignatureError
+from ecdsa.util import MalformedSignature, sigdecode_der
+
+# mbedtls error codes, as returned by the device's verify
+ERR_ECP_BAD_INPUT_DATA = -0x4F80
+ERR_ECP_INVALID_KEY = -0x4C80
+ERR_ECP_VERIFY_FAILED = -0x4E00
+
+
+def parse_pubkey(pubkey: bytes) -> VerifyingKey | None:
+    """Parses an encoded secp256k1 public key (compressed or not), None if it's invalid"""
+    try:
+        point = VerifyingKey.from_string(pubkey, curve=SECP256k1, hashfunc=sha256).pubkey.point
+    except MalformedPointError:
+        return None
+    # a point with known order marked as a generator gets precomputed tables on first use
+    point = PointJacobi(SECP256k1.curve, point.x(), point.y(), 1, SECP256k1.order, generator=True)
+    return VerifyingKey.from_public_point(point, curve=SECP256k1, hashfunc=sha256)
+
+
+def verify_signature(verifying_key: VerifyingKey | None, digest: bytes, sig: bytes) -> int:
+    """
+    Verifies a DER-encoded signature of a digest, returning 0 or a (signed) mbedtls error code as the device does. The
+    codes for an invalid key or malformed DER differ from the firmware's (see above)
+    """
+    if verifying_key is None:
+        return ERR_ECP_INVALID_KEY
+    try:
+        sigdecode_der(sig, SECP256k1.order)
+    except (UnexpectedDER, MalformedSignature):
+        return ERR_ECP_BAD_INPUT_DATA
+    try:
+        verifying_key.verify_digest(sig, digest, sigdecode=sigdecode_der)
+    except BadSignatureError:
+        return ERR_ECP_VERIFY_FAILED
+    return 0
+
+
+class Verifier:
+    """
+    Verifies signatures on the host, caching parsed public keys
+    """
+
+    def __init__(self, cache_size: int = 256) -> None:
+        """
+        Parameters
+        ----------
+        cache_size: int
+            The maximum number of parsed public keys to keep
+        """
+        if cache_size < 1:
+            raise ValueError("cache_size must be at least 1")
+        self.cache_size = cache_size
+        self._keys: OrderedDict[bytes, VerifyingKey | None] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, digest: bytes, sig: bytes, pubkey: bytes) -> int:
+        """
+        Checks the ECDSA signature given a hash and the ECDSA public key of the signer, as CryptoKey.verify. Unlike the
+        device, a malformed public key or signature gives an error code (ERR_ECP_INVALID_KEY or ERR_ECP_BAD_INPUT_DATA)
+
+        Parameters
+        ----------
+        digest: bytes
+            The SHA256 hash for the original data
+        sig: bytes
+            The ECDSA signature
+        pubkey: bytes
+            The signer's public key
+
+        Returns
+        -------
+        int
+            0 if the signature verifies
+            4294947328 (-0x480) if not
+            any other nonzero value indicates an error
+        """
+        return verify_signature(self._key(bytes(pubkey)), digest, sig) % 2**32
+
+    def verify_many(
+        self, items: Iterable[tuple[bytes, bytes, bytes]], processes: int | None = 1, chunksize: int = 256
+    ) -> list[int]:
+        """
+        Checks a batch of signatures, optionally using multiple processes
+
+        Parameters
+        ----------
+        items: Iterable[tuple[bytes, bytes, bytes]]
+            (digest, signature, public key) for each signature
+        processes: int | None
+            The number of worker processes, None for one per CPU. Small batches are verified in this process
+        chunksize: int
+            The number of signatures sent to a worker at a time
+
+        Returns
+        -------
+        list[int]
+            The result code for each signature, in order
+        """
+        items = list(items)
+        processes = processes or os.cpu_count() or 1
+        if processes == 1 or len(items) <= chunksize:
+            return [self.verify(*item) for item in items]
+        with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(self.cache_size,)) as executor:
+            return list(executor.map(_verify_in_worker, items, chunksize=chunksize))
+
+    def _key(self, pubkey: bytes) -> VerifyingKey | None:
+        if pubkey in self._keys:
+            self.hits += 1
+            self._keys.move_to_end(pubkey)
+            return self._keys[pubkey]
+        self.misses += 1
+        verifying_key = self._keys[pubkey] = parse_pubkey(pubkey)
+        if len(self._keys) > self.cache_size:
+            self._keys.popitem(last=False)
+        return verifying_key
+
+
+# each worker process has its own key cache
+_worker_verifier: Verifier | None = None
+
+
+def _init_worker(cache_size: int) -> None:
+    global _worker_verifier
+    _worker_verifier = Verifier(cache_size)
+
+
+def _verify_in_worker(item: tuple[bytes, bytes, bytes]) -> int:
+    assert _worker_verifier is not None
+    return _worker_verifier.verify(*item)
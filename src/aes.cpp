@@ -1,69 +1,99 @@
 
 #include "aes.h"
+#include "core1.h"
 #include "error.h"
+#include "profile.h"
 #include "usb_cdc.h"
 #include "utils.h"
 
 #include <string>
 
 namespace {
-ErrorMapper error(ErrorMapper::AES, {MBEDTLS_ERR_AES_INVALID_KEY_LENGTH});
-}
-
-void aes::key(const bytes& raw, mbedtls_aes_context& aes_key) {
-  // according to doc, you use the "enc" function to create a key for both encryption and decryption
-  error.check(mbedtls_aes_setkey_enc(&aes_key, raw.data(), KEY_BITS));
-}
-
-void aes::decrypt_in(const mbedtls_aes_context& key) {
-  bytes iv(16, 0);
-
-  bytes ciphertext(cdc::CHUNK_SIZE);
-  bytes plaintext(cdc::CHUNK_SIZE);
+ErrorMapper error(ErrorMapper::AES, {MBEDTLS_ERR_AES_INVALID_KEY_LENGTH, MBEDTLS_ERR_GCM_BAD_INPUT});
 
+// streams chunks of (length-prefixed) input through f(data, length), which transforms them in place on core 1, to the
+// output
+template <typename F> void transform_in(F&& f) {
   // 4 byte header containing length of data
   uint32_t length;
   cdc::read(length);
+  core1::stream(length, f);
+}
 
-  while (length) {
-    uint32_t chunk_length = length < cdc::CHUNK_SIZE ? length : cdc::CHUNK_SIZE;
-    uint32_t bytes_read = cdc::read(ciphertext, chunk_length);
-
-    int ret = mbedtls_aes_crypt_cfb8(const_cast<mbedtls_aes_context*>(&key), MBEDTLS_AES_DECRYPT, bytes_read, iv.data(),
-                                     ciphertext.data(), plaintext.data());
-    if (ret != 0) {
-      cdc::write("aes err %%"s % ret);
-      return;
-    }
+void cfb8_in(const mbedtls_aes_context& key, int mode) {
+  bytes iv(16, 0);
+  transform_in([&key, &iv, mode](byte* data, uint32_t length) {
+    // in-place is safe as each input byte is read before the output byte is written
+    error.check(
+        mbedtls_aes_crypt_cfb8(const_cast<mbedtls_aes_context*>(&key), mode, length, iv.data(), data, data));
+  });
+}
 
-    /*bytes_written +=*/cdc::write(plaintext, chunk_length);
-    length -= chunk_length;
+void gcm_in(mbedtls_gcm_context& key, int mode) {
+  bytes nonce(aes::NONCE_BYTES);
+  cdc::read(nonce);
+  {
+    profile::Timer timer(profile::current.compute_us);
+    error.check(mbedtls_gcm_starts(&key, mode, nonce.data(), nonce.size()));
   }
+  transform_in([&key](byte* data, uint32_t length) {
+    size_t output_length;
+    error.check(mbedtls_gcm_update(&key, data, length, data, length, &output_length));
+  });
+}
+} // namespace
 
+void aes::key(const bytes& raw, mbedtls_aes_context& aes_key) {
+  // according to doc, you use the "enc" function to create a key for both encryption and decryption
+  error.check(mbedtls_aes_setkey_enc(&aes_key, raw.data(), KEY_BITS));
 }
 
-void aes::encrypt_in(const mbedtls_aes_context& key) {
-  bytes iv(16, 0);
+void aes::key(const bytes& raw, mbedtls_gcm_context& gcm_key) {
+  error.check(mbedtls_gcm_setkey(&gcm_key, MBEDTLS_CIPHER_ID_AES, raw.data(), KEY_BITS));
+}
 
-  bytes plaintext(cdc::CHUNK_SIZE);
-  bytes ciphertext(cdc::CHUNK_SIZE);
+void aes::decrypt_in(const mbedtls_aes_context& key) { cfb8_in(key, MBEDTLS_AES_DECRYPT); }
 
-  // 4 byte header containing length of data
-  uint32_t length;
-  cdc::read(length);
+void aes::encrypt_in(const mbedtls_aes_context& key) { cfb8_in(key, MBEDTLS_AES_ENCRYPT); }
+
+void aes::ctr_in(const mbedtls_aes_context& key) {
+  // nonce followed by 32 bit block counter
+  bytes nonce_counter(16, 0);
+  cdc::read(nonce_counter, NONCE_BYTES);
+  bytes stream_block(16);
+  size_t offset = 0;
 
-  while (length) {
-    uint32_t chunk_length = length < cdc::CHUNK_SIZE ? length : cdc::CHUNK_SIZE;
-    uint32_t bytes_read = cdc::read(plaintext, chunk_length);
+  transform_in([&](byte* data, uint32_t length) {
+    error.check(mbedtls_aes_crypt_ctr(const_cast<mbedtls_aes_context*>(&key), length, &offset, nonce_counter.data(),
+                                      stream_block.data(), data, data));
+  });
+}
 
-    int ret = mbedtls_aes_crypt_cfb8(const_cast<mbedtls_aes_context*>(&key), MBEDTLS_AES_ENCRYPT, bytes_read, iv.data(),
-                                     plaintext.data(), ciphertext.data());
-    if (ret != 0) {
-      cdc::write("aes err %%"s % ret);
-      return;
-    }
+void aes::gcm_encrypt_in(mbedtls_gcm_context& key) {
+  gcm_in(key, MBEDTLS_GCM_ENCRYPT);
+  bytes tag(TAG_BYTES);
+  size_t output_length;
+  {
+    profile::Timer timer(profile::current.compute_us);
+    error.check(mbedtls_gcm_finish(&key, nullptr, 0, &output_length, tag.data(), tag.size()));
+  }
+  cdc::write(tag);
+}
 
-    /*bytes_written +=*/cdc::write(ciphertext, chunk_length);
-    length -= chunk_length;
+bool aes::gcm_decrypt_in(mbedtls_gcm_context& key) {
+  gcm_in(key, MBEDTLS_GCM_DECRYPT);
+  bytes expected(TAG_BYTES);
+  size_t output_length;
+  {
+    profile::Timer timer(profile::current.compute_us);
+    error.check(mbedtls_gcm_finish(&key, nullptr, 0, &output_length, expected.data(), expected.size()));
+  }
+  bytes tag(TAG_BYTES);
+  cdc::read(tag);
+  // constant time comparison
+  byte diff = 0;
+  for (size_t i = 0; i < TAG_BYTES; ++i) {
+    diff |= tag[i] ^ expected[i];
   }
+  return diff == 0;
 }
@@ -3,17 +3,31 @@
 #include "utils.h"
 
 #include "mbedtls/aes.h"
+#include "mbedtls/gcm.h"
 
 namespace aes {
 
 const size_t KEY_BITS = 256;
+const size_t NONCE_BYTES = 12;
+const size_t TAG_BYTES = 16;
 
 void key(const bytes& raw, mbedtls_aes_context& aes_key);
 
+void key(const bytes& raw, mbedtls_gcm_context& gcm_key);
+
 // decrypt stdin and output to stdout
 void decrypt_in(const mbedtls_aes_context& key);
 
 // encrypt stdin and output to stdout
 void encrypt_in(const mbedtls_aes_context& key);
 
-}
\ No newline at end of file
+// encrypt or decrypt (the same operation) stdin in CTR mode and output to stdout
+void ctr_in(const mbedtls_aes_context& key);
+
+// encrypt stdin in GCM mode and output to stdout, followed by the tag
+void gcm_encrypt_in(mbedtls_gcm_context& key);
+
+// decrypt stdin in GCM mode and output to stdout, then check the tag, returning false if it doesn't match
+bool gcm_decrypt_in(mbedtls_gcm_context& key);
+
+}
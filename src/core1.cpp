@@ -0,0 +1,45 @@
+#include "core1.h"
+
+#include "pico/flash.h"
+#include "pico/multicore.h"
+#include "pico/util/queue.h"
+
+namespace {
+
+struct Job {
+  void (*f)(void*);
+  void* context;
+};
+
+queue_t jobs;
+queue_t done;
+
+void main1() {
+  // allow core 0 to pause this core while it writes to flash
+  flash_safe_execute_core_init();
+  for (;;) {
+    Job job;
+    queue_remove_blocking(&jobs, &job);
+    job.f(job.context);
+    bool finished = true;
+    queue_add_blocking(&done, &finished);
+  }
+}
+
+} // namespace
+
+void core1::launch() {
+  queue_init(&jobs, sizeof(Job), 1);
+  queue_init(&done, sizeof(bool), 1);
+  multicore_launch_core1(main1);
+}
+
+void core1::start(void (*f)(void*), void* context) {
+  Job job{f, context};
+  queue_add_blocking(&jobs, &job);
+}
+
+void core1::join() {
+  bool finished;
+  queue_remove_blocking(&done, &finished);
+}
@@ -0,0 +1,55 @@
+#pragma once
+
+#include "pipeline.h"
+
+// Runs jobs on the second core. Jobs are handed over (and completions signalled) with SDK queues rather than the raw
+// inter-core FIFO, which is reserved for the lockout that pauses core 1 while flash is written
+namespace core1 {
+
+// Starts the worker loop on core 1 (once, at startup)
+void launch();
+
+// Runs f(context) on core 1, returning immediately
+void start(void (*f)(void*), void* context);
+
+// Waits for the job passed to start to finish
+void join();
+
+// Streams length bytes of CDC input through process(data, length) on core 1, writing each processed chunk back unless
+// output is false
+template <typename Process> void stream(uint32_t length, Process&& process, bool output = true);
+
+} // namespace core1
+
+#include "profile.h"
+#include "usb_cdc.h"
+
+#include "pico/stdlib.h"
+
+template <typename Process> void core1::stream(uint32_t length, Process&& process, bool output) {
+  pipeline::Ring<pipeline::SLOTS> ring(cdc::chunk_size());
+  const uint32_t count = pipeline::chunks(length, ring.chunk_size());
+
+  struct Job {
+    pipeline::Ring<pipeline::SLOTS>& ring;
+    uint32_t count;
+    Process& process;
+  } job{ring, count, process};
+
+  start(
+      [](void* context) {
+        Job& job = *static_cast<Job*>(context);
+        pipeline::consume(
+            job.ring, job.count,
+            [&job](byte* data, uint32_t length) {
+              profile::Timer timer(profile::current.compute_us);
+              job.process(data, length);
+            },
+            [] { tight_loop_contents(); });
+      },
+      &job);
+  pipeline::produce(
+      ring, length, cdc::read_some,
+      [output](const byte* data, uint32_t length) { return output ? cdc::write_some(data, length) : length; }, tud_task);
+  join();
+}
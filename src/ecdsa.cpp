@@ -1,6 +1,8 @@
 
 #include "ecdsa.h"
 #include "error.h"
+#include "profile.h"
+#include "sha256.h"
 
 #include "mbedtls/ecdsa.h"
 #include "mbedtls/ecp.h"
@@ -58,11 +60,13 @@ extern "C" int minstd_rand(void*, byte* p, size_t n) {
 } // namespace
 
 void ecdsa::key(const bytes& rawkey, mbedtls_ecp_keypair& ec_key) {
+  profile::Timer timer(profile::current.compute_us);
   error.check(mbedtls_ecp_read_key(MBEDTLS_ECP_DP_SECP256K1, &ec_key, rawkey.data(), rawkey.size()));
   error.check(mbedtls_ecp_mul(&ec_key.grp, &ec_key.Q, &ec_key.d, &ec_key.grp.G, minstd_rand, nullptr));
 }
 
 bytes ecdsa::pubkey(const mbedtls_ecp_keypair& ec_key) {
+  profile::Timer timer(profile::current.compute_us);
   bytes pubkey(FULL_FORM_PUBKEY_LENGTH);
   size_t outlen;
 
@@ -73,7 +77,16 @@ bytes ecdsa::pubkey(const mbedtls_ecp_keypair& ec_key) {
   return pubkey;
 }
 
+bytes ecdsa::fingerprint(const mbedtls_ecp_keypair& ec_key) {
+  bytes pubkey(FULL_FORM_PUBKEY_LENGTH);
+  size_t outlen;
+  error.check(mbedtls_ecp_point_write_binary(&ec_key.grp, &ec_key.Q, MBEDTLS_ECP_PF_COMPRESSED, &outlen, pubkey.data(),
+                                             pubkey.size()));
+  return sha256::hash(pubkey);
+}
+
 bytes ecdsa::sign(const mbedtls_ecp_keypair& key, const bytes& hash) {
+  profile::Timer timer(profile::current.compute_us);
   wrap<mbedtls_mpi> r(mbedtls_mpi_init, mbedtls_mpi_free);
   wrap<mbedtls_mpi> s(mbedtls_mpi_init, mbedtls_mpi_free);
 
@@ -89,6 +102,7 @@ bytes ecdsa::sign(const mbedtls_ecp_keypair& key, const bytes& hash) {
 }
 
 int ecdsa::verify(const bytes& hash, const bytes& sig, const bytes& pubkey) {
+  profile::Timer timer(profile::current.compute_us);
   // context is keypair typedef. needs to be initialised with group and pubkey
   wrap<mbedtls_ecdsa_context> ec_key(mbedtls_ecdsa_init, mbedtls_ecdsa_free);
 
@@ -13,6 +13,9 @@ void key(const bytes& rawkey, mbedtls_ecp_keypair& ec_key);
 
 bytes pubkey(const mbedtls_ecp_keypair& ec_key);
 
+// SHA256 of the (compressed) public key, identifies the device without the consistency check pubkey() does
+bytes fingerprint(const mbedtls_ecp_keypair& ec_key);
+
 bytes sign(const mbedtls_ecp_keypair& key, const bytes& hash);
 
 // zero for success
@@ -2,7 +2,7 @@
 #include "flash.h"
 
 #include <hardware/flash.h>
-#include <hardware/sync.h> // for interrupts
+#include <pico/flash.h> // for flash_safe_execute
 
 #include <algorithm>
 #include <pico/stdlib.h>
@@ -18,14 +18,26 @@ const uint32_t sectors_from_end = 1;
 #endif
 const uint32_t storage_offset = PICO_FLASH_SIZE_BYTES - sectors_from_end * FLASH_SECTOR_SIZE;
 const uint8_t* storage_address = reinterpret_cast<uint8_t*>(XIP_BASE + storage_offset);
+
+struct Program {
+  const uint8_t* data;
+  uint32_t length;
+};
+
+// runs with interrupts disabled and (if it's running) core 1 paused, as neither can execute from flash meanwhile
+void program(void* param) {
+  const Program* p = static_cast<const Program*>(param);
+  flash_range_erase(storage_offset, p->length);
+  flash_range_program(storage_offset, p->data, p->length);
+}
 } // namespace
 
 uint32_t flash::write(const bytes& b) {
   uint32_t length = std::min(b.size(), FLASH_SECTOR_SIZE);
-  uint32_t ints = save_and_disable_interrupts();
-  flash_range_erase(storage_offset, length);
-  flash_range_program(storage_offset, b.data(), length);
-  restore_interrupts(ints);
+  Program p{b.data(), length};
+  if (flash_safe_execute(program, &p, UINT32_MAX) != PICO_OK) {
+    return -1u;
+  }
   // now read to confirm
   bytes check = flash::read(length);
   return b == check ? 0 : -1u; // this will be nonzero if b longer than FLASH_SECTOR_SIZE
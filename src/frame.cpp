@@ -0,0 +1,32 @@
+#include "frame.h"
+
+#include <cstring>
+
+uint32_t frame::crc32(const byte* data, uint32_t length, uint32_t crc) {
+  crc = ~crc;
+  for (uint32_t i = 0; i < length; ++i) {
+    crc ^= data[i];
+    for (int bit = 0; bit < 8; ++bit) {
+      crc = (crc >> 1) ^ (0xedb88320 & -(crc & 1));
+    }
+  }
+  return ~crc;
+}
+
+bool frame::framed(uint8_t cmd) { return cmd && std::strchr("kgvraczlufFi", cmd); }
+
+bytes frame::header(uint8_t version, uint8_t opcode, uint8_t status, uint16_t id, uint32_t length) {
+  // fields are little-endian
+  return bytes{'T', version, opcode, status, byte(id), byte(id >> 8),
+               byte(length), byte(length >> 8), byte(length >> 16), byte(length >> 24)};
+}
+
+void frame::respond(uint8_t opcode, Status status, uint16_t id, const bytes& payload) {
+  bytes response = header(VERSION, opcode, uint8_t(status), id, payload.size());
+  response.reserve(response.size() + payload.size() + sizeof(uint32_t));
+  response.insert(response.end(), payload.begin(), payload.end());
+  uint32_t checksum = crc32(response.data(), response.size());
+  const byte* p = reinterpret_cast<const byte*>(&checksum);
+  response.insert(response.end(), p, p + sizeof(checksum));
+  cdc::write(response);
+}
@@ -0,0 +1,77 @@
+#pragma once
+
+#include "usb_cdc.h"
+#include "utils.h"
+
+// Tagged frames: a command sent as 'T', version[1], opcode[1], status[1], id[2], length[4], payload, crc32[4], where the
+// payload is the command's input and the crc32 (as zlib's) covers everything before it. The response frame has the same
+// layout, with the request's opcode and id, and the command's output as payload. Frames are self-contained, so several
+// can be queued by the host, and are interleaved with untagged commands on the same stream
+namespace frame {
+
+constexpr uint8_t VERSION = 1;
+
+// larger frames are rejected without reading the payload
+constexpr uint32_t MAX_PAYLOAD = cdc::MAX_CHUNK_SIZE;
+
+enum class Status : uint8_t { OK = 0, INVALID_CMD = 2, BAD_CHECKSUM = 3, BAD_FRAME = 4 };
+
+// CRC-32 (as zlib), continuing from a previous value
+uint32_t crc32(const byte* data, uint32_t length, uint32_t crc = 0);
+
+// Whether a command can be framed: its input and output are small and not streamed, and it doesn't end the session
+bool framed(uint8_t cmd);
+
+// Reads a frame (after its 'T'), runs execute(opcode) with its I/O redirected to the payload and writes the response.
+// A bad checksum, or a command that doesn't read exactly the payload, gives an error status and an empty response
+template <typename Execute> void handle(Execute&& execute);
+
+// The header of a frame, as sent
+bytes header(uint8_t version, uint8_t opcode, uint8_t status, uint16_t id, uint32_t length);
+
+// Writes a response frame
+void respond(uint8_t opcode, Status status, uint16_t id, const bytes& payload);
+
+} // namespace frame
+
+template <typename Execute> void frame::handle(Execute&& execute) {
+  uint8_t version, opcode, status;
+  uint16_t id;
+  uint32_t length;
+  cdc::read(version);
+  cdc::read(opcode);
+  cdc::read(status);
+  cdc::read(id);
+  cdc::read(length);
+  if (version != VERSION || length > MAX_PAYLOAD) {
+    // can't tell where the frame ends
+    respond(opcode, Status::BAD_FRAME, id, bytes());
+    return;
+  }
+  bytes payload(length);
+  cdc::read(payload);
+  uint32_t checksum;
+  cdc::read(checksum);
+
+  const bytes& received = header(version, opcode, status, id, length);
+  if (crc32(payload.data(), payload.size(), crc32(received.data(), received.size())) != checksum) {
+    respond(opcode, Status::BAD_CHECKSUM, id, bytes());
+    return;
+  }
+  if (!framed(opcode)) {
+    respond(opcode, Status::INVALID_CMD, id, bytes());
+    return;
+  }
+  bytes output;
+  bool consumed;
+  {
+    cdc::Capture capture(payload, output);
+    execute(opcode);
+    consumed = capture.consumed();
+  }
+  if (!consumed) {
+    respond(opcode, Status::BAD_FRAME, id, bytes());
+    return;
+  }
+  respond(opcode, Status::OK, id, output);
+}
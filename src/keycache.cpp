@@ -0,0 +1,49 @@
+#include "keycache.h"
+#include "ecdsa.h"
+
+#include <algorithm>
+#include <list>
+#include <memory>
+
+namespace {
+
+struct Entry {
+  bytes id;
+  std::unique_ptr<wrap<mbedtls_ecp_keypair>> key;
+};
+
+// most recently used first
+std::list<Entry> entries;
+uint32_t hit_count = 0;
+uint32_t miss_count = 0;
+
+} // namespace
+
+const mbedtls_ecp_keypair& keycache::get(const bytes& id, bytes (*derive)(const bytes&)) {
+  auto it = std::find_if(entries.begin(), entries.end(), [&id](const Entry& entry) { return entry.id == id; });
+  if (it != entries.end()) {
+    ++hit_count;
+    entries.splice(entries.begin(), entries, it);
+  } else {
+    ++miss_count;
+    auto key = std::make_unique<wrap<mbedtls_ecp_keypair>>(mbedtls_ecp_keypair_init, mbedtls_ecp_keypair_free);
+    ecdsa::key(derive(id), **key);
+    if (entries.size() == CAPACITY) {
+      entries.pop_back();
+    }
+    entries.push_front(Entry{id, std::move(key)});
+  }
+  return **entries.front().key;
+}
+
+void keycache::clear() {
+  entries.clear();
+  hit_count = 0;
+  miss_count = 0;
+}
+
+uint32_t keycache::hits() { return hit_count; }
+
+uint32_t keycache::misses() { return miss_count; }
+
+uint32_t keycache::size() { return entries.size(); }
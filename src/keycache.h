@@ -0,0 +1,30 @@
+#pragma once
+
+#include "utils.h"
+
+#include "mbedtls/ecp.h"
+
+// LRU cache of derived (webauthn) ECDSA keypairs, keyed by user@rp, so repeated register/auth calls for the same
+// identity skip the key derivation and scalar multiplication
+namespace keycache {
+
+// The cache is bounded by the number of entries, not their size. Each entry's heap use is that of its keypair: the
+// private and public keys, and the group, which (secp256k1's constants being static) is mostly the comb table of
+// multiples of the generator built by the first multiplication, 2^(MBEDTLS_ECP_WINDOW_SIZE - 1) points of three
+// 256-bit numbers. Allowing for MPIs over-allocated by intermediate results, and allocator overhead, that's at most
+// ~3kB (an estimate, not measured on the device), so 8 entries take under 24kB, a small fraction of the RP2040's 264kB
+// RAM
+constexpr uint32_t CAPACITY = 8;
+
+// Returns the keypair for the id, deriving it from derive(id) (and evicting the least recently used entry) if needed
+const mbedtls_ecp_keypair& get(const bytes& id, bytes (*derive)(const bytes&));
+
+// Frees all entries (private keys are zeroed) and resets the counters
+void clear();
+
+// Counters since the cache was last cleared
+uint32_t hits();
+uint32_t misses();
+uint32_t size();
+
+} // namespace keycache
@@ -1,8 +1,12 @@
 #include "aes.h"
 #include "board.h"
+#include "core1.h"
 #include "ecdsa.h"
 #include "error.h"
+#include "frame.h"
+#include "keycache.h"
 #include "pin.h"
+#include "profile.h"
 #include "sha256.h"
 #include "usb_cdc.h"
 #include "utils.h"
@@ -48,106 +52,225 @@ void append_timestamp(bytes& challenge) {
   challenge.insert(challenge.end(), p, p + sizeof(timestamp));
 }
 
-void repl(const wrap<mbedtls_ecp_keypair>& ec_key, const wrap<mbedtls_aes_context>& aes_key) {
+// runs a command, returns false if it ends the session
+bool execute(uint8_t cmd, const wrap<mbedtls_ecp_keypair>& ec_key, const wrap<mbedtls_aes_context>& aes_key,
+             wrap<mbedtls_gcm_context>& gcm_key) {
+  switch (cmd) {
+  // reset repl
+  case 'x': {
+    keycache::clear();
+    board::clear();
+    return false;
+  }
+  // write pin
+  case 'p': {
+    keycache::clear();
+    cdc::write(pin::set());
+    break;
+  }
+  // get ECDSA public key
+  case 'k': {
+    cdc::write(ecdsa::pubkey(*ec_key));
+    break;
+  }
+  // hash input
+  case 'h': {
+    bytes hash = sha256::hash_in();
+    cdc::write(hash);
+    break;
+  }
+  // hash many: length[4] then data for each item, ending with a length of END_OF_ITEMS. Writes each hash[32] as soon
+  // as it's computed
+  case 'H': {
+    for (;;) {
+      uint32_t length;
+      cdc::read(length);
+      if (length == sha256::END_OF_ITEMS) {
+        break;
+      }
+      cdc::write(sha256::hash_in(length));
+    }
+    break;
+  }
+  // decrypt input
+  case 'd': {
+    aes::decrypt_in(*aes_key);
+    break;
+  }
+  // encrypt input
+  case 'e': {
+    aes::encrypt_in(*aes_key);
+    break;
+  }
+  // encrypt/decrypt input in CTR mode: nonce[12], length[4], data
+  case 't': {
+    aes::ctr_in(*aes_key);
+    break;
+  }
+  // encrypt input in GCM mode: nonce[12], length[4], data. Writes the tag[16] after the ciphertext
+  case 'E': {
+    aes::gcm_encrypt_in(*gcm_key);
+    break;
+  }
+  // decrypt input in GCM mode: nonce[12], length[4], data, then tag[16]. Writes 0 if the tag matches, 1 otherwise
+  case 'D': {
+    cdc::write(uint32_t(aes::gcm_decrypt_in(*gcm_key) ? 0 : 1));
+    break;
+  }
+  // hash input and sign
+  case 's': {
+    bytes hash = sha256::hash_in();
+    cdc::write(hash);
+    bytes sig = ecdsa::sign(*ec_key, hash);
+    cdc::write_with_length(sig);
+    break;
+  }
+  // sign a precomputed hash: hash[32], writes len(sig)[4], sig
+  case 'g': {
+    bytes hash(sha256::LENGTH_BYTES);
+    cdc::read(hash);
+    cdc::write_with_length(ecdsa::sign(*ec_key, hash));
+    break;
+  }
+  // sign many: count[4], then per item either 'h' followed by length-prefixed data to hash, or 'd' followed by a
+  // digest[32]. Writes hash[32], len(sig)[4], sig for each item as soon as it's signed
+  case 'm': {
+    uint32_t count;
+    cdc::read(count);
+    bytes hash(sha256::LENGTH_BYTES);
+    for (uint32_t i = 0; i < count; ++i) {
+      char type;
+      cdc::read(type);
+      if (type == 'h') {
+        hash = sha256::hash_in();
+      } else {
+        cdc::read(hash);
+      }
+      cdc::write(hash);
+      cdc::write_with_length(ecdsa::sign(*ec_key, hash));
+    }
+    break;
+  }
+  // verify hash and signature
+  case 'v': {
+    // hash[32], len(sig)[4], sig, len(key)[4], key
+    bytes hash(sha256::LENGTH_BYTES);
+    cdc::read(hash);
+    bytes sig = cdc::read_with_length();
+    bytes pubkey = cdc::read_with_length();
+    // 4-byte int, 0 is success
+    cdc::write(ecdsa::verify(hash, sig, pubkey));
+    break;
+  }
+  // webauthn register: generate keypair from user and relying party ids, return public key
+  case 'r': {
+    bytes rp = cdc::read_with_length();
+    cdc::write(ecdsa::pubkey(keycache::get(rp, genkey)));
+    break;
+  }
+  // webauthn authenticate: read id, generate keypair, read challenge bytes, append timestamp, hash, sign
+  case 'a': {
+    // generate keypair
+    bytes rp = cdc::read_with_length();
+    const mbedtls_ecp_keypair& webauthn_key = keycache::get(rp, genkey);
+    bytes challenge = cdc::read_with_length();
+    // append timestamp bytes
+    append_timestamp(challenge);
+    // hash and sign
+    bytes hash = sha256::hash(challenge);
+    bytes sig = ecdsa::sign(webauthn_key, hash);
+    // write signature
+    cdc::write_with_length(sig);
+    break;
+  }
+  // transfer capabilities: current and max chunk sizes, USB buffer sizes
+  case 'c': {
+    cdc::write(4 * sizeof(uint32_t));
+    cdc::write(cdc::chunk_size());
+    cdc::write(cdc::MAX_CHUNK_SIZE);
+    cdc::write(uint32_t(CFG_TUD_CDC_RX_BUFSIZE));
+    cdc::write(uint32_t(CFG_TUD_CDC_TX_BUFSIZE));
+    break;
+  }
+  // set chunk size for streamed input, returns the size actually set
+  case 'z': {
+    uint32_t size;
+    cdc::read(size);
+    cdc::write(cdc::set_chunk_size(size));
+    break;
+  }
+  // webauthn keypair cache statistics: hits, misses, size, capacity
+  case 'l': {
+    cdc::write(4 * sizeof(uint32_t));
+    cdc::write(keycache::hits());
+    cdc::write(keycache::misses());
+    cdc::write(keycache::size());
+    cdc::write(keycache::CAPACITY);
+    break;
+  }
+  // device identifier (hash of public key)
+  case 'u': {
+    cdc::write_with_length(ecdsa::fingerprint(*ec_key));
+    break;
+  }
+  // profiling counters per command since the session started (or they were last reset)
+  case 'f': {
+    profile::write();
+    break;
+  }
+  // profiling counters, then reset them
+  case 'F': {
+    profile::write();
+    profile::clear();
+    break;
+  }
+  // board info
+  case 'i': {
+    cdc::write(VER.size() + sizeof(uint64_t));
+    cdc::write(VER);
+    cdc::write(get_time_ms());
+    break;
+  }
+  // framed protocol versions supported
+  case 'q': {
+    cdc::write(sizeof(uint32_t));
+    cdc::write(uint32_t(frame::VERSION));
+    break;
+  }
+  // tagged frame containing a (non-streamed) command, see frame.h
+  case 'T': {
+    frame::handle([&](uint8_t opcode) { execute(opcode, ec_key, aes_key, gcm_key); });
+    break;
+  }
+  default: {
+    board::invalid();
+    cdc::write(ErrorCode::INVALID_CMD);
+    sleep_ms(500);
+  }
+  }
+  return true;
+}
+
+void repl(const wrap<mbedtls_ecp_keypair>& ec_key, const wrap<mbedtls_aes_context>& aes_key,
+          wrap<mbedtls_gcm_context>& gcm_key) {
   uint8_t cmd;
   for (;;) {
     board::ready();
     cdc::read(cmd);
     board::busy();
-    switch (cmd) {
-    // reset repl
-    case 'x': {
-      board::clear();
+    profile::begin(cmd);
+    if (!execute(cmd, ec_key, aes_key, gcm_key)) {
       return;
     }
-    // write pin
-    case 'p': {
-      cdc::write(pin::set());
-      break;
-    }
-    // get ECDSA public key
-    case 'k': {
-      cdc::write(ecdsa::pubkey(*ec_key));
-      break;
-    }
-    // hash input
-    case 'h': {
-      bytes hash = sha256::hash_in();
-      cdc::write(hash);
-      break;
-    }
-    // decrypt input
-    case 'd': {
-      aes::decrypt_in(*aes_key);
-      break;
-    }
-    // encrypt input
-    case 'e': {
-      aes::encrypt_in(*aes_key);
-      break;
-    }
-    // hash input and sign
-    case 's': {
-      bytes hash = sha256::hash_in();
-      cdc::write(hash);
-      bytes sig = ecdsa::sign(*ec_key, hash);
-      cdc::write_with_length(sig);
-      break;
-    }
-    // verify hash and signature
-    case 'v': {
-      // hash[32], len(sig)[4], sig, len(key)[4], key
-      bytes hash(sha256::LENGTH_BYTES);
-      cdc::read(hash);
-      bytes sig = cdc::read_with_length();
-      bytes pubkey = cdc::read_with_length();
-      // 4-byte int, 0 is success
-      cdc::write(ecdsa::verify(hash, sig, pubkey));
-      break;
-    }
-    // webauthn register: generate keypair from user and relying party ids, return public key
-    case 'r': {
-      bytes rp = cdc::read_with_length();
-      wrap<mbedtls_ecp_keypair> webauthn_key(mbedtls_ecp_keypair_init, mbedtls_ecp_keypair_free);
-      ecdsa::key(genkey(rp), *webauthn_key);
-      cdc::write(ecdsa::pubkey(*webauthn_key));
-      break;
-    }
-    // webauthn authenticate: read id, generate keypair, read challenge bytes, append timestamp, hash, sign
-    case 'a': {
-      // generate keypair
-      bytes rp = cdc::read_with_length();
-      wrap<mbedtls_ecp_keypair> webauthn_key(mbedtls_ecp_keypair_init, mbedtls_ecp_keypair_free);
-      ecdsa::key(genkey(rp), *webauthn_key);
-      bytes challenge = cdc::read_with_length();
-      // append timestamp bytes
-      append_timestamp(challenge);
-      // hash and sign
-      bytes hash = sha256::hash(challenge);
-      bytes sig = ecdsa::sign(*webauthn_key, hash);
-      // write signature
-      cdc::write_with_length(sig);
-      break;
-    }
-    // board info
-    case 'i': {
-      cdc::write(VER.size() + sizeof(uint64_t));
-      cdc::write(VER);
-      cdc::write(get_time_ms());
-      break;
-    }
-    default: {
-      board::invalid();
-      cdc::write(ErrorCode::INVALID_CMD);
-      sleep_ms(500);
-    }
-    }
+    profile::end();
   }
 }
 
 int main() {
   tusb_init();
   board::init();
+  // streamed input is processed on core 1 while core 0 services USB
+  core1::launch();
 
   for (;;) {
     while (!pin::check()) {
@@ -171,8 +294,15 @@ int main() {
     wrap<mbedtls_aes_context> aes_key(mbedtls_aes_init, mbedtls_aes_free);
     aes::key(key, *aes_key);
 
+    wrap<mbedtls_gcm_context> gcm_key(mbedtls_gcm_init, mbedtls_gcm_free);
+    aes::key(key, *gcm_key);
+
+    // each session starts with the default chunk size and no profile
+    cdc::set_chunk_size(cdc::DEFAULT_CHUNK_SIZE);
+    profile::clear();
+
     // accept commands until reset
-    repl(ec_key, aes_key);
+    repl(ec_key, aes_key, gcm_key);
 
     sleep_ms(250);
   }
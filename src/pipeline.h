@@ -0,0 +1,143 @@
+#pragma once
+
+// Producer/consumer pipeline for streamed input. Core 0 keeps the USB FIFOs busy, reading chunks into a ring of slots
+// and writing processed slots back out, while core 1 processes the chunks in between. Nothing here depends on the
+// Pico SDK so it can be compiled and tested on the host (see test/firmware/test_pipeline.cpp)
+
+#include "utils.h"
+
+#include <algorithm>
+#include <atomic>
+#include <cstdint>
+
+namespace pipeline {
+
+// Enough slots for a chunk to be read, another processed and a third written at the same time
+constexpr uint32_t SLOTS = 3;
+
+// Single producer/single consumer ring of chunk buffers. Each slot moves through three stages in order: filled (by
+// core 0), processed in place (by core 1) and drained (by core 0). Each count is only modified by the stage that owns
+// it, so no locks are needed
+template <uint32_t N> class Ring final {
+public:
+  explicit Ring(uint32_t chunk_size) : m_chunk_size(chunk_size), m_storage(N * chunk_size), m_lengths{} {}
+
+  Ring(const Ring&) = delete;
+  Ring& operator=(const Ring&) = delete;
+
+  uint32_t chunk_size() const { return m_chunk_size; }
+
+  // Next slot to fill, or nullptr if all slots are in use
+  byte* fill_slot() {
+    uint32_t filled = m_filled.load(std::memory_order_relaxed);
+    return filled - m_drained.load(std::memory_order_acquire) < N ? slot(filled) : nullptr;
+  }
+
+  // Hand the slot returned by fill_slot, containing length bytes, to the processing stage
+  void filled(uint32_t length) {
+    uint32_t filled = m_filled.load(std::memory_order_relaxed);
+    m_lengths[filled % N] = length;
+    m_filled.store(filled + 1, std::memory_order_release);
+  }
+
+  // Next slot to process and its length, or nullptr if there's none ready
+  byte* process_slot(uint32_t& length) {
+    uint32_t processed = m_processed.load(std::memory_order_relaxed);
+    if (processed == m_filled.load(std::memory_order_acquire)) {
+      return nullptr;
+    }
+    length = m_lengths[processed % N];
+    return slot(processed);
+  }
+
+  // Hand the slot returned by process_slot to the drain stage
+  void processed() { m_processed.store(m_processed.load(std::memory_order_relaxed) + 1, std::memory_order_release); }
+
+  // Next slot to drain and its length, or nullptr if there's none ready
+  const byte* drain_slot(uint32_t& length) {
+    uint32_t drained = m_drained.load(std::memory_order_relaxed);
+    if (drained == m_processed.load(std::memory_order_acquire)) {
+      return nullptr;
+    }
+    length = m_lengths[drained % N];
+    return slot(drained);
+  }
+
+  // Return the slot returned by drain_slot to the fill stage
+  void drained() { m_drained.store(m_drained.load(std::memory_order_relaxed) + 1, std::memory_order_release); }
+
+private:
+  byte* slot(uint32_t index) { return m_storage.data() + (index % N) * m_chunk_size; }
+
+  const uint32_t m_chunk_size;
+  bytes m_storage;
+  uint32_t m_lengths[N];
+  // counts of slots that have completed each stage (wrapping is harmless as only differences are used)
+  std::atomic<uint32_t> m_filled{0};
+  std::atomic<uint32_t> m_processed{0};
+  std::atomic<uint32_t> m_drained{0};
+};
+
+// Number of chunks needed for length bytes
+inline uint32_t chunks(uint32_t length, uint32_t chunk_size) { return (length + chunk_size - 1) / chunk_size; }
+
+// Consumer (core 1): processes count chunks in place with process(data, length), calling idle() while waiting
+template <uint32_t N, typename Process, typename Idle>
+void consume(Ring<N>& ring, uint32_t count, Process&& process, Idle&& idle) {
+  for (uint32_t i = 0; i < count;) {
+    uint32_t length;
+    byte* data = ring.process_slot(length);
+    if (!data) {
+      idle();
+      continue;
+    }
+    process(data, length);
+    ring.processed();
+    ++i;
+  }
+}
+
+// Producer and drain (core 0): reads length bytes into the ring and writes the processed chunks out, calling idle()
+// when neither makes progress. read(buffer, n) and write(buffer, n) must not block (they return the number of bytes
+// actually transferred, possibly 0) so that output is never held up waiting for input the host won't send until it
+// has seen that output
+template <uint32_t N, typename Read, typename Write, typename Idle>
+void produce(Ring<N>& ring, uint32_t length, Read&& read, Write&& write, Idle&& idle) {
+  const uint32_t count = chunks(length, ring.chunk_size());
+  uint32_t filled = 0;
+  uint32_t fill_pos = 0;
+  uint32_t drained = 0;
+  uint32_t drain_pos = 0;
+  while (drained < count) {
+    bool progress = false;
+    if (filled < count) {
+      if (byte* data = ring.fill_slot()) {
+        uint32_t chunk_length = std::min(ring.chunk_size(), length - filled * ring.chunk_size());
+        uint32_t bytes_read = read(data + fill_pos, chunk_length - fill_pos);
+        progress = bytes_read > 0;
+        fill_pos += bytes_read;
+        if (fill_pos == chunk_length) {
+          ring.filled(chunk_length);
+          ++filled;
+          fill_pos = 0;
+        }
+      }
+    }
+    uint32_t chunk_length;
+    if (const byte* data = ring.drain_slot(chunk_length)) {
+      uint32_t bytes_written = write(data + drain_pos, chunk_length - drain_pos);
+      progress = progress || bytes_written > 0;
+      drain_pos += bytes_written;
+      if (drain_pos == chunk_length) {
+        ring.drained();
+        ++drained;
+        drain_pos = 0;
+      }
+    }
+    if (!progress) {
+      idle();
+    }
+  }
+}
+
+} // namespace pipeline
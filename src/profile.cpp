@@ -0,0 +1,60 @@
+#include "profile.h"
+#include "usb_cdc.h"
+
+#include <algorithm>
+
+namespace {
+
+struct Entry {
+  uint32_t cmd;
+  uint32_t calls;
+  uint64_t total_us;
+  profile::Counters counters;
+};
+
+// sent to the host as is
+static_assert(sizeof(Entry) == 56);
+
+Entry entries[profile::MAX_COMMANDS];
+uint32_t entry_count = 0;
+
+uint8_t current_cmd = 0;
+uint64_t start_us = 0;
+
+} // namespace
+
+profile::Counters profile::current{};
+
+void profile::begin(uint8_t cmd) {
+  current = Counters{};
+  current_cmd = cmd;
+  start_us = time_us_64();
+}
+
+void profile::end() {
+  uint64_t elapsed_us = time_us_64() - start_us;
+  Entry* end = entries + entry_count;
+  Entry* entry = std::find_if(entries, end, [](const Entry& e) { return e.cmd == current_cmd; });
+  if (entry == end) {
+    if (entry_count == MAX_COMMANDS) {
+      return;
+    }
+    *entry = Entry{current_cmd, 0, 0, {}};
+    ++entry_count;
+  }
+  ++entry->calls;
+  entry->total_us += elapsed_us;
+  entry->counters.usb_read_us += current.usb_read_us;
+  entry->counters.usb_write_us += current.usb_write_us;
+  entry->counters.compute_us += current.compute_us;
+  entry->counters.bytes_in += current.bytes_in;
+  entry->counters.bytes_out += current.bytes_out;
+}
+
+void profile::write() {
+  uint32_t length = entry_count * sizeof(Entry);
+  cdc::write(length);
+  cdc::write_impl(reinterpret_cast<const byte*>(entries), length);
+}
+
+void profile::clear() { entry_count = 0; }
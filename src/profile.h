@@ -0,0 +1,54 @@
+#pragma once
+
+#include "utils.h"
+
+#include "pico/stdlib.h"
+
+// Per-command profiling counters: time blocked in USB transfers, time in crypto (mbedtls/pico_sha256) calls and bytes
+// transferred. Counters accumulate for the command in progress and are added to that command's totals when it ends
+namespace profile {
+
+// distinct commands tracked (any more are not recorded)
+constexpr uint32_t MAX_COMMANDS = 32;
+
+struct Counters {
+  uint64_t usb_read_us;
+  uint64_t usb_write_us;
+  uint64_t compute_us;
+  uint64_t bytes_in;
+  uint64_t bytes_out;
+};
+
+// The command in progress. USB fields are only updated by core 0, compute time by whichever core is computing (core 0
+// only reads it once core 1 has finished)
+extern Counters current;
+
+// Starts timing a command, discarding anything counted since the last one ended (e.g. waiting for the command)
+void begin(uint8_t cmd);
+
+// Adds the command in progress to its totals
+void end();
+
+// Writes length[4] followed by, for each command: cmd[4], calls[4], total_us[8], usb_read_us[8], usb_write_us[8],
+// compute_us[8], bytes_in[8], bytes_out[8]
+void write();
+
+// Resets all the totals
+void clear();
+
+// Adds the time between construction and destruction to a counter
+class Timer final {
+public:
+  explicit Timer(uint64_t& counter) : m_counter(counter), m_start(time_us_64()) {}
+
+  ~Timer() { m_counter += time_us_64() - m_start; }
+
+  Timer(const Timer&) = delete;
+  Timer& operator=(const Timer&) = delete;
+
+private:
+  uint64_t& m_counter;
+  uint64_t m_start;
+};
+
+} // namespace profile
@@ -1,5 +1,7 @@
 #include "sha256.h"
+#include "core1.h"
 #include "error.h"
+#include "profile.h"
 #include "usb_cdc.h"
 
 #ifdef PICO_RP2350
@@ -14,6 +16,7 @@ ErrorMapper error(ErrorMapper::Context::SHA, {});
 
 
 bytes sha256::hash(const bytes& data) {
+  profile::Timer timer(profile::current.compute_us);
 #ifdef PICO_RP2350
   pico_sha256_state_t state;
   sha256_result_t result;
@@ -35,35 +38,40 @@ bytes sha256::hash_in() {
   // 4 byte header containing length of data
   uint32_t length;
   cdc::read(length);
-  bytes buffer(cdc::CHUNK_SIZE);
+  return hash_in(length);
+}
+
+bytes sha256::hash_in(uint32_t length) {
+  // input that fits in a single chunk isn't worth handing over to core 1
+  if (length <= cdc::chunk_size()) {
+    bytes data(length);
+    cdc::read(data);
+    return hash(data);
+  }
 
+  // input is hashed on core 1 while core 0 reads the next chunk
 #ifdef PICO_RP2350
   pico_sha256_state_t state;
   sha256_result_t result;
   pico_sha256_try_start(&state, SHA256_BIG_ENDIAN, true);
-
-  for (uint32_t total_read = 0; total_read < length;) {
-    uint32_t bytes_to_read = std::min(cdc::CHUNK_SIZE, length - total_read);
-    uint32_t bytes_read = cdc::read(buffer, bytes_to_read);
-    pico_sha256_update(&state, buffer.data(), bytes_read);
-    total_read += bytes_read;
+  // blocking, as the slot is refilled as soon as this returns
+  core1::stream(
+      length, [&state](const byte* data, uint32_t n) { pico_sha256_update_blocking(&state, data, n); }, false);
+  {
+    profile::Timer timer(profile::current.compute_us);
+    pico_sha256_finish(&state, &result);
   }
-
-  pico_sha256_finish(&state, &result);
   bytes hash(result.bytes, result.bytes + SHA256_RESULT_BYTES);
 #else
   wrap<mbedtls_sha256_context> ctx(mbedtls_sha256_init, mbedtls_sha256_free);
   mbedtls_sha256_starts(&ctx, 0);
-
-  for (uint32_t total_read = 0; total_read < length;) {
-    uint32_t bytes_to_read = std::min(cdc::CHUNK_SIZE, length - total_read);
-    uint32_t bytes_read = cdc::read(buffer, bytes_to_read);
-    mbedtls_sha256_update(&ctx, buffer.data(), bytes_read);
-    total_read += bytes_read;
-  }
-
+  core1::stream(
+      length, [&ctx](const byte* data, uint32_t n) { mbedtls_sha256_update(&ctx, data, n); }, false);
   bytes hash(sha256::LENGTH_BYTES);
-  mbedtls_sha256_finish(&ctx, hash.data());
+  {
+    profile::Timer timer(profile::current.compute_us);
+    mbedtls_sha256_finish(&ctx, hash.data());
+  }
 #endif
   return hash;
-}
\ No newline at end of file
+}
@@ -5,9 +5,15 @@ namespace sha256 {
 
 const size_t LENGTH_BYTES = 32;
 
+// marks the end of the items to hash_many
+const uint32_t END_OF_ITEMS = 0xffffffff;
+
 bytes hash(const bytes& data);
 
 // hashes CDC input
 bytes hash_in();
 
+// hashes length bytes of CDC input
+bytes hash_in(uint32_t length);
+
 } // namespace sha256
\ No newline at end of file
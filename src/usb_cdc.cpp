@@ -1,9 +1,59 @@
 #include "usb_cdc.h"
+#include "profile.h"
 #include "tusb.h"
 
 #include <algorithm>
 
+namespace {
+uint32_t current_chunk_size = cdc::DEFAULT_CHUNK_SIZE;
+
+// set while a cdc::Capture is in scope
+const bytes* capture_input = nullptr;
+uint32_t capture_pos = 0;
+bool capture_overrun = false;
+bytes* capture_output = nullptr;
+
+uint32_t capture_read(byte* buffer, uint32_t length) {
+  uint32_t available = std::min(length, uint32_t(capture_input->size() - capture_pos));
+  std::copy_n(capture_input->begin() + capture_pos, available, buffer);
+  std::fill_n(buffer + available, length - available, 0);
+  capture_pos += available;
+  capture_overrun |= available < length;
+  return length;
+}
+
+uint32_t capture_write(const byte* buffer, uint32_t length) {
+  capture_output->insert(capture_output->end(), buffer, buffer + length);
+  return length;
+}
+} // namespace
+
+cdc::Capture::Capture(const bytes& input, bytes& output) {
+  capture_input = &input;
+  capture_pos = 0;
+  capture_overrun = false;
+  capture_output = &output;
+}
+
+cdc::Capture::~Capture() {
+  capture_input = nullptr;
+  capture_output = nullptr;
+}
+
+bool cdc::Capture::consumed() const { return !capture_overrun && capture_pos == capture_input->size(); }
+
+uint32_t cdc::chunk_size() { return current_chunk_size; }
+
+uint32_t cdc::set_chunk_size(uint32_t size) {
+  current_chunk_size = std::clamp(size, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE);
+  return current_chunk_size;
+}
+
 uint32_t cdc::read_impl(byte* buffer, uint32_t buffer_size) {
+  if (capture_input) {
+    return capture_read(buffer, buffer_size);
+  }
+  profile::Timer timer(profile::current.usb_read_us);
   uint32_t buffer_pos = 0;
   while (buffer_pos < buffer_size) {
     uint32_t bytes_to_read = std::min(tud_cdc_available(), buffer_size - buffer_pos);
@@ -12,15 +62,32 @@ uint32_t cdc::read_impl(byte* buffer, uint32_t buffer_size) {
     }
     tud_task();
   }
+  profile::current.bytes_in += buffer_pos;
   return buffer_pos;
 }
 
+uint32_t cdc::read_some(byte* buffer, uint32_t length) {
+  if (capture_input) {
+    return capture_read(buffer, length);
+  }
+  profile::Timer timer(profile::current.usb_read_us);
+  tud_task();
+  uint32_t bytes_to_read = std::min(tud_cdc_available(), length);
+  uint32_t bytes_read = bytes_to_read ? tud_cdc_read(buffer, bytes_to_read) : 0;
+  profile::current.bytes_in += bytes_read;
+  return bytes_read;
+}
+
 uint32_t cdc::read(bytes& b, uint32_t length) { return cdc::read_impl(b.data(), std::min((uint32_t)b.size(), length)); }
 
 // specialise for bytes
 template <> bool cdc::read(bytes& b) { return read_impl(b.data(), b.size()) == b.size(); }
 
 uint32_t cdc::write_impl(const byte* buffer, uint32_t buffer_size) {
+  if (capture_output) {
+    return capture_write(buffer, buffer_size);
+  }
+  profile::Timer timer(profile::current.usb_write_us);
   uint32_t buffer_pos = 0;
   while (buffer_pos < buffer_size) {
     uint32_t bytes_to_write = std::min(tud_cdc_write_available(), buffer_size - buffer_pos);
@@ -31,16 +98,30 @@ uint32_t cdc::write_impl(const byte* buffer, uint32_t buffer_size) {
     tud_task();
     tud_cdc_write_flush();
   }
+  profile::current.bytes_out += buffer_pos;
   return buffer_pos;
 }
 
+uint32_t cdc::write_some(const byte* buffer, uint32_t length) {
+  if (capture_output) {
+    return capture_write(buffer, length);
+  }
+  profile::Timer timer(profile::current.usb_write_us);
+  uint32_t bytes_to_write = std::min(tud_cdc_write_available(), length);
+  uint32_t bytes_written = bytes_to_write ? tud_cdc_write(buffer, bytes_to_write) : 0;
+  tud_task();
+  tud_cdc_write_flush();
+  profile::current.bytes_out += bytes_written;
+  return bytes_written;
+}
+
 uint32_t cdc::write(const bytes& b, uint32_t length) {
   return cdc::write_impl(b.data(), std::min((uint32_t)b.size(), length));
 }
 
 bool cdc::write(const char* str) {
-  return cdc::write_impl(reinterpret_cast<const uint8_t*>(str), strnlen(str, cdc::CHUNK_SIZE)) ==
-         strnlen(str, cdc::CHUNK_SIZE);
+  return cdc::write_impl(reinterpret_cast<const uint8_t*>(str), strnlen(str, cdc::MAX_CHUNK_SIZE)) ==
+         strnlen(str, cdc::MAX_CHUNK_SIZE);
 }
 
 template <> bool cdc::write(const bytes& b) { return cdc::write_impl(b.data(), b.size()) == b.size(); }
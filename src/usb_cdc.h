@@ -1,3 +1,5 @@
+#pragma once
+
 #include "utils.h"
 
 #include "tusb.h"
@@ -7,11 +9,22 @@
 
 namespace cdc {
 
-constexpr uint32_t CHUNK_SIZE = 2048;
+constexpr uint32_t DEFAULT_CHUNK_SIZE = 2048;
+constexpr uint32_t MIN_CHUNK_SIZE = 64;
+constexpr uint32_t MAX_CHUNK_SIZE = 8192;
+
+// Size of chunks for streamed input (negotiable by the host)
+uint32_t chunk_size();
+
+// Set chunk size (clamped to [MIN_CHUNK_SIZE, MAX_CHUNK_SIZE]), returns the size actually set
+uint32_t set_chunk_size(uint32_t size);
 
 // Read length (no checking for buffer overrun)
 uint32_t read_impl(byte* buffer, uint32_t length);
 
+// Read whatever is available, up to length, without blocking. Returns the number of bytes read
+uint32_t read_some(byte* buffer, uint32_t length);
+
 // Read length into buffer without overrun
 uint32_t read(bytes& buffer, uint32_t length);
 
@@ -26,6 +39,9 @@ template <> bool cdc::read(bytes& b);
 // Write bytes (without flushing?)
 uint32_t write_impl(const byte* buffer, uint32_t buffer_size);
 
+// Write as much as there's space for, up to length, without blocking. Returns the number of bytes written
+uint32_t write_some(const byte* buffer, uint32_t length);
+
 // Write part of a byte buffer
 uint32_t write(const bytes& buffer, uint32_t length);
 
@@ -41,6 +57,20 @@ template <> bool cdc::write(const bytes& b);
 
 template <> bool cdc::write(const std::string& s);
 
+// Redirects reads to a buffer and appends writes to another, rather than using USB, until destroyed (used to run a
+// command from a frame, see frame.h). Reads beyond the end of the input are zero-filled and flagged as an overrun
+class Capture final {
+public:
+  Capture(const bytes& input, bytes& output);
+  ~Capture();
+
+  Capture(const Capture&) = delete;
+  Capture& operator=(const Capture&) = delete;
+
+  // whether all the input, and no more, was read
+  bool consumed() const;
+};
+
 // read data where size not known at compile time
 inline bytes read_with_length() {
   uint32_t length;
@@ -8,6 +8,14 @@ from pico_crypto_key import CryptoKey
 
 @pytest.fixture(scope="session")
 def crypto_key() -> Generator[CryptoKey, None, None]:
+    if os.getenv("PICO_CRYPTO_KEY_EMULATE"):
+        from pico_crypto_key.emulator import EmulatedDevice
+
+        # emulated device has the default pin
+        os.environ.setdefault("PICO_CRYPTO_KEY_PIN", "pico")
+        device = EmulatedDevice()
+    else:
+        device = None
     assert os.getenv("PICO_CRYPTO_KEY_PIN"), "tests need PICO_CRYPTO_KEY_PIN to be set"
-    with CryptoKey() as device:
-        yield device
+    with CryptoKey(device) as key:
+        yield key
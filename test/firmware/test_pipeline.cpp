@@ -0,0 +1,118 @@
+// Host unit tests for the firmware pipeline, run by test/test_pipeline.py. A thread stands in for core 1
+
+#include "pipeline.h"
+
+#include <cassert>
+#include <cstdio>
+#include <random>
+#include <thread>
+
+namespace {
+
+// transfers at most max_transfer bytes per call, as the USB FIFOs do
+struct Source {
+  const bytes& data;
+  uint32_t max_transfer;
+  uint32_t pos = 0;
+  std::mt19937 rng{19937};
+
+  uint32_t operator()(byte* buffer, uint32_t length) {
+    uint32_t n = std::min({length, uint32_t(data.size()) - pos, uint32_t(rng() % (max_transfer + 1))});
+    std::copy(data.begin() + pos, data.begin() + pos + n, buffer);
+    pos += n;
+    return n;
+  }
+};
+
+struct Sink {
+  bytes data;
+  uint32_t max_transfer;
+  std::mt19937 rng{1};
+
+  uint32_t operator()(const byte* buffer, uint32_t length) {
+    uint32_t n = std::min(length, uint32_t(rng() % (max_transfer + 1)));
+    data.insert(data.end(), buffer, buffer + n);
+    return n;
+  }
+};
+
+template <uint32_t N> bytes run(const bytes& input, uint32_t chunk_size, uint32_t max_transfer) {
+  pipeline::Ring<N> ring(chunk_size);
+  Source source{input, max_transfer};
+  Sink sink{{}, max_transfer};
+  uint32_t processed = 0;
+  std::thread consumer([&] {
+    pipeline::consume(
+        ring, pipeline::chunks(input.size(), chunk_size),
+        [&](byte* data, uint32_t length) {
+          assert(length <= chunk_size);
+          for (uint32_t i = 0; i < length; ++i) {
+            data[i] ^= 0x5a;
+          }
+          processed += length;
+        },
+        [] { std::this_thread::yield(); });
+  });
+  pipeline::produce(ring, input.size(), source, sink, [] { std::this_thread::yield(); });
+  consumer.join();
+  assert(processed == input.size());
+  return sink.data;
+}
+
+void test_ring() {
+  pipeline::Ring<2> ring(4);
+  uint32_t length;
+  assert(ring.process_slot(length) == nullptr);
+  assert(ring.drain_slot(length) == nullptr);
+
+  byte* first = ring.fill_slot();
+  ring.filled(3);
+  byte* second = ring.fill_slot();
+  assert(second != first);
+  ring.filled(4);
+  // both slots in use
+  assert(ring.fill_slot() == nullptr);
+
+  assert(ring.process_slot(length) == first && length == 3);
+  // not drainable until processed
+  assert(ring.drain_slot(length) == nullptr);
+  ring.processed();
+  assert(ring.drain_slot(length) == first && length == 3);
+  ring.drained();
+  // slot reused
+  assert(ring.fill_slot() == first);
+  assert(ring.process_slot(length) == second && length == 4);
+}
+
+void test_chunks() {
+  assert(pipeline::chunks(0, 64) == 0);
+  assert(pipeline::chunks(1, 64) == 1);
+  assert(pipeline::chunks(64, 64) == 1);
+  assert(pipeline::chunks(65, 64) == 2);
+}
+
+void test_stream() {
+  std::mt19937 rng(0);
+  for (uint32_t length : {0u, 1u, 63u, 64u, 65u, 1000u, 10000u}) {
+    bytes input(length);
+    for (auto& b : input) {
+      b = rng();
+    }
+    bytes expected(input);
+    for (auto& b : expected) {
+      b ^= 0x5a;
+    }
+    assert(run<pipeline::SLOTS>(input, 64, 17) == expected);
+    assert(run<pipeline::SLOTS>(input, 64, 1000) == expected);
+    assert(run<1>(input, 128, 50) == expected);
+  }
+}
+
+} // namespace
+
+int main() {
+  test_ring();
+  test_chunks();
+  test_stream();
+  std::puts("ok");
+}
@@ -0,0 +1,96 @@
+import asyncio
+import io
+import os
+import time
+
+import pytest
+
+from pico_crypto_key import AsyncCryptoKey, CryptoKey, CryptoKeyAuthenticationError
+from pico_crypto_key.emulator import EmulatedDevice
+
+
+@pytest.fixture
+def device(monkeypatch: pytest.MonkeyPatch) -> EmulatedDevice:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    return EmulatedDevice(latency_ms=1)
+
+
+def test_async_crypto_key(device: EmulatedDevice) -> None:
+    data = os.urandom(5000)
+
+    async def run() -> None:
+        async with AsyncCryptoKey(device) as key:
+            digest = await key.hash(data)
+            assert (await key.sign(data))[0] == digest
+            _, sig = await key.sign(data)
+            assert await key.verify(digest, sig, await key.pubkey()) == 0
+            assert await key.decrypt(await key.encrypt(data, "gcm"), "gcm") == data
+            assert (await key.info())[0].endswith("-emulator-host")
+
+            # many coroutines sharing the key get the right results
+            results = await asyncio.gather(*(key.hash(data[:i]) for i in range(0, 1000, 50)))
+            with CryptoKey(EmulatedDevice()) as sync_key:
+                assert results == [sync_key.hash(data[:i]) for i in range(0, 1000, 50)]
+                assert await key.register("rp", "user") == sync_key.register("rp", "user")
+
+    asyncio.run(run())
+
+
+def test_async_event_loop_not_blocked(device: EmulatedDevice) -> None:
+    data = os.urandom(20_000)
+
+    async def run() -> None:
+        ticks = 0
+
+        async def tick() -> None:
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.001)
+                ticks += 1
+
+        async with AsyncCryptoKey(device) as key:
+            ticker = asyncio.create_task(tick())
+            start = time.perf_counter()
+            await key.encrypt(data)
+            elapsed = time.perf_counter() - start
+            ticker.cancel()
+        # the loop kept running while the device was busy
+        assert elapsed > 0.05
+        assert ticks > 10
+
+    asyncio.run(run())
+
+
+def test_async_streams(device: EmulatedDevice) -> None:
+    data = os.urandom(10000)
+
+    async def run() -> None:
+        async with AsyncCryptoKey(device) as key:
+            for mode in ("cfb8", "ctr", "gcm"):
+                ciphertext = b"".join([chunk async for chunk in key.encrypt_stream(io.BytesIO(data), mode=mode)])
+                assert len(ciphertext) == len(data) + CryptoKey.ciphertext_overhead(mode)
+                assert await key.decrypt(ciphertext, mode) == data
+                chunks = [chunk async for chunk in key.decrypt_stream(io.BytesIO(ciphertext), mode=mode)]
+                assert len(chunks) > 1
+                assert b"".join(chunks) == data
+
+            tampered = bytearray(await key.encrypt(data, "gcm"))
+            tampered[-1] ^= 1
+            with pytest.raises(CryptoKeyAuthenticationError):
+                async for _ in key.decrypt_stream(io.BytesIO(tampered), mode="gcm"):
+                    pass
+
+            items = [data[:i] for i in range(1, 40)]
+            results = [result async for result in key.sign_many(items)]
+            assert [digest for digest, _ in results] == [await key.hash(item) for item in items]
+            assert [digest async for digest in key.hash_many(items)] == [digest for digest, _ in results]
+
+            # abandoning a stream part way leaves the key usable
+            async for _ in key.sign_many(items):
+                break
+            stream = key.encrypt_stream(io.BytesIO(data))
+            await anext(stream)
+            await stream.aclose()
+            assert await key.decrypt(await key.encrypt(data)) == data
+
+    asyncio.run(run())
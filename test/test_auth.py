@@ -41,3 +41,14 @@ def test_pubkey(crypto_key: CryptoKey, challenge: bytes) -> None:
     expired_challenge = challenge + struct.pack("Q", t - 60000)
     with pytest.raises(ecdsa.keys.BadSignatureError):
         verifying_key.verify(sig, expired_challenge, sigdecode=ecdsa.util.sigdecode_der)
+
+
+def test_keypair_cache(crypto_key: CryptoKey) -> None:
+    before = crypto_key.keypair_cache_stats()
+    assert before["size"] <= before["capacity"]
+    # first use of this identity derives the key, subsequent uses hit the device's cache
+    crypto_key.auth("cache.example.com", "a.user", b"challenge")
+    crypto_key.auth("cache.example.com", "a.user", b"challenge")
+    after = crypto_key.keypair_cache_stats()
+    assert after["misses"] - before["misses"] == 1
+    assert after["hits"] - before["hits"] == 1
@@ -0,0 +1,110 @@
+import zlib
+from collections.abc import Generator
+from struct import pack
+
+import pytest
+
+from pico_crypto_key import CryptoKey, CryptoKeyCommunicationError
+from pico_crypto_key.emulator import EmulatedDevice
+
+
+@pytest.fixture
+def emulated_key(monkeypatch: pytest.MonkeyPatch) -> Generator[CryptoKey, None, None]:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    with CryptoKey(EmulatedDevice(), key_cache=None) as key:
+        yield key
+
+
+def test_batch(crypto_key: CryptoKey) -> None:
+    assert crypto_key.protocol_version() == CryptoKey.FRAME_VERSION
+    digest, sig = crypto_key.sign(b"data")
+    pubkey = crypto_key.pubkey()
+    crypto_key.reset_stats()
+    with crypto_key.batch() as batch:
+        assert batch.framed
+        key = batch.pubkey()
+        info = batch.info()
+        verified = batch.verify(digest, sig, pubkey)
+        rejected = batch.verify(bytes(32), sig, pubkey)
+        registered = batch.register("example.com", "user")
+        signed = batch.sign_digest(digest)
+        # all sent before any reply has been read
+        assert len(batch) == 6
+        assert not key.done()
+        # replies are matched to requests in whatever order they're asked for
+        assert signed.result() == sig
+        assert key.done()
+        assert key.result() == pubkey
+    assert len(batch) == 0
+    assert info.result()[0] == crypto_key.info()[0]
+    assert verified.result() == 0
+    assert rejected.result() == CryptoKey.VERIFY_FAILED
+    assert registered.result() == crypto_key.register("example.com", "user")
+    assert crypto_key.stats()["batch"]["calls"] == 1
+
+
+def test_batch_auth(crypto_key: CryptoKey) -> None:
+    challenge = b"challenge"
+    with crypto_key.batch() as batch:
+        replies = [batch.auth("example.com", "user", challenge) for _ in range(3)]
+    # the same timestamp interval, unless the minute has just ticked over
+    expected = crypto_key.auth("example.com", "user", challenge)
+    assert expected in {reply.result() for reply in replies}
+
+
+def test_batch_flow_control(emulated_key: CryptoKey) -> None:
+    digest, sig = emulated_key.sign(b"data")
+    pubkey = emulated_key.pubkey()
+    with emulated_key.batch() as batch:
+        replies = []
+        for _ in range(100):
+            replies.append(batch.verify(digest, sig, pubkey))
+            # no more in flight than the device's buffers hold
+            assert len(batch) * 128 <= emulated_key.capabilities()["tx_bufsize"]
+        # a request larger than the receive buffer is sent on its own
+        large = batch.auth("example.com", "user", bytes(3000))
+        assert len(batch) == 1
+    assert all(reply.result() == 0 for reply in replies)
+    assert large.result()
+
+
+def test_frame_errors(emulated_key: CryptoKey) -> None:
+    with emulated_key.batch() as batch:
+        # not a framed command
+        streamed = batch._submit(b"h", pack("I", 0), bytes, emulated_key.hash)
+        # payload doesn't match the command
+        extra = batch._submit(b"k", b"\0", bytes, emulated_key.pubkey)
+        key = batch.pubkey()
+    with pytest.raises(CryptoKeyCommunicationError, match="invalid command"):
+        streamed.result()
+    with pytest.raises(CryptoKeyCommunicationError, match="bad frame"):
+        extra.result()
+    assert key.result() == emulated_key.pubkey()
+
+    # a corrupted request is rejected without losing sync
+    frame = pack(CryptoKey.FRAME_HEADER, b"T", CryptoKey.FRAME_VERSION, ord("k"), 0, 7, 0)
+    emulated_key._write(frame + pack("I", zlib.crc32(frame) ^ 1))
+    assert emulated_key._read_frame() == (b"k", 3, 7, b"")
+    assert emulated_key.info()
+
+    # ids are assigned in order, and untagged commands still work in between batches
+    with emulated_key.batch() as batch:
+        ids = [batch.device_id().id, batch.device_id().id]
+    assert ids == [0, 1]
+    assert emulated_key.hash(b"data") == emulated_key.hash(b"data")
+
+
+def test_batch_legacy(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    with CryptoKey(EmulatedDevice(legacy=True)) as crypto_key:
+        assert crypto_key.protocol_version() == 0
+        digest, sig = crypto_key.sign(b"data")
+        with crypto_key.batch() as batch:
+            assert not batch.framed
+            key = batch.pubkey()
+            # commands run as they're queued
+            assert key.done()
+            verified = batch.verify(digest, sig, key.result())
+            device_id = batch.device_id()
+        assert verified.result() == 0
+        assert device_id.result() is None
@@ -0,0 +1,119 @@
+import os
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from pico_crypto_key import CryptoKey, benchmark
+from pico_crypto_key.emulator import EmulatedDevice
+
+
+def test_parse_size() -> None:
+    assert benchmark.parse_size("1") == 1
+    assert benchmark.parse_size("100K") == 100 * 1024
+    assert benchmark.parse_size("1000k") == 1000 * 1024
+    assert benchmark.parse_size("100MB") == 100 * 1024**2
+    for size in (1, 1024, 100 * 1024, 3 * 1024**2, 1000):
+        assert benchmark.parse_size(benchmark.format_size(size)) == size
+    with pytest.raises(ValueError):
+        benchmark.parse_size("1.5M")
+
+
+def test_percentile() -> None:
+    times = [4.0, 1.0, 3.0, 2.0]
+    assert benchmark.percentile(times, 0) == 1.0
+    assert benchmark.percentile(times, 50) == 2.5
+    assert benchmark.percentile(times, 100) == 4.0
+    assert benchmark.percentile([1.0], 99) == 1.0
+
+
+def test_operations(crypto_key: CryptoKey) -> None:
+    data = os.urandom(1000)
+    # decryption decrypts (setup isn't timed)
+    assert benchmark._operation(crypto_key, "decrypt", data)() == data
+    assert benchmark._operation(crypto_key, "decrypt-gcm", data)() == data
+    assert benchmark._operation(crypto_key, "hash", data)() == crypto_key.hash(data)
+    assert benchmark._operation(crypto_key, "verify", data)() == 0
+    with pytest.raises(ValueError):
+        benchmark._operation(crypto_key, "compress", data)
+
+
+def test_run(crypto_key: CryptoKey, tmp_path: Path) -> None:
+    chunk_size = crypto_key.chunk_size
+    results = benchmark.run(
+        crypto_key, ["hash", "verify", "decrypt"], [1, 1024], chunk_sizes=[512, 1024], warmup=0, repeat=3
+    )
+    # original settings are restored
+    assert crypto_key.chunk_size == chunk_size
+
+    assert results["board"] == crypto_key.info()[0]
+    assert results["emulated"] == isinstance(crypto_key.device, EmulatedDevice)
+    assert {(r["operation"], r["size"], r["chunk_size"]) for r in results["results"]} == {
+        (op, size, chunk)
+        for chunk in (512, 1024)
+        for op, size in [("hash", 1), ("hash", 1024), ("verify", None), ("decrypt", 1), ("decrypt", 1024)]
+    }
+    for result in results["results"]:
+        assert result["runs"] == len(result["times_s"]) == 3
+        assert result["min_s"] <= result["p50_s"] <= result["p90_s"] <= result["p99_s"] <= result["max_s"]
+        assert ("bitrate_kbps" in result) == (result["size"] is not None)
+        # the device's own split of the time per run
+        assert result["device"]["compute_s"] <= result["device"]["total_s"] <= result["max_s"]
+
+    benchmark.save(results, tmp_path / "results.json")
+    assert benchmark.load(tmp_path / "results.json") == results
+
+    with pytest.raises(ValueError):
+        benchmark.run(crypto_key, ["compress"])
+
+
+def test_run_legacy(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    with CryptoKey(EmulatedDevice(legacy=True)) as crypto_key:
+        # chunk size can't be negotiated, so only the default is used
+        results = benchmark.run(crypto_key, ["hash"], [1024], chunk_sizes=[512, 1024], warmup=0, repeat=1)
+    assert [r["chunk_size"] for r in results["results"]] == [crypto_key.CHUNK_SIZE]
+    assert "device" not in results["results"][0]
+    assert results["capabilities"] == {}
+
+
+def _results(board: str, times: dict[str, float]) -> dict[str, Any]:
+    return {
+        "version": benchmark.RESULTS_VERSION,
+        "board": board,
+        "results": [
+            {"operation": op, "size": None if op == "verify" else 1024, "chunk_size": 2048, "p50_s": t}
+            | ({} if op == "verify" else {"bitrate_kbps": 8 / t})
+            for op, t in times.items()
+        ],
+    }
+
+
+def test_compare() -> None:
+    baseline = _results("A", {"hash": 1.0, "sign": 1.0, "verify": 0.5})
+    current = _results("B", {"hash": 1.05, "sign": 1.2, "verify": 0.25, "encrypt": 2.0})
+    comparison = benchmark.compare(baseline, current, threshold=0.1)
+    # only operations in both are compared
+    assert [row["operation"] for row in comparison] == ["hash", "sign", "verify"]
+    assert [row["regression"] for row in comparison] == [False, True, False]
+    assert comparison[2]["change"] == pytest.approx(-0.5)
+
+
+def test_markdown(tmp_path: Path) -> None:
+    runs = [_results("A", {"hash": 2.0, "verify": 0.5}), _results("B", {"hash": 1.0, "verify": 0.4})]
+    table = benchmark.markdown_table(runs, 1024, ["hash", "verify"])
+    lines = table.splitlines()
+    assert len(lines) == 4
+    assert lines[0].startswith("|         | A<br/>time(s) |")
+    assert lines[1].startswith("|:--------|")
+    assert [cell.strip() for cell in lines[2].split("|")[1:-1]] == ["hash", "2.0", "4.0", "1.0", "8.0", "100.0"]
+    assert [cell.strip() for cell in lines[3].split("|")[1:-1]] == ["verify", "0.5", "", "0.4", "", "25.0"]
+    # all rows the same width
+    assert len({len(line) for line in lines}) == 1
+
+    readme = tmp_path / "README.md"
+    readme.write_text("# Title\n\n<!-- benchmark:boards -->\nold table\n<!-- /benchmark:boards -->\n\nmore\n")
+    benchmark.update_readme(readme, "boards", table)
+    assert readme.read_text() == f"# Title\n\n<!-- benchmark:boards -->\n{table}\n<!-- /benchmark:boards -->\n\nmore\n"
+    with pytest.raises(ValueError):
+        benchmark.update_readme(readme, "modes", table)
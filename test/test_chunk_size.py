@@ -0,0 +1,75 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from pico_crypto_key import CryptoKey, CryptoKeyCommunicationError
+from pico_crypto_key.emulator import EmulatedDevice
+
+
+def test_capabilities(crypto_key: CryptoKey) -> None:
+    capabilities = crypto_key.capabilities()
+    assert capabilities["chunk_size"] == crypto_key.chunk_size
+    assert capabilities["max_chunk_size"] >= crypto_key.CHUNK_SIZE
+    assert capabilities["rx_bufsize"] > 0
+    assert capabilities["tx_bufsize"] > 0
+
+
+def test_set_chunk_size(crypto_key: CryptoKey) -> None:
+    data = os.urandom(10000)
+    ciphertext = crypto_key.encrypt(data)
+    digest = crypto_key.hash(data)
+    max_chunk_size = crypto_key.capabilities()["max_chunk_size"]
+    try:
+        # out of range sizes are clamped by the device
+        assert crypto_key.set_chunk_size(1) < crypto_key.CHUNK_SIZE
+        assert crypto_key.set_chunk_size(max_chunk_size + 1) == max_chunk_size
+
+        for size in (512, 4096):
+            assert crypto_key.set_chunk_size(size) == crypto_key.chunk_size == size
+            assert crypto_key.encrypt(data) == ciphertext
+            assert crypto_key.decrypt(ciphertext) == data
+            assert crypto_key.decrypt(crypto_key.encrypt(data, "gcm"), "gcm") == data
+            # upload size is independent of the device chunk size
+            crypto_key.upload_chunk_size = 2 * size
+            assert crypto_key.hash(data) == digest
+    finally:
+        crypto_key.upload_chunk_size = crypto_key.CHUNK_SIZE
+        crypto_key.set_chunk_size(crypto_key.CHUNK_SIZE)
+
+
+def test_legacy_firmware(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    with CryptoKey(EmulatedDevice(legacy=True)) as crypto_key:
+        assert crypto_key.capabilities() == {}
+        with pytest.raises(CryptoKeyCommunicationError):
+            crypto_key.set_chunk_size(1024)
+        # still usable with the default chunk size
+        data = os.urandom(3000)
+        assert crypto_key.decrypt(crypto_key.encrypt(data)) == data
+        # batch signing falls back to individual commands
+        assert list(crypto_key.sign_many([data, data])) == [crypto_key.sign(data)] * 2
+        with pytest.raises(CryptoKeyCommunicationError):
+            crypto_key.sign(data, prehash="host")
+        assert crypto_key.keypair_cache_stats() == {}
+        with pytest.raises(CryptoKeyCommunicationError):
+            crypto_key.encrypt(data, "ctr")
+
+
+def test_tune(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    monkeypatch.setenv("PICO_CRYPTO_KEY_CONFIG_DIR", str(tmp_path))
+    device = EmulatedDevice()
+    with CryptoKey(device) as crypto_key:
+        tuning = crypto_key.tune(sizes=(1024, 4096), length=8192)
+        assert tuning["chunk_size"] in (1024, 4096)
+        assert tuning["upload_chunk_size"] in (1024, 4096)
+        assert crypto_key.chunk_size == tuning["chunk_size"]
+        assert (tmp_path / "tuning.json").exists()
+
+    # saved tuning is applied to a new session
+    with CryptoKey(device) as crypto_key:
+        assert crypto_key.chunk_size == tuning["chunk_size"]
+        assert crypto_key.upload_chunk_size == tuning["upload_chunk_size"]
+        data = os.urandom(5000)
+        assert crypto_key.decrypt(crypto_key.encrypt(data)) == data
@@ -0,0 +1,136 @@
+import os
+import signal
+import socket
+import stat
+import subprocess
+import sys
+import threading
+import time
+from collections.abc import Generator
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from pico_crypto_key import (
+    CryptoKey,
+    CryptoKeyAuthenticationError,
+    CryptoKeyClient,
+    CryptoKeyConnectionError,
+    CryptoKeyServer,
+)
+from pico_crypto_key.daemon import _recv, _send
+from pico_crypto_key.emulator import EmulatedDevice
+
+
+@pytest.fixture
+def server(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> Generator[CryptoKeyServer, None, None]:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    with CryptoKey(EmulatedDevice()) as crypto_key, CryptoKeyServer(crypto_key, tmp_path / "key.sock") as server:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield server
+        server.shutdown()
+        thread.join()
+
+
+def test_client(server: CryptoKeyServer, tmp_path: Path) -> None:
+    data = os.urandom(5000)
+    key = server.crypto_key
+    with CryptoKeyClient(server.path) as client:
+        assert client.hash(data) == key.hash(data)
+        # files are read by the client
+        (tmp_path / "data.bin").write_bytes(data)
+        assert client.hash(tmp_path / "data.bin") == key.hash(data)
+        with open(tmp_path / "data.bin", "rb") as fd:
+            assert client.hash(fd, 100) == key.hash(data[:100])
+
+        digest, sig = client.sign(data)
+        assert client.sign(data, prehash="host") == (digest, sig)
+        assert client.verify(digest, sig, client.pubkey()) == 0
+        assert client.sign_digest(digest) == sig
+        assert list(client.sign_many([data, data[:10]])) == [key.sign(data), key.sign(data[:10])]
+        assert list(client.sign_many([digest], prehashed=True)) == [(digest, sig)]
+
+        for mode in ("cfb8", "ctr", "gcm"):
+            assert client.decrypt(client.encrypt(data, mode), mode) == data
+        assert client.register("rp", "user") == key.register("rp", "user")
+        assert client.auth("rp", "user", b"challenge") == key.auth("rp", "user", b"challenge")
+        version, timestamp = client.info()
+        assert version == key.info()[0]
+        assert timestamp.tzinfo is not None
+        assert client.device_id() == key.device_id()
+        assert client.capabilities() == key.capabilities()
+        assert client.keypair_cache_stats()["capacity"] > 0
+        assert client.stats() == key.stats()
+        assert client.stats()["sign_many"]["calls"] == 2
+
+        # errors are raised in the client
+        tampered = bytearray(client.encrypt(data, "gcm"))
+        tampered[-1] ^= 1
+        with pytest.raises(CryptoKeyAuthenticationError):
+            client.decrypt(bytes(tampered), "gcm")
+        invalid: Any = "ecb"
+        with pytest.raises(ValueError):
+            client.encrypt(data, invalid)
+        # the key remains usable
+        assert client.hash(data) == key.hash(data)
+
+
+def test_raw_requests(server: CryptoKeyServer) -> None:
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(str(server.path))
+        # only the whitelisted methods can be called
+        _send(sock, {"method": "set_pin", "args": []})
+        assert _recv(sock) == {"error": ["ValueError", "unknown method 'set_pin'"]}
+        # the daemon doesn't read files on behalf of clients
+        _send(sock, {"method": "hash", "args": ["/etc/passwd"]})
+        assert _recv(sock) == {"error": ["TypeError", "hash data must be bytes"]}
+
+
+def test_many_clients(server: CryptoKeyServer) -> None:
+    data = os.urandom(1000)
+    expected = [server.crypto_key.hash(data[:i]) for i in (10, 500, 1000)]
+    results: list[bool] = []
+
+    def work() -> None:
+        with CryptoKeyClient(server.path) as client:
+            results.extend(client.hash(data[:i]) == digest for i, digest in zip((10, 500, 1000), expected, strict=True))
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 24
+    assert all(results)
+
+
+def test_socket(server: CryptoKeyServer, tmp_path: Path) -> None:
+    # owner-only access
+    assert stat.S_IMODE(server.path.stat().st_mode) == 0o600
+    # a socket in use isn't replaced
+    with pytest.raises(OSError, match="in use"):
+        CryptoKeyServer(server.crypto_key, server.path)
+    with pytest.raises(CryptoKeyConnectionError), CryptoKeyClient(tmp_path / "missing.sock"):
+        pass
+
+
+def test_serve(tmp_path: Path) -> None:
+    path = tmp_path / "key.sock"
+    env = os.environ | {"PICO_CRYPTO_KEY_CONFIG_DIR": str(tmp_path)}
+    command = [sys.executable, "-c", "from pico_crypto_key.cli import app; app()", "serve", "--emulate"]
+    process = subprocess.Popen([*command, "--socket", str(path)], env=env, stdout=subprocess.PIPE, text=True)
+    try:
+        for _ in range(100):
+            if path.exists():
+                break
+            time.sleep(0.1)
+        with CryptoKeyClient(path) as client:
+            assert client.info()[0].endswith("-emulator-host")
+    finally:
+        process.send_signal(signal.SIGTERM)
+        stdout, _ = process.communicate(timeout=10)
+    assert process.returncode == 0
+    assert "Served 1 requests" in stdout
+    assert not path.exists()
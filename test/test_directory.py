@@ -0,0 +1,120 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+from typer.testing import CliRunner
+
+from pico_crypto_key import CryptoKey, CryptoKeyAuthenticationError, directory
+from pico_crypto_key.cli import app
+from pico_crypto_key.verifier import Verifier
+
+# old enough for files to be indexed
+MTIME_NS = 10**18
+
+
+def _make_tree(root: Path) -> None:
+    (root / "sub" / "deeper").mkdir(parents=True)
+    for name in ("a.txt", "sub/b.bin", "sub/deeper/c.bin"):
+        (root / name).write_bytes(os.urandom(1000))
+        os.utime(root / name, ns=(MTIME_NS, MTIME_NS))
+    (root / "link").symlink_to(root / "a.txt")
+
+
+def test_list_files(tmp_path: Path) -> None:
+    _make_tree(tmp_path)
+    assert directory.list_files(tmp_path) == ["a.txt", "sub/b.bin", "sub/deeper/c.bin"]
+    assert directory.list_files(tmp_path, exclude=[tmp_path / "sub/b.bin"]) == ["a.txt", "sub/deeper/c.bin"]
+
+
+def test_hash_index(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_CONFIG_DIR", str(tmp_path / "config"))
+    tree = tmp_path / "tree"
+    _make_tree(tree)
+    files = directory.list_files(tree)
+    index = directory.HashIndex(tree)
+    hashes = index.hash_files(files, workers=2)
+    assert (index.hits, index.misses) == (0, 3)
+    assert hashes["sub/b.bin"] == directory._file_hash(tree / "sub/b.bin")
+
+    # a new index for the tree (e.g. the next run) skips unchanged files...
+    index = directory.HashIndex(tree)
+    assert index.hash_files(files) == hashes
+    assert (index.hits, index.misses) == (3, 0)
+
+    # ...and rehashes changed ones
+    (tree / "a.txt").write_bytes(b"changed")
+    index = directory.HashIndex(tree)
+    hashes = index.hash_files(files)
+    assert (index.hits, index.misses) == (2, 1)
+    assert hashes["a.txt"] == directory._file_hash(tree / "a.txt")
+    # recently modified, so not indexed in case it changes again within the timestamp resolution
+    index = directory.HashIndex(tree)
+    index.hash_files(files)
+    assert (index.hits, index.misses) == (2, 1)
+
+    # an unpersisted index starts empty
+    index = directory.HashIndex(tree, persist=False)
+    index.hash_files(files)
+    assert (index.hits, index.misses) == (0, 3)
+
+
+def test_sign_tree(crypto_key: CryptoKey, tmp_path: Path) -> None:
+    _make_tree(tmp_path)
+    manifest = directory.sign_tree(crypto_key, tmp_path)
+    assert list(manifest["files"]) == ["a.txt", "sub/b.bin", "sub/deeper/c.bin"]
+    assert manifest["pubkey"] == crypto_key.pubkey().hex()
+    no_changes = {"changed": [], "removed": [], "added": []}
+    assert directory.verify_tree(manifest, tmp_path, crypto_key.verify) == no_changes
+    assert directory.verify_tree(manifest, tmp_path, Verifier().verify) == no_changes
+
+    (tmp_path / "sub/b.bin").write_bytes(b"changed")
+    (tmp_path / "sub/deeper/c.bin").unlink()
+    (tmp_path / "new.txt").write_bytes(b"new")
+    assert directory.verify_tree(manifest, tmp_path, crypto_key.verify) == {
+        "changed": ["sub/b.bin"],
+        "removed": ["sub/deeper/c.bin"],
+        "added": ["new.txt"],
+    }
+
+    tampered = {
+        **manifest,
+        "files": {**manifest["files"], "sub/b.bin": directory._file_hash(tmp_path / "sub/b.bin").hex()},
+    }
+    with pytest.raises(CryptoKeyAuthenticationError):
+        directory.verify_tree(tampered, tmp_path, crypto_key.verify)
+    with pytest.raises(ValueError, match="version"):
+        directory.verify_tree({**manifest, "version": 2}, tmp_path, crypto_key.verify)
+
+
+def test_cli(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_CONFIG_DIR", str(tmp_path / "config"))
+    tree = tmp_path / "tree"
+    _make_tree(tree)
+    runner = CliRunner()
+
+    result = runner.invoke(app, ["sign-dir", str(tree), "--emulate"])
+    assert result.exit_code == 0, result.output
+    assert "Signed 3 files (3 hashed, 0 unchanged)" in result.output
+    assert set(json.loads((tmp_path / "tree.manifest.json").read_text())["files"]) == {
+        "a.txt",
+        "sub/b.bin",
+        "sub/deeper/c.bin",
+    }
+    result = runner.invoke(app, ["sign-dir", str(tree), "--emulate"])
+    assert "Signed 3 files (0 hashed, 3 unchanged)" in result.output
+
+    result = runner.invoke(app, ["verify-dir", str(tree), "--emulate"])
+    assert result.exit_code == 0, result.output
+    assert "Manifest signed by this device" in result.output
+    assert "All 3 files match" in result.output
+
+    # a manifest in the tree isn't part of it
+    manifest = tree / "MANIFEST.json"
+    assert runner.invoke(app, ["sign-dir", str(tree), "--manifest", str(manifest), "--emulate"]).exit_code == 0
+    assert "MANIFEST.json" not in json.loads(manifest.read_text())["files"]
+
+    (tree / "a.txt").write_bytes(b"changed")
+    result = runner.invoke(app, ["verify-dir", str(tree), "--emulate"])
+    assert result.exit_code == 1
+    assert "changed: a.txt" in result.output
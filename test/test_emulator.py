@@ -0,0 +1,120 @@
+from time import time
+
+import pytest
+import usb.core
+
+from pico_crypto_key import CryptoKey, CryptoKeyPinError
+from pico_crypto_key.emulator import AES256, EmulatedDevice, GHash
+
+
+def test_aes256() -> None:
+    # FIPS-197 C.3
+    aes = AES256(bytes(range(32)))
+    block = aes.encrypt_block(bytes.fromhex("00112233445566778899aabbccddeeff"))
+    assert block == bytes.fromhex("8ea2b7ca516745bfeafc49904b496089")
+
+    # NIST SP800-38A F.3.17/F.3.18 CFB8-AES256
+    aes = AES256(bytes.fromhex("603deb1015ca71be2b73aef0857d77811f352c073b6108d72d9810a30914dff4"))
+    iv = int("000102030405060708090a0b0c0d0e0f", 16)
+    plaintext = bytes.fromhex("6bc1bee22e409f96e93d7e117393172aae2d")
+    ciphertext = bytes.fromhex("dc1f1a8520a64db55fcc8ac554844e889700")
+    assert aes.cfb8(plaintext, iv, encrypt=True)[0] == ciphertext
+    assert aes.cfb8(ciphertext, iv, encrypt=False)[0] == plaintext
+
+    # chunked is equivalent to one-shot
+    head, iv2 = aes.cfb8(plaintext[:7], iv, encrypt=True)
+    tail, _ = aes.cfb8(plaintext[7:], iv2, encrypt=True)
+    assert head + tail == ciphertext
+
+    # NIST SP800-38A F.5.5 CTR-AES256, in uneven chunks
+    plaintext = bytes.fromhex("6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51")
+    ciphertext = bytes.fromhex("601ec313775789a5b7a7f504bbf3d228f443e3ca4d62b59aca84e990cacaf5c5")
+    head, counter, keystream = aes.ctr(plaintext[:7], int("f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff", 16))
+    tail, _, _ = aes.ctr(plaintext[7:], counter, keystream)
+    assert head + tail == ciphertext
+
+
+def test_gcm() -> None:
+    # GCM spec test case 15 (AES256, 96-bit IV, no additional data)
+    aes = AES256(bytes.fromhex("feffe9928665731c6d6a8f9467308308feffe9928665731c6d6a8f9467308308"))
+    j0 = int.from_bytes(bytes.fromhex("cafebabefacedbaddecaf888") + b"\0\0\0\1", "big")
+    plaintext = bytes.fromhex(
+        "d9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d8a318a72"
+        "1c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657ba637b391aafd255"
+    )
+    ciphertext, _, _ = aes.ctr(plaintext, j0 + 1)
+    assert ciphertext == bytes.fromhex(
+        "522dc1f099567d07f47f37a32a84427d643a8cdcbfe5c0c97598a2bd2555d1aa"
+        "8cb08e48590dbb3da7b08b1056828838c5f61e6393ba7a0abcc9f662898015ad"
+    )
+    ghash = GHash(int.from_bytes(aes.encrypt_block(bytes(16)), "big"))
+    ghash.update(ciphertext[:20])
+    ghash.update(ciphertext[20:])
+    tag = int.from_bytes(aes.encrypt_block(j0.to_bytes(16, "big")), "big") ^ ghash.digest()
+    assert tag == int("b094dac5d93471bdec1a502270e3cc6c", 16)
+
+
+def test_pin(monkeypatch: pytest.MonkeyPatch) -> None:
+    device = EmulatedDevice(pin="1234")
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "4321")
+    with pytest.raises(CryptoKeyPinError):
+        CryptoKey(device).init()
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "1234")
+    with CryptoKey(device) as crypto_key:
+        assert crypto_key.have_repl
+
+
+def test_keys_depend_on_board_id(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    with CryptoKey(EmulatedDevice()) as key1, CryptoKey(EmulatedDevice(board_id=b"OTHERKEY")) as key2:
+        assert key1.pubkey() != key2.pubkey()
+        data = b"some data"
+        assert key1.encrypt(data) != key2.encrypt(data)
+        assert key2.decrypt(key1.encrypt(data)) != data
+
+
+def test_transfer_model(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    device = EmulatedDevice(latency_ms=5)
+    with CryptoKey(device, key_cache=None) as crypto_key:
+        ep_out, ep_in = device.endpoints
+        transfers = ep_out.transfers + ep_in.transfers
+        start = time()
+        crypto_key.pubkey()
+        elapsed = time() - start
+        # one write (command) and one read (key)
+        assert ep_out.transfers + ep_in.transfers - transfers == 2
+        assert elapsed >= 0.01
+
+
+def test_keypair_cache(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    device = EmulatedDevice()
+    with CryptoKey(device, key_cache=None) as crypto_key:
+        capacity = crypto_key.keypair_cache_stats()["capacity"]
+        pubkeys = [crypto_key.register("rp", f"user{i}") for i in range(capacity + 1)]
+        # the first identity has been evicted, the second is still cached
+        assert crypto_key.register("rp", "user1") == pubkeys[1]
+        assert crypto_key.register("rp", "user0") == pubkeys[0]
+        assert crypto_key.keypair_cache_stats() == {
+            "hits": 1,
+            "misses": capacity + 2,
+            "size": capacity,
+            "capacity": capacity,
+        }
+    # cleared on reset
+    with CryptoKey(device) as crypto_key:
+        assert crypto_key.keypair_cache_stats() == {"hits": 0, "misses": 0, "size": 0, "capacity": capacity}
+
+
+def test_error_loop(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    device = EmulatedDevice(timeout_ms=100)
+    with CryptoKey(device) as crypto_key:
+        digest, sig = crypto_key.sign(b"data")
+        # as the firmware, the device stops responding given a public key it can't parse
+        with pytest.raises(usb.core.USBTimeoutError):
+            crypto_key.verify(digest, sig, b"not a key")
+        assert device.halted
+        with pytest.raises(usb.core.USBTimeoutError):
+            crypto_key.info()
@@ -1,6 +1,13 @@
+import mmap
+import os
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Self
+
 import pytest
 
-from pico_crypto_key import CryptoKey
+from pico_crypto_key import CryptoKey, CryptoKeyAuthenticationError
+from pico_crypto_key.device import CipherMode
 
 
 @pytest.mark.parametrize(
@@ -16,3 +23,169 @@ def test_encrypt_decrypt(crypto_key: CryptoKey, file: str) -> None:
         data_dec = crypto_key.decrypt(data_enc)
         assert data == data_dec
         print("[H] round-trip ok")
+
+
+@pytest.mark.parametrize(
+    "file",
+    ["./test/test.txt", "./test/test2.txt", "./test/test3.txt", "./test/test4.bin"],
+)
+def test_encrypt_decrypt_stream(crypto_key: CryptoKey, file: str, tmp_path: Path) -> None:
+    encrypted = tmp_path / "encrypted"
+    decrypted = tmp_path / "decrypted"
+    length = crypto_key.encrypt_stream(file, encrypted)
+    assert length == os.stat(file).st_size
+    with open(file, "rb") as fd:
+        data = fd.read()
+    assert encrypted.read_bytes() == crypto_key.encrypt(data)
+
+    crypto_key.decrypt_stream(encrypted, decrypted)
+    assert decrypted.read_bytes() == data
+
+    # file objects, from the current position
+    with open(file, "rb") as src:
+        src.seek(length // 2)
+        output = BytesIO()
+        assert crypto_key.encrypt_stream(src, output) == length - length // 2
+        assert crypto_key.decrypt(output.getvalue()) == data[length // 2 :]
+
+
+def test_stream_length(crypto_key: CryptoKey) -> None:
+    data = b"0123456789"
+    output = BytesIO()
+    assert crypto_key.encrypt_stream(BytesIO(data), output, length=4) == 4
+    assert crypto_key.decrypt(output.getvalue()) == data[:4]
+
+
+@pytest.mark.parametrize(
+    "file",
+    ["./test/test.txt", "./test/test2.txt", "./test/test3.txt", "./test/test4.bin"],
+)
+def test_encrypt_decrypt_pipelined(crypto_key: CryptoKey, file: str) -> None:
+    with open(file, "rb") as fd:
+        data = fd.read()
+    data_enc = crypto_key.encrypt(data)
+    crypto_key.pipeline_depth = 2
+    try:
+        assert crypto_key.encrypt(data) == data_enc
+        assert crypto_key.decrypt(data_enc) == data
+    finally:
+        crypto_key.pipeline_depth = 1
+
+
+def test_pipelined_short_final_chunk(crypto_key: CryptoKey, monkeypatch: pytest.MonkeyPatch) -> None:
+    # the writer must not use the coalescing buffer, which the reader thread flushes
+    class GuardedBuffer(bytearray):
+        pipelined = False
+
+        def __iadd__(self, b: Any) -> Self:
+            assert not self.pipelined, "written to the coalescing buffer while pipelined"
+            return super().__iadd__(b)
+
+    buffer = GuardedBuffer()
+    crypt_pipelined = crypto_key._crypt_pipelined
+
+    def guarded_crypt_pipelined(*args: Any) -> None:
+        buffer.pipelined = True
+        try:
+            crypt_pipelined(*args)
+        finally:
+            buffer.pipelined = False
+
+    monkeypatch.setattr(crypto_key, "_write_buffer", buffer)
+    monkeypatch.setattr(crypto_key, "_crypt_pipelined", guarded_crypt_pipelined)
+    data = os.urandom(2 * crypto_key.chunk_size + CryptoKey.COALESCE_BYTES - 1)
+    ciphertext = crypto_key.encrypt(data)
+    crypto_key.pipeline_depth = 2
+    try:
+        assert crypto_key.decrypt(crypto_key.encrypt(data)) == data
+        assert crypto_key.decrypt(ciphertext) == data
+    finally:
+        crypto_key.pipeline_depth = 1
+
+
+@pytest.mark.parametrize(
+    "file",
+    ["./test/test.txt", "./test/test2.txt", "./test/test3.txt", "./test/test4.bin"],
+)
+def test_encrypt_decrypt_into(crypto_key: CryptoKey, file: str) -> None:
+    with open(file, "rb") as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        length = len(data)
+        encrypted = bytearray(length)
+        assert crypto_key.encrypt_into(data, encrypted) == length
+        assert encrypted == crypto_key.encrypt(data[:])
+
+        # decrypt into a larger anonymous mmap
+        with mmap.mmap(-1, length + 10) as decrypted:
+            assert crypto_key.decrypt_into(memoryview(encrypted), decrypted) == length
+            assert decrypted[:length] == data[:]
+
+
+def test_encrypt_into_invalid(crypto_key: CryptoKey) -> None:
+    with pytest.raises(ValueError):
+        crypto_key.encrypt_into(b"too long", bytearray(4))
+    with pytest.raises(ValueError):
+        crypto_key.encrypt_into(b"readonly", b"readonly")
+
+
+@pytest.mark.parametrize("mode", ["ctr", "gcm"])
+@pytest.mark.parametrize(
+    "file",
+    ["./test/test.txt", "./test/test2.txt", "./test/test3.txt", "./test/test4.bin"],
+)
+def test_cipher_modes(crypto_key: CryptoKey, file: str, mode: CipherMode, tmp_path: Path) -> None:
+    data = Path(file).read_bytes()
+    ciphertext = crypto_key.encrypt(data, mode)
+    assert len(ciphertext) == len(data) + CryptoKey.ciphertext_overhead(mode)
+    assert ciphertext.startswith(b"PCK\x01")
+    # random nonce
+    assert crypto_key.encrypt(data, mode) != ciphertext
+    assert crypto_key.decrypt(ciphertext, mode) == data
+    with pytest.raises(ValueError):
+        crypto_key.decrypt(ciphertext, "ctr" if mode == "gcm" else "gcm")
+
+    encrypted = tmp_path / "encrypted"
+    decrypted = tmp_path / "decrypted"
+    assert crypto_key.encrypt_stream(file, encrypted, mode=mode) == len(data)
+    assert crypto_key.decrypt_stream(encrypted, decrypted, mode=mode) == len(data)
+    assert decrypted.read_bytes() == data
+    assert crypto_key.decrypt(encrypted.read_bytes(), mode) == data
+
+    output = bytearray(len(data))
+    assert crypto_key.decrypt_into(memoryview(ciphertext), output, mode) == len(data)
+    assert output == data
+
+    crypto_key.pipeline_depth = 2
+    try:
+        assert crypto_key.decrypt(crypto_key.encrypt(data, mode), mode) == data
+    finally:
+        crypto_key.pipeline_depth = 1
+
+
+def test_gcm_authentication(crypto_key: CryptoKey, tmp_path: Path) -> None:
+    data = os.urandom(5000)
+    ciphertext = crypto_key.encrypt(data, "gcm")
+    # modified ciphertext, tag and nonce
+    for pos in (100, len(ciphertext) - 1, CryptoKey.HEADER_BYTES - 1):
+        tampered = bytearray(ciphertext)
+        tampered[pos] ^= 1
+        with pytest.raises(CryptoKeyAuthenticationError):
+            crypto_key.decrypt(tampered, "gcm")
+        output = bytearray(b"\xff" * len(data))
+        with pytest.raises(CryptoKeyAuthenticationError):
+            crypto_key.decrypt_into(tampered, output, "gcm")
+        assert output == bytes(len(data))
+        with pytest.raises(CryptoKeyAuthenticationError):
+            crypto_key.decrypt_stream(BytesIO(tampered), tmp_path / "decrypted", mode="gcm")
+    # device is still usable
+    assert crypto_key.decrypt(ciphertext, "gcm") == data
+
+
+def test_cipher_mode_invalid(crypto_key: CryptoKey) -> None:
+    invalid: Any = "ecb"
+    with pytest.raises(ValueError):
+        crypto_key.encrypt(b"data", invalid)
+    with pytest.raises(ValueError):
+        crypto_key.decrypt(b"short", "ctr")
+    # cfb8 ciphertexts have no header
+    with pytest.raises(ValueError):
+        crypto_key.decrypt(crypto_key.encrypt(os.urandom(100)), "ctr")
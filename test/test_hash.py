@@ -1,8 +1,17 @@
+import mmap
+import os
+from collections.abc import Iterator
 from hashlib import sha256
+from io import BytesIO
+from pathlib import Path
+from typing import Any
 
 import pytest
+import usb.core
 
 from pico_crypto_key import CryptoKey
+from pico_crypto_key.device import _sessions
+from pico_crypto_key.emulator import EmulatedDevice
 
 
 @pytest.mark.parametrize(
@@ -18,3 +27,113 @@ def test_hash(crypto_key: CryptoKey, file: str) -> None:
 
     # check hash matches hashlib's sha256
     assert digest == hash2
+
+
+def test_hash_sources(crypto_key: CryptoKey) -> None:
+    file = "./test/test2.txt"
+    with open(file, "rb") as fd:
+        data = fd.read()
+    expected = sha256(data).digest()
+
+    assert crypto_key.hash(Path(file)) == expected
+    assert crypto_key.hash(data) == expected
+    assert crypto_key.hash(bytearray(data)) == expected
+    assert crypto_key.hash(memoryview(data)[100:]) == sha256(data[100:]).digest()
+    assert crypto_key.hash(BytesIO(data)) == expected
+    assert crypto_key.hash(BytesIO(data), length=100) == sha256(data[:100]).digest()
+    assert crypto_key.hash(b"") == sha256().digest()
+    with open(file, "rb") as fd:
+        fd.seek(1000)
+        assert crypto_key.hash(fd) == sha256(data[1000:]).digest()
+        fd.seek(0)
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            assert crypto_key.hash(mapped) == expected
+
+
+def test_hash_empty_file(crypto_key: CryptoKey, tmp_path: Path) -> None:
+    file = tmp_path / "empty"
+    file.touch()
+    assert crypto_key.hash(file) == sha256().digest()
+
+
+def test_hash_missing_file(crypto_key: CryptoKey) -> None:
+    with pytest.raises(FileNotFoundError):
+        crypto_key.hash("./test/missing.txt")
+    # device is still in sync
+    assert crypto_key.hash(b"abc") == sha256(b"abc").digest()
+
+
+def test_hash_many(crypto_key: CryptoKey, tmp_path: Path) -> None:
+    # empty, small, larger than a transfer, and more than the device can buffer the digests of
+    data = [os.urandom(n) for n in (0, 1, 1000, 5000, 10000)] + [os.urandom(50) for _ in range(200)]
+    file = tmp_path / "data"
+    file.write_bytes(data[2])
+    items: list[Any] = [data[0], bytearray(data[1]), file, BytesIO(data[3]), memoryview(data[4]), *data[5:]]
+    expected = [sha256(d).digest() for d in data]
+
+    taken = 0
+
+    def lazily() -> Iterator[Any]:
+        nonlocal taken
+        for item in items:
+            taken += 1
+            yield item
+
+    results = crypto_key.hash_many(lazily())
+    assert next(results) == expected[0]
+    # results are available before all the items have been taken
+    assert taken < len(items)
+    assert [expected[0], *results] == expected
+
+    crypto_key.reset_stats()
+    assert list(crypto_key.hash_many(data[5:])) == expected[5:]
+    # small items are packed into far fewer transfers than hash() would need
+    stats = crypto_key.stats()["hash_many"]
+    assert stats["writes"] < len(data[5:]) / 10
+    assert stats["reads"] < len(data[5:]) / 10
+    assert list(crypto_key.hash_many([])) == []
+
+
+def test_hash_many_errors(crypto_key: CryptoKey) -> None:
+    data = [os.urandom(100) for _ in range(100)]
+    # abandoned
+    results = crypto_key.hash_many(data)
+    assert next(results) == sha256(data[0]).digest()
+    results.close()
+    # an item that can't be opened is only detected when it's reached
+    results = crypto_key.hash_many([*data, "./test/missing.txt"])
+    with pytest.raises(FileNotFoundError):
+        list(results)
+    # device is still in sync
+    assert crypto_key.hash(b"abc") == sha256(b"abc").digest()
+
+
+def test_hash_many_legacy(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    with CryptoKey(EmulatedDevice(legacy=True)) as crypto_key:
+        data = [b"a", b"bc", b""]
+        assert list(crypto_key.hash_many(data)) == [sha256(d).digest() for d in data]
+
+
+@pytest.mark.parametrize("op", ["hash", "sign"])
+def test_upload_error(monkeypatch: pytest.MonkeyPatch, tmp_path: Path, op: str) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    device = EmulatedDevice()
+    path = tmp_path / "data.bin"
+    path.write_bytes(os.urandom(10_000))
+    with pytest.raises(usb.core.USBTimeoutError), CryptoKey(device, idle_timeout=10) as crypto_key:
+        ep_out = device.endpoints[0]
+        write = ep_out.write
+        writes = [0]
+
+        def failing_write(data: Any, timeout: int | None = None) -> int:
+            writes[0] += 1
+            if writes[0] == 2:
+                raise usb.core.USBTimeoutError("Operation timed out", errno=110)
+            return write(data, timeout)
+
+        monkeypatch.setattr(ep_out, "write", failing_write)
+        # the transfer error, not a failure to unmap the file while its slices are still referenced
+        getattr(crypto_key, op)(path)
+    # the device may have been left mid-command, so isn't kept for reuse
+    assert device not in _sessions
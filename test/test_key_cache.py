@@ -0,0 +1,82 @@
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from pico_crypto_key import CryptoKey, device
+from pico_crypto_key.emulator import EmulatedDevice
+
+
+def _transfers(emulated: EmulatedDevice) -> int:
+    return sum(endpoint.transfers for endpoint in emulated.endpoints)
+
+
+def test_device_id(crypto_key: CryptoKey) -> None:
+    device_id = crypto_key.device_id()
+    assert device_id is not None
+    assert len(device_id) == CryptoKey.HASH_BYTES
+    assert crypto_key.device_id() == device_id
+
+
+def test_key_cache(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    monkeypatch.setattr(device, "_key_cache", {})
+    emulated = EmulatedDevice(board_id=b"KEYCACHE")
+    with CryptoKey(emulated) as crypto_key:
+        pubkey = crypto_key.pubkey()
+        registered = crypto_key.register("rp", "user")
+        transfers = _transfers(emulated)
+        assert crypto_key.pubkey() == pubkey
+        assert crypto_key.register("rp", "user") == registered
+        assert _transfers(emulated) == transfers
+        assert crypto_key.register("rp", "other") != registered
+
+    # cache persists across sessions with the same device...
+    with CryptoKey(emulated) as crypto_key:
+        crypto_key.device_id()
+        transfers = _transfers(emulated)
+        assert crypto_key.pubkey() == pubkey
+        assert _transfers(emulated) == transfers
+
+    # ...but a different device gets its own entries
+    with CryptoKey(EmulatedDevice(board_id=b"ANOTHER!")) as crypto_key:
+        assert crypto_key.pubkey() != pubkey
+        assert crypto_key.register("rp", "user") != registered
+
+    with CryptoKey(emulated, key_cache=None) as crypto_key:
+        transfers = _transfers(emulated)
+        assert crypto_key.pubkey() == pubkey
+        assert _transfers(emulated) - transfers == 2
+
+    invalid: Any = "elsewhere"
+    with pytest.raises(ValueError):
+        CryptoKey(emulated, key_cache=invalid)
+
+
+def test_key_cache_disk(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    monkeypatch.setenv("PICO_CRYPTO_KEY_CONFIG_DIR", str(tmp_path))
+    monkeypatch.setattr(device, "_key_cache", {})
+    emulated = EmulatedDevice(board_id=b"KEYCACHE")
+    with CryptoKey(emulated, key_cache="disk") as crypto_key:
+        pubkey = crypto_key.pubkey()
+    assert (tmp_path / "keys.json").exists()
+
+    # simulate a new process
+    monkeypatch.setattr(device, "_key_cache", {})
+    with CryptoKey(emulated, key_cache="disk") as crypto_key:
+        crypto_key.device_id()
+        transfers = _transfers(emulated)
+        assert crypto_key.pubkey() == pubkey
+        assert _transfers(emulated) == transfers
+        crypto_key.clear_key_cache()
+        assert crypto_key.pubkey() == pubkey
+        # one write (command) and one read (key)
+        assert _transfers(emulated) - transfers == 2
+
+
+def test_key_cache_legacy_firmware(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    with CryptoKey(EmulatedDevice(legacy=True)) as crypto_key:
+        assert crypto_key.device_id() is None
+        assert crypto_key.pubkey() == crypto_key.pubkey()
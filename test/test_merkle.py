@@ -0,0 +1,125 @@
+import os
+from hashlib import sha256
+from pathlib import Path
+
+import pytest
+
+from pico_crypto_key import CryptoKey, CryptoKeyAuthenticationError
+from pico_crypto_key.merkle import ChunkVerifier, Manifest, hash_chunks, leaf_hash, merkle_root, node_hash
+from pico_crypto_key.verifier import Verifier
+
+
+def _reference_root(leaves: list[bytes]) -> bytes:
+    """RFC 6962 tree hash, splitting at the largest power of two below the number of leaves"""
+    if not leaves:
+        return sha256().digest()
+    if len(leaves) == 1:
+        return leaves[0]
+    split = 1 << (len(leaves) - 1).bit_length() - 1
+    return node_hash(_reference_root(leaves[:split]), _reference_root(leaves[split:]))
+
+
+def test_merkle_root() -> None:
+    leaves = [leaf_hash(bytes([i])) for i in range(20)]
+    for n in range(len(leaves)):
+        assert merkle_root(leaves[:n]) == _reference_root(leaves[:n])
+    # RFC 6962 test vector: the empty tree
+    assert merkle_root([]).hex() == "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+
+
+def test_hash_chunks(tmp_path: Path) -> None:
+    data = os.urandom(10_000)
+    path = tmp_path / "data.bin"
+    path.write_bytes(data)
+    size, leaves = hash_chunks(path, 1000)
+    assert size == len(data)
+    assert leaves == [leaf_hash(data[pos : pos + 1000]) for pos in range(0, len(data), 1000)]
+    assert hash_chunks(path, 3000, workers=1) == hash_chunks(path, 3000, workers=4)
+    assert len(hash_chunks(path, 3000)[1]) == 4
+
+    (tmp_path / "empty").touch()
+    assert hash_chunks(tmp_path / "empty") == (0, [])
+    with pytest.raises(ValueError):
+        hash_chunks(path, 0)
+
+
+def test_sign_large(crypto_key: CryptoKey, tmp_path: Path) -> None:
+    data = bytearray(os.urandom(10_500))
+    path = tmp_path / "large.bin"
+    path.write_bytes(data)
+    manifest = crypto_key.sign_large(path, chunk_size=1000)
+    assert (manifest.file, manifest.size, manifest.chunk_size) == ("large.bin", len(data), 1000)
+    assert len(manifest.leaves) == 11
+    assert manifest.pubkey == crypto_key.pubkey()
+    assert crypto_key.verify(manifest.root, manifest.signature, manifest.pubkey) == 0
+
+    manifest.save(tmp_path / "manifest.json")
+    loaded = Manifest.load(tmp_path / "manifest.json")
+    assert loaded.to_dict() == manifest.to_dict()
+
+    # the device and host verifiers are interchangeable
+    verifier = ChunkVerifier(loaded, Verifier().verify)
+    ChunkVerifier(loaded, crypto_key.verify)
+    assert verifier.verify_file(path) == []
+    assert all(verifier.verify_chunk(i, data[i * 1000 : (i + 1) * 1000]) for i in range(11))
+    assert verifier.chunk_length(10) == 500
+    assert not verifier.verify_chunk(1, data[:1000])
+    assert not verifier.verify_chunk(10, data[10_000:10_400])
+    assert not verifier.verify_chunk(11, b"")
+
+    # changed or appended data is located to its chunk
+    data[4321] ^= 1
+    path.write_bytes(data + b"more")
+    assert verifier.verify_file(path, workers=2) == [4, 10]
+    path.write_bytes(data[:2500])
+    assert verifier.verify_file(path) == list(range(2, 11))
+
+
+def test_sign_large_empty(crypto_key: CryptoKey, tmp_path: Path) -> None:
+    path = tmp_path / "empty"
+    path.touch()
+    manifest = crypto_key.sign_large(path)
+    assert manifest.leaves == []
+    assert ChunkVerifier(manifest, crypto_key.verify).verify_file(path) == []
+
+
+def test_manifest_tampering(crypto_key: CryptoKey, tmp_path: Path) -> None:
+    path = tmp_path / "data.bin"
+    path.write_bytes(os.urandom(5000))
+    manifest = crypto_key.sign_large(path, chunk_size=1000)
+
+    tampered = Manifest.from_dict(manifest.to_dict())
+    tampered.leaves[2] = leaf_hash(b"other")
+    with pytest.raises(CryptoKeyAuthenticationError, match="don't match the root"):
+        ChunkVerifier(tampered, crypto_key.verify)
+
+    tampered = Manifest.from_dict(manifest.to_dict())
+    tampered.root = merkle_root(tampered.leaves[:-1])
+    tampered.size = 4000
+    tampered.leaves = tampered.leaves[:-1]
+    with pytest.raises(CryptoKeyAuthenticationError, match="signature"):
+        ChunkVerifier(tampered, crypto_key.verify)
+
+    tampered = Manifest.from_dict(manifest.to_dict())
+    tampered.size = 6000
+    with pytest.raises(CryptoKeyAuthenticationError, match="file size"):
+        ChunkVerifier(tampered, crypto_key.verify)
+
+    # rejected on loading, or by the verifier if constructed directly
+    for field, value, message in [
+        ("chunk_size", 0, "chunk size"),
+        ("chunk_size", -1000, "chunk size"),
+        ("chunk_size", "1000", "chunk size"),
+        ("size", -1, "file size"),
+    ]:
+        with pytest.raises(CryptoKeyAuthenticationError, match=f"invalid {message}"):
+            Manifest.from_dict({**manifest.to_dict(), field: value})
+    tampered = Manifest.from_dict(manifest.to_dict())
+    tampered.chunk_size = 0
+    with pytest.raises(CryptoKeyAuthenticationError, match="invalid chunk size"):
+        ChunkVerifier(tampered, crypto_key.verify)
+
+    with pytest.raises(ValueError, match="version"):
+        Manifest.from_dict({**manifest.to_dict(), "version": 2})
+    with pytest.raises(ValueError, match="not a Merkle"):
+        Manifest.from_dict({})
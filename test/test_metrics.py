@@ -0,0 +1,200 @@
+import os
+import urllib.request
+from collections.abc import Generator
+from typing import cast
+
+import pytest
+
+from pico_crypto_key import CryptoKey, CryptoKeyAuthenticationError, metrics
+from pico_crypto_key.emulator import EmulatedDevice
+from pico_crypto_key.metrics import LATENCY_BUCKETS, Sample
+
+
+@pytest.fixture
+def crypto_key(monkeypatch: pytest.MonkeyPatch) -> Generator[CryptoKey, None, None]:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    with CryptoKey(EmulatedDevice(), key_cache=None) as key:
+        # query (and cache) the capabilities now, rather than in the first operation that needs them
+        key.capabilities()
+        key.reset_stats()
+        yield key
+
+
+def test_stats(crypto_key: CryptoKey) -> None:
+    data = os.urandom(10000)
+    crypto_key.hash(data)
+    crypto_key.hash(data)
+    stats = crypto_key.stats()
+    assert list(stats) == ["hash"]
+    hash_stats = stats["hash"]
+    assert hash_stats["calls"] == 2
+    assert hash_stats["errors"] == 0
+    # command and length are sent with the first chunk of data; then the digest
+    chunks = -(-len(data) // crypto_key.upload_chunk_size)
+    assert hash_stats["writes"] == 2 * chunks
+    assert hash_stats["bytes_sent"] == 2 * (1 + 4 + len(data))
+    assert hash_stats["bytes_received"] == 2 * CryptoKey.HASH_BYTES
+    assert hash_stats["reads"] >= 2
+    assert 0 < hash_stats["write_s"] + hash_stats["read_s"] <= hash_stats["latency_s"]
+    assert len(hash_stats["latency_buckets"]) == len(LATENCY_BUCKETS) + 1
+    assert sum(hash_stats["latency_buckets"]) == 2
+
+    # nested calls are attributed to the outer operation
+    ciphertext = crypto_key.encrypt(data, "gcm")
+    assert "encrypt_into" not in crypto_key.stats()
+    assert crypto_key.stats()["encrypt"]["bytes_received"] == len(ciphertext) - CryptoKey.HEADER_BYTES
+
+    crypto_key.reset_stats()
+    assert crypto_key.stats() == {}
+
+
+def test_errors(crypto_key: CryptoKey) -> None:
+    ciphertext = bytearray(crypto_key.encrypt(b"secret", "gcm"))
+    ciphertext[-1] ^= 1
+    with pytest.raises(CryptoKeyAuthenticationError):
+        crypto_key.decrypt(bytes(ciphertext), "gcm")
+    assert crypto_key.stats()["decrypt"]["errors"] == 1
+    # errors before anything is sent
+    with pytest.raises(ValueError):
+        crypto_key.decrypt(b"short", "gcm")
+    assert crypto_key.stats()["decrypt"]["calls"] == crypto_key.stats()["decrypt"]["errors"] == 2
+
+
+def test_generator(crypto_key: CryptoKey) -> None:
+    items = [os.urandom(100) for _ in range(5)]
+    assert len(list(crypto_key.sign_many(items))) == 5
+    stats = crypto_key.stats()
+    # sign_many is recorded once, including its uploads
+    assert set(stats) == {"sign_many"}
+    assert stats["sign_many"]["calls"] == 1
+    assert stats["sign_many"]["bytes_sent"] > 500
+
+    # an abandoned batch is recorded once it has been completed
+    results = crypto_key.sign_many(items)
+    next(results)
+    results.close()
+    assert crypto_key.stats()["sign_many"]["calls"] == 2
+    assert crypto_key.stats()["sign_many"]["errors"] == 0
+    assert crypto_key.info()
+
+
+def test_hooks(crypto_key: CryptoKey) -> None:
+    samples: list[Sample] = []
+    crypto_key.add_hook(samples.append)
+    digest, sig = crypto_key.sign(b"data")
+    crypto_key.verify(digest, sig, crypto_key.pubkey())
+    assert [sample.operation for sample in samples] == ["sign", "pubkey", "verify"]
+    assert samples[0].bytes_sent == 1 + 4 + 4
+    assert samples[0].error is None
+    assert samples[0].latency_s > 0
+    crypto_key.remove_hook(samples.append)
+    crypto_key.pubkey()
+    assert len(samples) == 3
+
+
+def test_round_trips(crypto_key: CryptoKey) -> None:
+    digest, sig = crypto_key.sign(b"data")
+    pubkey = crypto_key.pubkey()
+    assert crypto_key.verify(digest, sig, pubkey) == 0
+    crypto_key.register("example.com", "user")
+    crypto_key.auth("example.com", "user", b"challenge")
+    crypto_key.info()
+    # each command is sent, with its arguments, in a single transfer
+    stats = crypto_key.stats()
+    for operation in ("sign", "pubkey", "verify", "register", "auth", "info"):
+        assert stats[operation]["writes"] == 1, operation
+    assert stats["verify"]["bytes_sent"] == 1 + len(digest) + 4 + len(sig) + 4 + len(pubkey)
+
+    # ...along with the first chunk of data
+    data = os.urandom(crypto_key.chunk_size * 2 + 1)
+    assert crypto_key.decrypt(crypto_key.encrypt(data)) == data
+    assert crypto_key.stats()["encrypt"]["writes"] == 3
+
+    # nothing is sent until a reply is read
+    crypto_key._write(b"i")
+    assert crypto_key._write_buffer == b"i"
+    length = crypto_key._read_uint32()
+    assert not crypto_key._write_buffer
+    assert CryptoKey._parse_info(crypto_key._read(length))[0] == crypto_key.info()[0]
+
+
+@pytest.mark.parametrize("enabled", [True, False])
+def test_partial_command_discarded(monkeypatch: pytest.MonkeyPatch, enabled: bool) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    with CryptoKey(EmulatedDevice(), metrics=enabled) as crypto_key:
+        data = b"data"
+        digest = crypto_key.hash(data)
+        # fails after the command and digest have been buffered, but before anything is sent
+        with pytest.raises(TypeError):
+            crypto_key.verify(digest, cast(bytes, "not bytes"), crypto_key.pubkey())
+        assert not crypto_key._write_buffer
+        assert crypto_key.hash(data) == digest
+
+
+def test_disabled(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    with CryptoKey(EmulatedDevice(), metrics=False) as crypto_key:
+        crypto_key.hash(b"data")
+        assert crypto_key.stats() == {}
+        with pytest.raises(ValueError):
+            crypto_key.add_hook(print)
+
+
+def test_openmetrics(crypto_key: CryptoKey) -> None:
+    crypto_key.hash(b"data")
+    crypto_key.device_id()
+    text = crypto_key.openmetrics()
+    lines = text.splitlines()
+    assert lines[-1] == "# EOF"
+    device = crypto_key._device_id.hex() if crypto_key._device_id else ""
+    assert f'pico_crypto_key_operations_total{{device="{device}",operation="hash"}} 1' in lines
+    assert f'pico_crypto_key_transferred_bytes_total{{device="{device}",operation="hash",direction="out"}} 9' in lines
+    assert f'pico_crypto_key_operation_seconds_bucket{{device="{device}",operation="hash",le="+Inf"}} 1' in lines
+    assert f'pico_crypto_key_operation_seconds_count{{device="{device}",operation="device_id"}} 1' in lines
+    # every metric family is declared before its samples
+    families = [line.split()[2] for line in lines if line.startswith("# TYPE")]
+    for line in lines:
+        if not line.startswith("#"):
+            assert any(line.startswith(family + "_") for family in families)
+
+    assert '{board="a\\"b"' in metrics.openmetrics(crypto_key.stats(), {"board": 'a"b'})
+
+
+def test_serve(crypto_key: CryptoKey) -> None:
+    crypto_key.hash(b"data")
+    server = metrics.serve(crypto_key.openmetrics, 0)
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:  # noqa: S310
+            assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+            assert response.read().decode() == crypto_key.openmetrics()
+    finally:
+        server.shutdown()
+
+
+def test_device_profile(crypto_key: CryptoKey) -> None:
+    crypto_key.device_profile(reset=True)
+    data = os.urandom(10000)
+    crypto_key.hash(data)
+    crypto_key.hash(data)
+    crypto_key.sign_digest(crypto_key.hash(data))
+    profile = crypto_key.device_profile()
+    assert set(profile) == {"hash", "sign_digest", "device_profile"}
+    assert profile["device_profile"]["calls"] == 1
+    hash_profile = profile["hash"]
+    assert hash_profile["calls"] == 3
+    # length and data in, digest out
+    assert hash_profile["bytes_in"] == 3 * (4 + len(data))
+    assert hash_profile["bytes_out"] == 3 * CryptoKey.HASH_BYTES
+    assert hash_profile["usb_read_us"] + hash_profile["usb_write_us"] <= hash_profile["total_us"]
+    assert profile["sign_digest"]["compute_us"] > 0
+
+    # counters accumulate until reset
+    assert crypto_key.device_profile(reset=True)["device_profile"]["calls"] == 2
+    assert set(crypto_key.device_profile()) == {"device_profile"}
+
+
+def test_device_profile_legacy(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    with CryptoKey(EmulatedDevice(legacy=True)) as crypto_key:
+        crypto_key.hash(b"data")
+        assert crypto_key.device_profile() == {}
@@ -1,6 +1,9 @@
 from datetime import UTC, datetime
 
-from pico_crypto_key import CryptoKey, __version__
+import pytest
+
+from pico_crypto_key import CryptoKey, CryptoKeyPinError, __version__, device
+from pico_crypto_key.emulator import EmulatedDevice
 
 
 def test_pubkey(crypto_key: CryptoKey) -> None:
@@ -20,3 +23,30 @@ def test_reset_init(crypto_key: CryptoKey) -> None:
     crypto_key.reset()
     crypto_key.init()
     test_pubkey(crypto_key)
+
+
+def test_set_pin(monkeypatch: pytest.MonkeyPatch) -> None:
+    emulated = EmulatedDevice()
+    # non-ASCII, so its length in bytes differs from its length in characters
+    new_pin = "pïcø"
+    prompts = iter([("PIN:", "pico"), ("NEW PIN:", new_pin), ("CONFIRM:", new_pin), ("PIN:", new_pin)])
+
+    def pwinput(prompt: str) -> str:
+        expected, response = next(prompts)
+        assert prompt == expected
+        return response
+
+    monkeypatch.setattr(device, "pwinput", pwinput)
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    with CryptoKey(emulated) as crypto_key:
+        crypto_key.set_pin()
+        # reauthenticated with the new pin
+        assert crypto_key.info()[0] == emulated.version
+    assert next(prompts, None) is None
+
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    with pytest.raises(CryptoKeyPinError), CryptoKey(emulated):
+        pass
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", new_pin)
+    with CryptoKey(emulated) as crypto_key:
+        assert crypto_key.pubkey()
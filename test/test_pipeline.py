@@ -0,0 +1,33 @@
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parent.parent
+
+COMPILER = shutil.which("c++") or shutil.which("g++") or shutil.which("clang++")
+
+
+@pytest.mark.skipif(COMPILER is None, reason="no C++ compiler")
+def test_firmware_pipeline(tmp_path: Path) -> None:
+    """Builds and runs the host unit tests for the firmware's producer/consumer pipeline"""
+    assert COMPILER is not None
+    binary = tmp_path / "test_pipeline"
+    subprocess.run(
+        [
+            COMPILER,
+            "-std=c++20",
+            "-Wall",
+            "-Werror",
+            "-pthread",
+            f"-I{ROOT / 'src'}",
+            str(ROOT / "test" / "firmware" / "test_pipeline.cpp"),
+            "-o",
+            str(binary),
+        ],
+        check=True,
+    )
+    result = subprocess.run([binary], capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "ok"
@@ -0,0 +1,70 @@
+import os
+import threading
+from collections import Counter
+
+import pytest
+
+from pico_crypto_key import CryptoKey, CryptoKeyConnectionError, CryptoKeyPool
+from pico_crypto_key.emulator import EmulatedDevice
+
+
+@pytest.fixture
+def devices(monkeypatch: pytest.MonkeyPatch) -> list[EmulatedDevice]:
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    return [EmulatedDevice(board_id=b"EMULATE%d" % i, latency_ms=1) for i in range(3)]
+
+
+def test_pool(devices: list[EmulatedDevice]) -> None:
+    data = os.urandom(5000)
+    with CryptoKeyPool(devices, key_cache=None) as pool:
+        assert len(pool) == 3
+        # each key has its own identity
+        assert len(set(pool.device_ids())) == 3
+        pubkeys = [pool.pubkey(i).result() for i in range(3)]
+        assert len(set(pubkeys)) == 3
+
+        # any key can hash and verify
+        digest = pool.hash(data).result()
+        assert all(f.result() == digest for f in [pool.hash(data) for _ in range(20)])
+        assert pool.sign(data, device=1).result()[0] == digest
+        sig = pool.sign(data, device=1).result()[1]
+        assert all(f.result() == 0 for f in [pool.verify(digest, sig, pubkeys[1]) for _ in range(6)])
+        assert pool.verify(digest, sig, pubkeys[0]).result() == CryptoKey.VERIFY_FAILED
+
+        # decryption must use the key that encrypted
+        ciphertexts = [pool.encrypt(data, device=i, mode="ctr").result() for i in range(3)]
+        for i, ciphertext in enumerate(ciphertexts):
+            assert pool.decrypt(ciphertext, device=i, mode="ctr").result() == data
+
+        assert pool.register("rp", "user", device=2).result() != pool.register("rp", "user", device=0).result()
+
+        with pytest.raises(IndexError):
+            pool.pubkey(3)
+
+
+def test_pool_scheduling(devices: list[EmulatedDevice]) -> None:
+    with CryptoKeyPool(devices, key_cache=None) as pool:
+        # unpinned work is spread over the keys
+        used = Counter(f.result() for f in [pool.submit(lambda key: key.device_id()) for _ in range(30)])
+        assert len(used) > 1
+
+        # pinned work always runs on its key
+        ids = pool.device_ids()
+        assert all(f.result() == ids[2] for f in [pool.submit(lambda key: key.device_id(), device=2) for _ in range(5)])
+
+        # errors are returned via the future
+        with pytest.raises(ValueError):
+            pool.decrypt(b"PCK\x01\x09" + bytes(12), device=0, mode="ctr").result()
+
+        # queued work completes before the pool closes
+        blocker = threading.Event()
+        futures = [pool.submit(lambda key: blocker.wait(1)), pool.hash(b"data")]
+        blocker.set()
+    assert all(f.done() for f in futures)
+    with pytest.raises(RuntimeError):
+        pool.hash(b"data")
+
+
+def test_pool_no_devices() -> None:
+    with pytest.raises(CryptoKeyConnectionError), CryptoKeyPool([]):
+        pass
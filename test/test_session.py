@@ -0,0 +1,99 @@
+import os
+import time
+from collections.abc import Generator
+
+import pytest
+import usb.core
+
+from pico_crypto_key import CryptoKey
+from pico_crypto_key.device import _sessions
+from pico_crypto_key.emulator import EmulatedDevice
+
+
+@pytest.fixture
+def unlocks(monkeypatch: pytest.MonkeyPatch) -> Generator[list[int], None, None]:
+    """Counts full unlocks (the PIN handshake ends by setting the device time)"""
+    monkeypatch.setenv("PICO_CRYPTO_KEY_PIN", "pico")
+    count = [0]
+    set_device_time = CryptoKey._set_device_time
+
+    def counting_set_device_time(self: CryptoKey) -> None:
+        count[0] += 1
+        set_device_time(self)
+
+    monkeypatch.setattr(CryptoKey, "_set_device_time", counting_set_device_time)
+    yield count
+    CryptoKey.close_sessions()
+
+
+def test_session_reuse(unlocks: list[int]) -> None:
+    device = EmulatedDevice()
+    data = os.urandom(1000)
+    with CryptoKey(device, idle_timeout=10) as crypto_key:
+        ciphertext = crypto_key.encrypt(data)
+    assert device in _sessions
+    for _ in range(3):
+        with CryptoKey(device, idle_timeout=10) as crypto_key:
+            assert crypto_key.decrypt(ciphertext) == data
+    assert unlocks[0] == 1
+
+    # without idle_timeout, sessions are neither reused nor kept
+    with CryptoKey(device) as crypto_key:
+        assert crypto_key.decrypt(ciphertext) == data
+    assert unlocks[0] == 2
+    assert device not in _sessions
+
+    with CryptoKey(device, idle_timeout=10) as crypto_key:
+        assert crypto_key.decrypt(ciphertext) == data
+    CryptoKey.close_sessions()
+    assert not _sessions
+    with CryptoKey(device, idle_timeout=10) as crypto_key:
+        assert crypto_key.decrypt(ciphertext) == data
+    assert unlocks[0] == 4
+
+
+def test_session_idle_timeout(unlocks: list[int]) -> None:
+    device = EmulatedDevice()
+    with CryptoKey(device, idle_timeout=0.1) as crypto_key:
+        crypto_key.info()
+    time.sleep(0.5)
+    assert device not in _sessions
+    with CryptoKey(device, idle_timeout=0.1) as crypto_key:
+        crypto_key.info()
+    assert unlocks[0] == 2
+
+
+def test_session_health_check(unlocks: list[int], monkeypatch: pytest.MonkeyPatch) -> None:
+    device = EmulatedDevice()
+    with CryptoKey(device, idle_timeout=10) as crypto_key:
+        pubkey = crypto_key.pubkey()
+
+    # the parked session no longer responds
+    def unresponsive(self: CryptoKey) -> tuple[str, str]:
+        raise usb.core.USBError("No such device")
+
+    parked = _sessions[device][0]
+    monkeypatch.setattr(parked, "info", unresponsive.__get__(parked))
+    with CryptoKey(device, idle_timeout=10) as crypto_key:
+        assert crypto_key.pubkey() == pubkey
+    assert unlocks[0] == 2
+
+
+def test_session_errors(unlocks: list[int]) -> None:
+    device = EmulatedDevice()
+    # application errors don't affect the device
+    with pytest.raises(KeyError), CryptoKey(device, idle_timeout=10):
+        raise KeyError("application error")
+    assert device in _sessions
+
+    # communication errors may have left it mid-command
+    with pytest.raises(usb.core.USBError), CryptoKey(device, idle_timeout=10):
+        raise usb.core.USBError("timeout")
+    assert device not in _sessions
+
+    with CryptoKey(device, idle_timeout=10) as crypto_key:
+        crypto_key.close()
+        assert not crypto_key.have_repl
+    assert device not in _sessions
+    # the session was reused after the application error
+    assert unlocks[0] == 2
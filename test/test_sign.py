@@ -1,4 +1,7 @@
+import os
 from hashlib import sha256
+from io import BytesIO
+from typing import Any
 
 import ecdsa.util
 import pytest
@@ -52,3 +55,66 @@ def test_sign_verify(crypto_key: CryptoKey, file: str) -> None:
         verifying_key = ecdsa.VerifyingKey.from_string(wrong_pubkey, curve=ecdsa.SECP256k1, hashfunc=sha256)
         with pytest.raises(ecdsa.keys.BadSignatureError):
             verifying_key.verify(wrong_sig, content, sigdecode=ecdsa.util.sigdecode_der)
+
+
+def test_sign_sources(crypto_key: CryptoKey) -> None:
+    file = "./test/test2.txt"
+    with open(file, "rb") as fd:
+        data = fd.read()
+        fd.seek(0)
+        assert crypto_key.sign(fd) == crypto_key.sign(file)
+    digest, sig = crypto_key.sign(data)
+    assert digest == sha256(data).digest()
+    assert crypto_key.sign(BytesIO(data)) == (digest, sig)
+
+
+def test_sign_many(crypto_key: CryptoKey) -> None:
+    files = ["./test/test.txt", "./test/test2.txt", "./test/test3.txt", "./test/test4.bin"]
+    # enough items to fill the device's transmit buffer
+    data = [os.urandom(n) for n in range(0, 2000, 50)]
+    items = [*files, *data, BytesIO(data[-1])]
+
+    results = list(crypto_key.sign_many(items))
+    assert results == [crypto_key.sign(file) for file in files] + [crypto_key.sign(d) for d in data] + [results[-2]]
+
+    digests = [digest for digest, _ in results]
+    assert list(crypto_key.sign_many(digests, prehashed=True)) == results
+    assert list(crypto_key.sign_many([])) == []
+
+
+def test_sign_many_incomplete(crypto_key: CryptoKey) -> None:
+    data = [os.urandom(100) for _ in range(30)]
+    expected = crypto_key.sign(data[0])
+
+    # abandoned batch
+    for result in crypto_key.sign_many(data):
+        assert result == expected
+        break
+    # missing file mid-batch
+    with pytest.raises(FileNotFoundError):
+        list(crypto_key.sign_many([*data, "./test/missing.txt", *data]))
+    with pytest.raises(ValueError):
+        list(crypto_key.sign_many([b"not a digest"], prehashed=True))
+
+    # device is still usable
+    assert crypto_key.sign(data[0]) == expected
+
+
+def test_sign_prehash(crypto_key: CryptoKey) -> None:
+    file = "./test/test4.bin"
+    digest, sig = crypto_key.sign(file)
+    assert crypto_key.sign(file, prehash="host") == (digest, sig)
+    assert crypto_key.sign_digest(digest) == sig
+    with open(file, "rb") as fd:
+        data = fd.read()
+        fd.seek(0)
+        assert crypto_key.sign(fd, prehash="host") == (digest, sig)
+        fd.seek(0)
+        assert crypto_key.sign(fd, length=100, prehash="host") == crypto_key.sign(data[:100])
+    assert crypto_key.sign(memoryview(data), prehash="host") == (digest, sig)
+
+    with pytest.raises(ValueError):
+        crypto_key.sign_digest(digest[1:])
+    invalid: Any = "elsewhere"
+    with pytest.raises(ValueError):
+        crypto_key.sign(file, prehash=invalid)
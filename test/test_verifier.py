@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from pico_crypto_key import CryptoKey
+from pico_crypto_key.verifier import ERR_ECP_BAD_INPUT_DATA, ERR_ECP_INVALID_KEY, Verifier
+
+
+def test_verifier_matches_device(crypto_key: CryptoKey) -> None:
+    verifier = Verifier()
+    pubkey = crypto_key.pubkey()
+    digest, sig = crypto_key.sign(b"some data")
+    wrong_hash, wrong_sig = crypto_key.sign(b"other data")
+    wrong_pubkey = crypto_key.register("user", "rp")
+    # well-formed keys and signatures only: the firmware's codes for malformed input differ (see test_malformed_input)
+    for args in [
+        (digest, sig, pubkey),
+        (wrong_hash, sig, pubkey),
+        (digest, wrong_sig, pubkey),
+        (digest, sig, wrong_pubkey),
+    ]:
+        assert verifier.verify(*args) == crypto_key.verify(*args)
+    assert verifier.verify(digest, sig, pubkey) == 0
+    assert verifier.verify(wrong_hash, sig, pubkey) == CryptoKey.VERIFY_FAILED
+
+
+def test_malformed_input() -> None:
+    # host only: the device stops responding given an unparseable key, and adds an ASN.1 code for malformed DER
+    verifier = Verifier()
+    pubkey = bytes.fromhex("0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798")  # the generator
+    sig = bytes.fromhex(
+        "3044022079be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798"
+        "02201111111111111111111111111111111111111111111111111111111111111111"
+    )
+    assert verifier.verify(bytes(32), sig, pubkey) == CryptoKey.VERIFY_FAILED
+    assert verifier.verify(bytes(32), sig, b"not a key") == ERR_ECP_INVALID_KEY % 2**32
+    # a well-formed encoding of a point not on the curve
+    assert verifier.verify(bytes(32), sig, b"\x02" + bytes(32)) == ERR_ECP_INVALID_KEY % 2**32
+    assert verifier.verify(bytes(32), b"not a signature", pubkey) == ERR_ECP_BAD_INPUT_DATA % 2**32
+    assert verifier.verify(bytes(32), sig[:-1], pubkey) == ERR_ECP_BAD_INPUT_DATA % 2**32
+
+
+def test_verifier_cache(crypto_key: CryptoKey) -> None:
+    verifier = Verifier(cache_size=2)
+    pubkeys = [crypto_key.register(f"user{i}", "rp") for i in range(3)]
+    digest = bytes(32)
+    _, sig = crypto_key.sign(b"some data")
+    for pubkey in [*pubkeys, pubkeys[2], pubkeys[0]]:
+        verifier.verify(digest, sig, pubkey)
+    # only the least recently used key is evicted
+    assert (verifier.hits, verifier.misses) == (1, 4)
+    with pytest.raises(ValueError):
+        Verifier(cache_size=0)
+
+
+def test_verify_many(crypto_key: CryptoKey) -> None:
+    pubkey = crypto_key.pubkey()
+    data = [os.urandom(100) for _ in range(20)]
+    items = [(*crypto_key.sign(d), pubkey) for d in data]
+    items[5] = (bytes(32), items[5][1], pubkey)
+    expected = [CryptoKey.VERIFY_FAILED if i == 5 else 0 for i in range(len(items))]
+
+    verifier = Verifier()
+    assert verifier.verify_many(items) == expected
+    assert verifier.verify_many(items, processes=2, chunksize=4) == expected
+    assert verifier.verify_many([]) == []